@@ -5,25 +5,30 @@ auth.py is callable with manage.py using the command "do_guide_auth"
 import os
 
 from django.conf import settings
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
+from django.template import TemplateDoesNotExist
+from django.template.loader import select_template
+
+from django_devops.management.base import ProfiledCommand
 
 
 PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
 
 
-def confirm_file(name, path=None):
+def confirm_template(template_name):
     """
-    Finds a file by name.
-    If path is set, it will confirm file is in that path.
-    Returns True if file is found, False otherwise.
+    Finds a template through the configured template loaders.
+    Returns the path the template was loaded from, or None if it was not found.
     """
-    for root, _, files in os.walk(os.path.join('opt', PROJECT_NAME)):
-        if name in files and (not path or path in root):
-            return True
-    return False
+    try:
+        template = select_template([template_name])
+    except TemplateDoesNotExist:
+        return None
+    origin = getattr(template, 'origin', None)
+    return getattr(origin, 'name', None) or template_name
 
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     """
     Steps through the guide and makes recommendations related to the Django authentication system.
     """
@@ -42,15 +47,16 @@ class Command(BaseCommand):
 
         # ----------------------------- Verify Templates ----------------------------- #
         template_checklist = [
-            ('login.html', 'templates/registration'),
-            ('register.html', 'templates/registration')
+            'registration/login.html',
+            'registration/register.html'
         ]
 
-        for file_name, expected_path in template_checklist:
-            if confirm_file(file_name, expected_path):
-                print(f'✓ - {file_name} found in {expected_path}/')
+        for template_name in template_checklist:
+            origin = confirm_template(template_name)
+            if origin:
+                print(f'✓ - {template_name} found at {origin}')
             else:
-                print(f'✗ - {file_name} not found in {expected_path}/')
+                print(f'✗ - {template_name} not found by the template loaders')
                 errors_found = True
 
         # ----------------------------- Verify Settings ----------------------------- #
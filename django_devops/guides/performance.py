@@ -0,0 +1,211 @@
+'''
+performance.py is callable with manage.py using the command "do_guide_performance"
+'''
+
+import django
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from django_devops.management.base import ProfiledCommand
+
+
+CACHED_LOADER = 'django.template.loaders.cached.Loader'
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+FAST_SESSION_ENGINES = (
+    'django.contrib.sessions.backends.cache',
+    'django.contrib.sessions.backends.cached_db',
+    'django.contrib.sessions.backends.signed_cookies',
+)
+# Larger request bodies should be streamed to disk instead of read into memory.
+MAX_UPLOAD_MEMORY_SIZE = 10 * 1024 * 1024
+
+
+def check_debug():
+    """
+    DEBUG keeps every SQL query in memory and disables the cached template loader.
+    """
+    if settings.DEBUG:
+        return [(False, 'DEBUG is True, set it to False in production')]
+    return [(True, 'DEBUG is False')]
+
+
+def check_databases():
+    """
+    Persistent connections avoid a new database connection for every request.
+    """
+    results = []
+    for alias, database in settings.DATABASES.items():
+        conn_max_age = database.get('CONN_MAX_AGE', 0)
+        if conn_max_age == 0:
+            results.append((False, f'DATABASES["{alias}"] CONN_MAX_AGE is 0, '
+                                   'a new connection is opened for every request'))
+            continue
+        results.append((True, f'DATABASES["{alias}"] CONN_MAX_AGE is {conn_max_age}'))
+
+        if django.VERSION >= (4, 1) and not database.get('CONN_HEALTH_CHECKS', False):
+            results.append((False, f'DATABASES["{alias}"] CONN_HEALTH_CHECKS is False, '
+                                   'broken persistent connections fail a request'))
+        elif django.VERSION >= (4, 1):
+            results.append((True, f'DATABASES["{alias}"] CONN_HEALTH_CHECKS is True'))
+    return results
+
+
+def check_template_loaders():
+    """
+    Templates should be compiled once per process, not on every render.
+    """
+    results = []
+    for template in settings.TEMPLATES:
+        if template.get('BACKEND') != 'django.template.backends.django.DjangoTemplates':
+            continue
+
+        loaders = template.get('OPTIONS', {}).get('loaders')
+        if loaders is None:
+            # Django enables the cached loader itself when no loaders are configured.
+            cached = not settings.DEBUG or django.VERSION >= (4, 1)
+        else:
+            cached = any(
+                isinstance(loader, (list, tuple)) and loader[0] == CACHED_LOADER
+                for loader in loaders
+            )
+
+        if cached:
+            results.append((True, 'The cached template loader is used'))
+        else:
+            results.append((False, f'The cached template loader is not used, wrap the '
+                                   f'loaders in "{CACHED_LOADER}"'))
+    return results
+
+
+def check_caches():
+    """
+    locmem and dummy caches are not shared between gunicorn workers.
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if backend in PER_PROCESS_CACHES:
+        return [(False, f'The default cache uses {backend}, which is not shared between '
+                        'worker processes. Use Redis or Memcached in production')]
+    return [(True, f'The default cache uses {backend}')]
+
+
+def check_sessions():
+    """
+    Database sessions cost a query on every request that reads the session.
+    """
+    engine = settings.SESSION_ENGINE
+    cache_backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+
+    if engine not in FAST_SESSION_ENGINES:
+        return [(False, f'SESSION_ENGINE is {engine}, use a cache backed session engine')]
+    if engine.endswith('.cache') and cache_backend in PER_PROCESS_CACHES:
+        return [(False, f'SESSION_ENGINE is {engine} but the default cache is per process, '
+                        'sessions will be lost between workers')]
+    return [(True, f'SESSION_ENGINE is {engine}')]
+
+
+def check_static_storage():
+    """
+    Hashed file names allow static files to be cached forever by browsers and nginx.
+    """
+    storages = getattr(settings, 'STORAGES', None) or {}
+    backend = storages.get('staticfiles', {}).get('BACKEND') or \
+        getattr(settings, 'STATICFILES_STORAGE', '')
+
+    if 'Manifest' in backend:
+        return [(True, f'Static files are stored with {backend}')]
+    return [(False, f'Static files are stored with {backend or "the default storage"}, '
+                    'use ManifestStaticFilesStorage so they can be cached forever')]
+
+
+def check_middleware():
+    """
+    Every middleware runs on every request, some of them are better left to nginx.
+    """
+    middleware = list(settings.MIDDLEWARE)
+    results = []
+
+    if 'django.middleware.gzip.GZipMiddleware' in middleware:
+        results.append((False, 'GZipMiddleware compresses responses in Python, '
+                               'let nginx compress them instead'))
+    if 'debug_toolbar.middleware.DebugToolbarMiddleware' in middleware:
+        results.append((False, 'DebugToolbarMiddleware is enabled'))
+    if 'django.middleware.locale.LocaleMiddleware' in middleware and not settings.USE_I18N:
+        results.append((False, 'LocaleMiddleware is enabled but USE_I18N is False'))
+
+    update_cache = 'django.middleware.cache.UpdateCacheMiddleware'
+    fetch_cache = 'django.middleware.cache.FetchFromCacheMiddleware'
+    if update_cache in middleware and middleware[0] != update_cache:
+        results.append((False, 'UpdateCacheMiddleware should be the first middleware'))
+    if fetch_cache in middleware and middleware[-1] != fetch_cache:
+        results.append((False, 'FetchFromCacheMiddleware should be the last middleware'))
+
+    if not results:
+        results.append((True, f'MIDDLEWARE has no unnecessary entries ({len(middleware)} total)'))
+    return results
+
+
+def check_upload_size():
+    """
+    Request bodies below DATA_UPLOAD_MAX_MEMORY_SIZE are read into memory.
+    """
+    size = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+    if size is None:
+        return [(False, 'DATA_UPLOAD_MAX_MEMORY_SIZE is None, request bodies are not limited')]
+    if size > MAX_UPLOAD_MEMORY_SIZE:
+        return [(False, f'DATA_UPLOAD_MAX_MEMORY_SIZE is {size} bytes, '
+                        f'keep it below {MAX_UPLOAD_MEMORY_SIZE}')]
+    return [(True, f'DATA_UPLOAD_MAX_MEMORY_SIZE is {size} bytes')]
+
+
+class Command(ProfiledCommand):
+    """
+    Steps through the guide and makes recommendations related to the performance of the project.
+    """
+
+    help = 'Scores the performance related settings of the project.'
+
+    def handle(self, *args, **options):
+        """
+        Steps through a best practice guide checking the following:
+        1) `DEBUG` is False
+        2) Database connections are persistent and health checked
+        3) The cached template loader is used
+        4) The default cache is shared between processes
+        5) Sessions are not stored in the database
+        6) Static files use ManifestStaticFilesStorage
+        7) `MIDDLEWARE` has no unnecessary or misplaced entries
+        8) `DATA_UPLOAD_MAX_MEMORY_SIZE` is limited
+        """
+
+        errors_found = False
+        passed = total = 0
+
+        checklist = [
+            check_debug,
+            check_databases,
+            check_template_loaders,
+            check_caches,
+            check_sessions,
+            check_static_storage,
+            check_middleware,
+            check_upload_size,
+        ]
+
+        for check in checklist:
+            for check_passed, message in check():
+                total += 1
+                if check_passed:
+                    passed += 1
+                    print(f'✓ | {message}')
+                else:
+                    errors_found = True
+                    print(f'✗ | {message}')
+
+        # ------------------------------- Report Errors ------------------------------ #
+        print(f'Score: {passed}/{total}')
+
+        if errors_found:
+            raise CommandError('One or more errors were found in the guide.')
@@ -0,0 +1,51 @@
+'''
+The base class of the django_devops management commands.
+'''
+
+import sys
+
+from django.core.management.base import BaseCommand
+
+from django_devops.utils.logger import finish_profile, span, start_profile
+
+
+# Each command implements handle, this base only adds the profiling options.
+class ProfiledCommand(BaseCommand):  # pylint: disable=abstract-method
+    '''
+    A management command with "--profile" and "--profile-json" options.
+    The command runs in a span named after it, steps of the command can add their own
+    spans with django_devops.utils.logger.span.
+    With "--profile-json -" stdout only carries the JSON lines, the output goes to stderr.
+    '''
+
+    def create_parser(self, prog_name, subcommand, **kwargs):
+        '''
+        Adds the profiling options to every command, next to Django's own options.
+        '''
+        parser = super().create_parser(prog_name, subcommand, **kwargs)
+        parser.add_argument(
+            '--profile', action='store_true',
+            help='Print the slowest steps of the command when it finishes.'
+        )
+        parser.add_argument(
+            '--profile-json', metavar='PATH',
+            help='Append timing spans and log records to PATH as JSON lines, "-" for stdout '
+                 '(the output of the command then goes to stderr).'
+        )
+        return parser
+
+    def execute(self, *args, **options):
+        '''
+        Runs the command, profiled if one of the profiling options is set.
+        '''
+        if not options.get('profile') and not options.get('profile_json'):
+            return super().execute(*args, **options)
+
+        if options.get('profile_json') == '-':
+            options['stdout'] = sys.stderr
+        start_profile(options.get('profile_json'))
+        try:
+            with span(self.__module__.rsplit('.', 1)[-1]):
+                return super().execute(*args, **options)
+        finally:
+            finish_profile()
@@ -0,0 +1,157 @@
+'''
+Reports the latency of each route from the access logs of gunicorn or nginx.
+'''
+
+import os
+import glob
+import multiprocessing
+from datetime import datetime
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.urls import Resolver404, resolve
+
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.access_logs import analyze_lines, read_lines
+
+PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
+
+# Written by the nginx config of "prep_nginx", rotated files are read as well.
+NGINX_ACCESS_LOG = f'/var/log/nginx/{PROJECT_NAME}.access.log'
+
+
+@lru_cache(maxsize=65536)
+def route_of(path):
+    '''
+    Returns the URL pattern that handles path, so /item/1/ and /item/2/ share one route.
+    '''
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return '<unresolved>'
+    return '/' + match.route if match.route else match.view_name or path
+
+
+def analyze_file(path, interval, top):
+    '''
+    Returns the LogStats of a single file, run in a worker process.
+    '''
+    return analyze_lines(read_lines(path), route_of, interval, top)
+
+
+def format_seconds(seconds):
+    '''
+    Formats a latency in milliseconds.
+    '''
+    return f'{seconds * 1000:.0f}ms'
+
+
+def analyze_files(paths, processes, interval, top):
+    '''
+    Analyzes each file in its own process and returns the merged LogStats.
+    '''
+    processes = min(processes, len(paths))
+    if processes > 1 and '-' not in paths:
+        # Forked workers inherit the configured Django project and its URLconf.
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            results = pool.starmap(analyze_file, [(path, interval, top) for path in paths])
+    else:
+        results = [analyze_file(path, interval, top) for path in paths]
+
+    stats = results[0]
+    for result in results[1:]:
+        stats.merge(result)
+    return stats
+
+
+def print_routes(stats):
+    '''
+    Prints the latency percentiles of each route, the busiest routes first.
+    '''
+    width = max(len(route) for route in stats.routes)
+    print(f'{"Route":<{width}} {"Requests":>9} {"p50":>8} {"p95":>8} {"p99":>8} {"5xx":>6}')
+    ordered = sorted(stats.routes.items(), key=lambda item: -item[1].count)
+    for route, histogram in ordered:
+        print(
+            f'{route:<{width}} {histogram.count:>9} '
+            f'{format_seconds(histogram.percentile(50)):>8} '
+            f'{format_seconds(histogram.percentile(95)):>8} '
+            f'{format_seconds(histogram.percentile(99)):>8} {stats.errors[route]:>6}'
+        )
+
+    if stats.upstream.count:
+        print(f'\nUpstream response time p50 {format_seconds(stats.upstream.percentile(50))}'
+              f', p95 {format_seconds(stats.upstream.percentile(95))}'
+              f', p99 {format_seconds(stats.upstream.percentile(99))}')
+
+
+def print_throughput(stats):
+    '''
+    Prints the requests and 5xx responses of each interval.
+    '''
+    print(f'\n{"Interval":<16} {"Requests":>9} {"req/s":>8} {"5xx":>6}')
+    for start in sorted(stats.throughput):
+        requests = stats.throughput[start]
+        print(
+            f'{datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M"):<16} {requests:>9} '
+            f'{requests / stats.interval:>8.2f} {stats.throughput_errors[start]:>6}'
+        )
+
+
+def print_slowest(stats):
+    '''
+    Prints the slowest requests.
+    '''
+    print('\nSlowest requests')
+    for request_time, url, status in sorted(stats.slowest, reverse=True):
+        print(f'{format_seconds(request_time):>8} {status} {url}')
+
+
+class Command(ProfiledCommand):
+    '''
+    Streams the access logs and prints per route latency percentiles, throughput over time
+    and the slowest requests.
+    '''
+
+    help = 'Reports per route latency, throughput and the slowest requests from access logs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*',
+            help=f'Log files, may be gzip compressed, "-" reads stdin. '
+                 f'Defaults to {NGINX_ACCESS_LOG} and its rotated files. '
+                 f'Gunicorn logs to the journal: journalctl -u gunicorn -o cat | ... analyze_logs -'
+        )
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count() or 1,
+            help='Number of files analyzed in parallel.'
+        )
+        parser.add_argument(
+            '--interval', type=int, default=3600, help='Seconds per throughput interval.'
+        )
+        parser.add_argument('--top', type=int, default=10, help='Number of slowest requests.')
+
+    def handle(self, *args, **options):
+        '''
+        Analyzes each file in its own process and merges the results.
+        '''
+        paths = options['paths'] or sorted(glob.glob(f'{NGINX_ACCESS_LOG}*'))
+        if not paths:
+            raise CommandError(f'No log files given and {NGINX_ACCESS_LOG} does not exist.')
+        for path in paths:
+            if path != '-' and not os.path.isfile(path):
+                raise CommandError(f'{path} does not exist.')
+
+        stats = analyze_files(paths, options['processes'], options['interval'], options['top'])
+        if not stats.routes:
+            raise CommandError(
+                'No requests with a request time were found, '
+                'regenerate the configs with "prep_gunicorn" and "prep_nginx".'
+            )
+
+        print_routes(stats)
+        print_throughput(stats)
+        print_slowest(stats)
+
+        print(f'\n✓ - {stats.lines} lines read, {stats.skipped} skipped.')
@@ -0,0 +1,140 @@
+'''
+Measures the latency and throughput of a cache through Django's cache API.
+'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.utils.module_loading import import_string
+
+from django_devops.management.base import ProfiledCommand
+
+KEY_PREFIX = 'django_devops_benchmark'
+REDIS_BACKEND = 'django.core.cache.backends.redis.RedisCache'
+
+
+def create_cache(alias, location=None, serializer=None):
+    '''
+    Creates a new cache backend from settings.CACHES[alias], like django.core.cache.caches,
+    with the location and the serializer (RedisCache only) optionally replaced.
+    '''
+    params = dict(settings.CACHES[alias])
+    backend = params.pop('BACKEND')
+    params_location = params.pop('LOCATION', '')
+    if serializer:
+        params['OPTIONS'] = dict(params.get('OPTIONS', {}), serializer=serializer)
+    return import_string(backend)(location or params_location, params)
+
+
+def payload(size):
+    '''
+    Returns a dict of about size bytes shaped like a typical cached object,
+    so serializers are compared on structured data and not a single string.
+    '''
+    fields = max(1, size // 64)
+    return {
+        'id': 1,
+        'score': 1.5,
+        'active': True,
+        'fields': {f'field_{index}': 'x' * 48 for index in range(fields)},
+    }
+
+
+def percentile(latencies, percent):
+    '''
+    Returns a percentile of a sorted list, 0 for an empty list.
+    '''
+    if not latencies:
+        return 0
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+
+class Command(ProfiledCommand):
+    '''
+    Runs set, get and get_many against the cache and prints their latency and throughput.
+    '''
+
+    help = 'Benchmarks get/set latency and throughput of a cache through the Django cache API.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--alias', default='default', help='Alias in settings.CACHES.')
+        parser.add_argument(
+            '--location', help='Replaces LOCATION, e.g. to compare a unix socket with TCP.'
+        )
+        parser.add_argument(
+            '--serializer',
+            help='Dotted path of a RedisCache serializer class, the default pickles values.'
+        )
+        parser.add_argument('--operations', type=int, default=10000, help='Operations per test.')
+        parser.add_argument('--value-size', type=int, default=1024, help='Bytes per value.')
+        parser.add_argument('--threads', type=int, default=1, help='Concurrent clients.')
+        parser.add_argument('--batch', type=int, default=10, help='Keys per get_many.')
+
+    def run(self, options, operation):
+        '''
+        Runs an operation once per key, split over the threads, each with its own client.
+        Returns (sorted latencies in seconds, elapsed seconds).
+        '''
+        threads = max(1, options['threads'])
+        keys = [f'{KEY_PREFIX}:{index}' for index in range(options['operations'])]
+        slices = [keys[index::threads] for index in range(threads)]
+
+        def client(thread_keys):
+            cache = create_cache(options['alias'], options['location'], options['serializer'])
+            latencies = []
+            for key in thread_keys:
+                start = time.perf_counter()
+                operation(cache, key)
+                latencies.append(time.perf_counter() - start)
+            cache.close()
+            return latencies
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(client, slices))
+        elapsed = time.perf_counter() - start
+
+        return sorted(latency for latencies in results for latency in latencies), elapsed
+
+    def handle(self, *args, **options):
+        '''
+        Benchmarks the cache, then removes the keys it wrote.
+        '''
+        if not options['operations'] >= options['threads'] >= 1:
+            raise CommandError('--threads must be at least 1 and at most --operations.')
+        if options['alias'] not in settings.CACHES:
+            raise CommandError(f'"{options["alias"]}" is not in settings.CACHES.')
+        backend = settings.CACHES[options['alias']]['BACKEND']
+        if options['serializer'] and backend != REDIS_BACKEND:
+            raise CommandError('--serializer is only supported by RedisCache.')
+
+        cache = create_cache(options['alias'], options['location'], options['serializer'])
+        value = payload(options['value_size'])
+        batch = max(1, options['batch'])
+        batch_keys = [f'{KEY_PREFIX}:{index}' for index in range(batch)]
+
+        location = options['location'] or settings.CACHES[options['alias']].get('LOCATION', '')
+        print(f'{backend} at {location}, {options["threads"]} thread(s), '
+              f'serializer: {options["serializer"] or "default"}')
+
+        tests = [
+            ('set', lambda cache, key: cache.set(key, value, 300)),
+            ('get', lambda cache, key: cache.get(key)),
+            ('get_many', lambda cache, key: cache.get_many(batch_keys)),
+        ]
+
+        print(f'{"Operation":<10} {"ops/s":>10} {"p50":>9} {"p95":>9} {"p99":>9}')
+        try:
+            for name, operation in tests:
+                latencies, elapsed = self.run(options, operation)
+                print(
+                    f'{name:<10} {len(latencies) / elapsed:>10.0f} '
+                    f'{percentile(latencies, 50) * 1e6:>7.0f}us '
+                    f'{percentile(latencies, 95) * 1e6:>7.0f}us '
+                    f'{percentile(latencies, 99) * 1e6:>7.0f}us'
+                )
+        finally:
+            cache.delete_many([f'{KEY_PREFIX}:{index}' for index in range(options['operations'])])
+            cache.close()
@@ -7,8 +7,13 @@ import sys
 import pwd
 
 from django.conf import settings
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.logger import span
+from django_devops.utils.requirements import (
+    audit_requirements, fixed_requirements, freeze_lines, installed_distributions
+)
 from django_devops.utils.user_input import query_yes_no
 
 PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
@@ -30,7 +35,16 @@ def in_virtualenv():
     return get_base_prefix_compat() != sys.prefix
 
 
-class Command(BaseCommand):
+def write_requirements(lines):
+    '''
+    Writes the requirements file.
+    '''
+    with open(REQUIREMENTS_FILE, 'w', encoding="UTF-8") as file:
+        file.write('\n'.join(lines) + '\n')
+    print(f'✓ - {REQUIREMENTS_FILE} updated.')
+
+
+class Command(ProfiledCommand):
     '''
     Steps through a user guided review to do the following:
     1) Create file locations used by django_devops
@@ -40,6 +54,44 @@ class Command(BaseCommand):
 
     help = 'Runs through a user guided DevOps review and makes recommendations as needed.'
 
+    def check_requirements(self):
+        '''
+        Ensures that packages have a fixed version number matching what is installed.
+        '''
+        with span('installed_distributions'):
+            installed = installed_distributions()
+
+        if not os.path.exists(REQUIREMENTS_FILE):
+            if query_yes_no(f'{REQUIREMENTS_FILE} does not exist. Create it?'):
+                write_requirements(freeze_lines(installed))
+            else:
+                raise CommandError('Please create the file requirements.txt.')
+        else:
+            print(f'✓ - /opt/{PROJECT_NAME}/requirements.txt exists.')
+
+        with open(REQUIREMENTS_FILE, 'r', encoding="UTF-8") as file:
+            requirements = file.read().splitlines()
+
+        with span('audit_requirements'):
+            audit = audit_requirements(requirements, installed)
+
+        if audit.unpinned:
+            print(f'✗ - These packages are missing fixed versions: {audit.unpinned}')
+        for name, pinned, version in audit.drift:
+            print(f'✗ - {name} is pinned to {pinned} but {version} is installed.')
+        for name, version in audit.unlisted:
+            print(f'✗ - {name}=={version} is installed but not in requirements.txt.')
+        for name in audit.missing:
+            print(f'! - {name} is in requirements.txt but not installed.')
+
+        if audit.unpinned or audit.drift or audit.unlisted:
+            if query_yes_no('Pin requirements.txt to the installed versions?'):
+                write_requirements(fixed_requirements(requirements, installed))
+            else:
+                raise CommandError('Please fix the version numbers of the packages.')
+        else:
+            print('✓ - All packages have a fixed version number matching the installed version.')
+
     def handle(self, *args, **options):
         '''
         1) Confirms project compliance with django_devops
@@ -99,31 +151,7 @@ class Command(BaseCommand):
         # chmod o+r - R
 
         # -------------------------- Python Package Versions ------------------------- #
-        if not os.path.exists(REQUIREMENTS_FILE):
-            if query_yes_no(f'{REQUIREMENTS_FILE} does not exist. Create it?'):
-                os.system(f'pip freeze > /opt/{PROJECT_NAME}/requirements.txt')
-            else:
-                raise CommandError('Please create the file requirements.txt.')
-        else:
-            print(f'✓ - /opt/{PROJECT_NAME}/requirements.txt exists.')
-
-        # Ensures that packages have a fixed version number.
-        with open(f'/opt/{PROJECT_NAME}/requirements.txt', 'r', encoding="UTF-8") as file:
-            requirements = file.readlines()
-
-        packages = []
-        for requirement in requirements:
-            if not '==' in requirement:
-                package_name = requirement.split('> | < | =')[0]
-                packages.append(package_name)
-
-        if packages:
-            if query_yes_no(f'These packages are missing fixed versions: {packages}. Fix them?'):
-                os.system(f'pip freeze > {REQUIREMENTS_FILE}')
-            else:
-                raise CommandError('Please fix the version numbers of the packages.')
-        else:
-            print('✓ - All packages have a fixed version number.')
+        self.check_requirements()
 
         # -------------------------- Verifies GitHub Actions ------------------------- #
         github_workflow_dir = f'{settings.BASE_DIR}/.github/workflows'
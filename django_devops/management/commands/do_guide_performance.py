@@ -0,0 +1,5 @@
+'''
+Makes the performance guide callable with "python manage.py do_guide_performance"
+'''
+
+from django_devops.guides.performance import Command  # pylint: disable=unused-import
@@ -0,0 +1,190 @@
+'''
+Writes .gz and .br files next to the collected static files for nginx's gzip_static.
+'''
+
+import os
+import gzip
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.manifest import load_manifest, save_manifest, stat_signature
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = {
+    '.css', '.js', '.mjs', '.json', '.map', '.svg', '.html', '.htm', '.txt', '.xml',
+    '.ico', '.wasm', '.ttf', '.otf', '.eot',
+}
+# Matches gzip_min_length in the nginx config, smaller files are sent as they are.
+MIN_SIZE = 256
+SUFFIXES = ('.gz', '.br')
+
+
+def compressible_files(root):
+    '''
+    Yields the paths of the files below root worth compressing.
+    '''
+    pending = [root]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif os.path.splitext(entry.name)[1].lower() in COMPRESSIBLE_EXTENSIONS \
+                        and entry.stat().st_size >= MIN_SIZE:
+                    yield entry.path
+
+
+def write_sibling(path, suffix, data, mtime_ns):
+    '''
+    Replaces path + suffix with data in a single step, with the modification time of
+    the original so nginx sends the same Last-Modified for both.
+    Compressed files that are not smaller than the original are removed instead.
+    '''
+    sibling = f'{path}{suffix}'
+    if data is None:
+        if os.path.exists(sibling):
+            os.remove(sibling)
+        return
+
+    tmp_path = f'{sibling}.tmp'
+    with open(tmp_path, 'wb') as sibling_file:
+        sibling_file.write(data)
+    os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+    os.replace(tmp_path, sibling)
+
+
+def compress_file(path, digest, use_brotli):
+    '''
+    Compresses a file unless its content still has the recorded digest.
+    Returns (path, digest, compressed), run in a worker process.
+    '''
+    with open(path, 'rb') as static_file:
+        data = static_file.read()
+    new_digest = hashlib.sha256(data).hexdigest()
+
+    siblings = SUFFIXES if use_brotli else SUFFIXES[:1]
+    if new_digest == digest and all(os.path.exists(f'{path}{suffix}') for suffix in siblings):
+        return path, new_digest, False
+
+    mtime_ns = os.stat(path).st_mtime_ns
+    gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+    write_sibling(path, '.gz', gzipped if len(gzipped) < len(data) else None, mtime_ns)
+    if use_brotli:
+        compressed = brotli.compress(data, quality=11)
+        write_sibling(path, '.br', compressed if len(compressed) < len(data) else None, mtime_ns)
+
+    return path, new_digest, True
+
+
+def changed_files(static_root, manifest, use_brotli):
+    '''
+    Returns the {path: manifest entry} of the files below static_root, and the
+    (path, recorded digest) pairs of the files that have to be compared.
+    Files with the recorded size and modification time are skipped without being read.
+    '''
+    current = {}
+    pending = []
+    for path in compressible_files(static_root):
+        entry = manifest.get(path, {})
+        current[path] = entry
+        if entry.get('source') != stat_signature(path) or entry.get('brotli') != use_brotli:
+            pending.append((path, entry.get('digest')))
+    return current, pending
+
+
+def compress_files(pending, use_brotli, processes):
+    '''
+    Compresses the (path, recorded digest) pairs in parallel.
+    Returns the {path: manifest entry} of the files and how many were compressed.
+    '''
+    entries = {}
+    compressed = 0
+    if not pending:
+        return entries, compressed
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(
+            compress_file,
+            [path for path, _ in pending],
+            [digest for _, digest in pending],
+            [use_brotli] * len(pending),
+            chunksize=max(1, len(pending) // (processes * 4)),
+        )
+        for path, digest, was_compressed in results:
+            compressed += was_compressed
+            entries[path] = {
+                'digest': digest, 'source': stat_signature(path), 'brotli': use_brotli
+            }
+    return entries, compressed
+
+
+def remove_stale(paths):
+    '''
+    Removes the compressed files of static files that no longer exist.
+    Returns how many were removed.
+    '''
+    removed = 0
+    for path in paths:
+        for suffix in SUFFIXES:
+            if os.path.exists(f'{path}{suffix}'):
+                os.remove(f'{path}{suffix}')
+                removed += 1
+    return removed
+
+
+class Command(ProfiledCommand):
+    '''
+    Precompresses STATIC_ROOT after "collectstatic", only files that changed since the
+    last run are compressed again.
+    '''
+
+    help = 'Writes .gz and .br (with the brotli package) files next to the static files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count() or 1,
+            help='Number of files compressed in parallel.'
+        )
+        parser.add_argument(
+            '--force', action='store_true', help='Compress every file, even if it did not change.'
+        )
+        parser.add_argument('--no-brotli', action='store_true', help='Only write .gz files.')
+
+    def handle(self, *args, **options):
+        '''
+        Compares each file with the manifest of the last run and compresses the changed ones.
+        '''
+        static_root = getattr(settings, 'STATIC_ROOT', None)
+        if not static_root or not os.path.isdir(static_root):
+            raise CommandError(
+                'STATIC_ROOT is not set or does not exist, run "collectstatic" first.'
+            )
+
+        static_root = os.path.normpath(str(static_root))
+        # Kept next to STATIC_ROOT so nginx does not serve it.
+        manifest_path = f'{static_root}.precompress.json'
+        manifest = {} if options['force'] else load_manifest(manifest_path)
+
+        use_brotli = brotli is not None and not options['no_brotli']
+        if brotli is None and not options['no_brotli']:
+            print('✗ - brotli is not installed, only .gz files are written.')
+
+        current, pending = changed_files(static_root, manifest, use_brotli)
+        entries, compressed = compress_files(pending, use_brotli, max(1, options['processes']))
+        current.update(entries)
+        removed = remove_stale(set(manifest) - set(current))
+
+        try:
+            save_manifest(current, manifest_path)
+        except OSError as err:
+            raise CommandError(f'Unable to save {manifest_path}: {err}') from err
+        print(f'✓ - {compressed} compressed, {len(current) - compressed} unchanged, '
+              f'{removed} stale files removed.')
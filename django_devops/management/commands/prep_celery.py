@@ -3,32 +3,218 @@ A programmatic way to prepare and configure celery.
 '''
 
 import os
-from textwrap import dedent
+import re
+import argparse
+from importlib.util import find_spec
 from os.path import exists
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 
 from django.conf import settings
 
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.files import generate_file
 from django_devops.utils.user_input import query_yes_no
+from django_devops.utils.host import available_memory, describe_host, effective_cpus
+from django_devops.utils.resources import PROFILES, resource_block, resource_directives
 
 PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
 
 
-def generate_file(file_path, file_template):
+def tune_celery(cpus, memory, workload='cpu', pool='auto', task_memory_mb=200):
     '''
-    Generates a file from a template.
+    Picks the pool and worker options for a host with the given CPU count
+    and available memory in bytes.
+    CPU-bound work uses one prefork child per CPU, I/O-bound work uses many threads or greenlets.
+    Prefork children are capped by the memory available for them.
     '''
-    if exists(file_path):
-        if query_yes_no(f'{file_path} exists. Overwrite?'):
-            pass
+    if pool == 'auto':
+        if workload == 'cpu':
+            pool = 'prefork'
         else:
-            raise CommandError(f'{file_path} will not be overwritten.')
+            pool = 'gevent' if find_spec('gevent') else 'threads'
+
+    if pool == 'prefork':
+        concurrency = cpus if workload == 'cpu' else cpus * 4
+        if memory:
+            concurrency = min(concurrency, max(1, int(memory * 0.75 // (task_memory_mb * 2 ** 20))))
+    elif pool == 'threads':
+        concurrency = cpus if workload == 'cpu' else cpus * 8
+    else:
+        concurrency = 100 * cpus
+
+    tuning = {
+        'pool': pool,
+        'concurrency': concurrency,
+        # Long CPU-bound tasks should not be reserved by a busy worker while others are idle.
+        'prefetch_multiplier': 1 if workload == 'cpu' else 4,
+        'max_tasks_per_child': None,
+        'max_memory_per_child': None,
+    }
+
+    # Recycling children to bound memory growth only applies to the prefork pool.
+    if pool == 'prefork':
+        tuning['max_tasks_per_child'] = 1000
+        tuning['max_memory_per_child'] = task_memory_mb * 2 * 1024  # KiB
+
+    return tuning
+
+
+def route_queues(routes):
+    '''
+    Returns the queue names CELERY_TASK_ROUTES sends tasks to.
+    Routes may be a dict, a list of dicts or a list of (pattern, route) pairs,
+    router functions are skipped since they only decide at runtime.
+    '''
+    if isinstance(routes, dict):
+        routes = [routes]
+
+    queues = []
+    for router in routes or []:
+        if isinstance(router, dict):
+            entries = router.values()
+        elif isinstance(router, (list, tuple)):
+            entries = [pair[1] for pair in router if isinstance(pair, (list, tuple))]
+        else:
+            continue
+
+        for route in entries:
+            if isinstance(route, dict):
+                route = route.get('queue')
+            queues.append(getattr(route, 'name', route))
+    return [queue for queue in queues if isinstance(queue, str)]
+
+
+def celery_queues():
+    '''
+    Returns the queues used by the project, starting with the default queue.
+    '''
+    queues = [getattr(settings, 'CELERY_TASK_DEFAULT_QUEUE', 'celery')]
+    for queue in getattr(settings, 'CELERY_TASK_QUEUES', None) or []:
+        queues.append(getattr(queue, 'name', queue))
+    queues.extend(route_queues(getattr(settings, 'CELERY_TASK_ROUTES', None)))
+    return list(dict.fromkeys(queue for queue in queues if queue))
+
+
+def node_layout(queues, default_queue, groups):
+    '''
+    Returns {node name: [queues]}, one node per queue unless queues are grouped.
+    The default queue is served by the "worker" node.
+    '''
+    layout = dict(groups)
+    grouped = {queue for group_queues in layout.values() for queue in group_queues}
+
+    for queue in queues:
+        if queue not in grouped:
+            node = 'worker' if queue == default_queue else re.sub(r'[^\w-]', '_', queue)
+            layout.setdefault(node, []).append(queue)
+    return layout
+
+
+def key_value(text):
+    '''
+    Parses a NAME=VALUE command line argument.
+    '''
+    name, equals, value = text.partition('=')
+    if not equals or not name or not value:
+        raise argparse.ArgumentTypeError(f'expected NAME=VALUE, got "{text}"')
+    return name, value
+
+
+def node_concurrency(tuning, layout, overrides):
+    '''
+    Returns the concurrency of one node of the layout, overrides are its node_settings.
+    Prefork nodes share the CPUs and memory, thread and greenlet pools do not need to.
+    '''
+    concurrency = tuning['concurrency']
+    if tuning['pool'] == 'prefork':
+        concurrency = max(1, concurrency // len(layout))
+    return int(overrides.get('concurrency', concurrency))
+
+
+def celery_options(tuning, time_limit, layout, node_settings, autoscale=False):
+    '''
+    Returns the CELERYD_OPTS value for the given tuning and node layout.
+    Per node options use celery multi's "-Q:node" syntax.
+    node_settings maps a node name to its "concurrency" and "pool" overrides.
+    '''
+    options = [f'--time-limit={time_limit}', f'--pool={tuning["pool"]}']
+    options.append(f'--prefetch-multiplier={tuning["prefetch_multiplier"]}')
+
+    if tuning['max_tasks_per_child']:
+        options.append(f'--max-tasks-per-child={tuning["max_tasks_per_child"]}')
+    if tuning['max_memory_per_child']:
+        options.append(f'--max-memory-per-child={tuning["max_memory_per_child"]}')
+
+    for node, queues in layout.items():
+        overrides = node_settings.get(node, {})
+        options.append(f'-Q:{node} {",".join(queues)}')
+
+        concurrency = node_concurrency(tuning, layout, overrides)
+        if autoscale:
+            options.append(f'--autoscale:{node}={concurrency},{max(1, concurrency // 4)}')
+        else:
+            options.append(f'-c:{node} {concurrency}')
+
+        if 'pool' in overrides:
+            options.append(f'-P:{node} {overrides["pool"]}')
+
+    return ' '.join(options)
+
+
+def node_footprint(tuning, layout, node_settings, task_memory_mb):
+    '''
+    Returns the (memory in MB, processes and threads) of the largest node.
+    Prefork children and threads each run a task, greenlets share the process.
+    '''
+    memory_mb, tasks = 0, 0
+    for node in layout:
+        concurrency = node_concurrency(tuning, layout, node_settings.get(node, {}))
+        pool = node_settings.get(node, {}).get('pool', tuning['pool'])
+        if pool == 'prefork':
+            memory_mb = max(memory_mb, 150 + concurrency * task_memory_mb)
+        else:
+            memory_mb = max(memory_mb, 150 + 2 * task_memory_mb)
+        tasks = max(tasks, (16 if pool == 'gevent' else concurrency) + 16)
+    return memory_mb, tasks
+
+
+def detect_settings(options):
+    '''
+    Returns the pool and worker options for this host with the command's overrides applied.
+    '''
+    tuning = tune_celery(
+        effective_cpus(), available_memory(),
+        options['workload'], options['pool'], options['task_memory']
+    )
+
+    overrides = (
+        'concurrency', 'prefetch_multiplier', 'max_tasks_per_child', 'max_memory_per_child'
+    )
+    for setting in overrides:
+        if options[setting] is not None:
+            tuning[setting] = options[setting]
+
+    if options['autoscale'] and tuning['pool'] != 'prefork':
+        raise CommandError('--autoscale is only supported by the prefork pool.')
+    return tuning
+
 
-    with open(file_path, 'w+', encoding='UTF-8') as file:
-        file.seek(0)
-        file.write(dedent(file_template))
-        file.truncate()
+def detect_layout(options):
+    '''
+    Returns the node layout of the project's queues, and the per node overrides.
+    '''
+    default_queue = getattr(settings, 'CELERY_TASK_DEFAULT_QUEUE', 'celery')
+    groups = [(node, queues.split(',')) for node, queues in options['queue_group']]
+    layout = node_layout(celery_queues(), default_queue, groups)
+
+    node_settings = {}
+    for setting in ('concurrency', 'pool'):
+        for node, value in options[f'node_{setting}']:
+            if node not in layout:
+                raise CommandError(f'Unknown node "{node}", nodes are: {", ".join(layout)}')
+            node_settings.setdefault(node, {})[setting] = value
+    return layout, node_settings
 
 
 def create_and_set_permissions(directory, owner, group):
@@ -40,13 +226,79 @@ def create_and_set_permissions(directory, owner, group):
         os.system(f'chown -R {owner}:{group} {directory}')
 
 
-class Command(BaseCommand):
+class Command(ProfiledCommand):
     '''
     Programmatically generates the service file for celery.
     '''
 
     help = 'PProgrammatically generates the service file for celery.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workload', choices=['cpu', 'io'], default='cpu',
+            help='Whether the tasks are mostly CPU-bound or I/O-bound (default: cpu).'
+        )
+        parser.add_argument(
+            '--pool', choices=['auto', 'prefork', 'threads', 'gevent'], default='auto',
+            help='Worker pool, "auto" picks prefork for CPU-bound and gevent/threads for I/O work.'
+        )
+        parser.add_argument('--concurrency', type=int, help='Number of child processes or threads.')
+        parser.add_argument(
+            '--autoscale', action='store_true',
+            help='Scale the pool between a quarter of the concurrency and the full concurrency.'
+        )
+        parser.add_argument(
+            '--prefetch-multiplier', type=int, help='Messages reserved per pool slot.'
+        )
+        parser.add_argument(
+            '--max-tasks-per-child', type=int,
+            help='Tasks a prefork child runs before it is replaced.'
+        )
+        parser.add_argument(
+            '--max-memory-per-child', type=int,
+            help='Resident memory in KiB after which a prefork child is replaced.'
+        )
+        parser.add_argument(
+            '--task-memory', type=int, default=200,
+            help='Expected memory use of a prefork child in MB (default: 200).'
+        )
+        parser.add_argument(
+            '--time-limit', type=int, default=300, help='Hard time limit of a task in seconds.'
+        )
+        parser.add_argument(
+            '--queue-group', type=key_value, action='append', default=[], metavar='NODE=QUEUES',
+            help='Serve several queues from a single node, e.g. bulk=mail,reports.'
+        )
+        parser.add_argument(
+            '--node-concurrency', type=key_value, action='append', default=[], metavar='NODE=N',
+            help='Concurrency of a single node.'
+        )
+        parser.add_argument(
+            '--node-pool', type=key_value, action='append', default=[], metavar='NODE=POOL',
+            help='Pool of a single node, e.g. io=gevent.'
+        )
+        parser.add_argument(
+            '--no-beat', action='store_true', help='Do not generate celerybeat.service.'
+        )
+        parser.add_argument(
+            '--resources', choices=PROFILES, default='shared',
+            help='systemd resource controls: "shared" gives celery a smaller share than gunicorn, '
+                 '"isolated" also keeps it on its own CPUs (default: shared).'
+        )
+
+    def remove_legacy_service(self, service_files_path):
+        '''
+        The single celery.service unit is replaced by one instance per node.
+        '''
+        legacy_service = f'{service_files_path}/celery.service'
+        if exists(legacy_service) and \
+                query_yes_no(f'{legacy_service} is replaced by celery@.service. Remove it?'):
+            os.remove(legacy_service)
+            self.stdout.write(
+                'update_services stops, disables and removes celery.service '
+                'on the hosts where it was deployed.'
+            )
+
     def handle(self, *args, **options):
         '''
         Verifies that the service folder exists for use with django_devops
@@ -60,10 +312,26 @@ class Command(BaseCommand):
                 First run "python manage.py devops" to configure django_devops.
             ''')
 
-        # Generate celery.service file.
+        # ------------------------------ Detect Settings ----------------------------- #
+        tuning = detect_settings(options)
+        layout, node_settings = detect_layout(options)
+
+        celeryd_opts = celery_options(
+            tuning, options['time_limit'], layout, node_settings, options['autoscale']
+        )
+
+        # Every node gets the limits of the largest one, they share the template unit.
+        resources = resource_block(resource_directives(
+            options['resources'], 'worker',
+            *node_footprint(tuning, layout, node_settings, options['task_memory'])
+        ), ' ' * 12)
+
+        # Generate celery@.service file.
+        # Each node runs as its own instance (celery@<node>.service) so it can be
+        # restarted on its own, "celery multi" applies the options namespaced to %i.
         celery_service_template = f'''
             [Unit]
-            Description = Celery Service
+            Description = Celery node %i
             After = network.target
 
             [Service]
@@ -74,28 +342,35 @@ class Command(BaseCommand):
             EnvironmentFile = /etc/conf.d/celery
 
             WorkingDirectory = /opt/{PROJECT_NAME}
+            PIDFile = /var/run/celery/%i.pid
 
-            ExecStart   =   /bin/sh -c '/opt/{PROJECT_NAME}/.venv/bin/celery multi start ${{CELERYD_NODES}} \
+            ExecStart   =   /bin/sh -c '${{CELERY_BIN}} multi start %i \
                             -A ${{CELERY_APP}} --pidfile=${{CELERYD_PID_FILE}} \
                             --logfile=${{CELERYD_LOG_FILE}} --loglevel=${{CELERYD_LOG_LEVEL}} $CELERYD_OPTS'
 
-            ExecStop    =   /bin/sh -c '/opt/{PROJECT_NAME}/.venv/bin/celery ${{CELERY_BIN}} multi stopwait ${{CELERYD_NODES}} \
+            # stopwait and restart send TERM (warm shutdown), letting running tasks finish.
+            ExecStop    =   /bin/sh -c '${{CELERY_BIN}} multi stopwait %i \
                             --pidfile=${{CELERYD_PID_FILE}}'
 
-            ExecReload  =   /bin/sh -c '/opt/{PROJECT_NAME}/.venv/bin/celery ${{CELERY_BIN}} multi restart ${{CELERYD_NODES}} \
+            ExecReload  =   /bin/sh -c '${{CELERY_BIN}} multi restart %i \
                             -A ${{CELERY_APP}} --pidfile=${{CELERYD_PID_FILE}} \
                             --logfile=${{CELERYD_LOG_FILE}} --loglevel=${{CELERYD_LOG_LEVEL}} $CELERYD_OPTS'
 
-            Restart=always
+            # Matches --time-limit so the warm shutdown is not cut short.
+            TimeoutStopSec = {options['time_limit']}
+
+            Restart=always{resources}
 
             [Install]
             WantedBy = multi-user.target
         '''
 
-        # Generate celery.service file.
+        # Generate celery config file.
         celery_config_template = f'''
-            # Name of nodes to start.
-            CELERYD_NODES="worker"
+            # Generated by "python manage.py prep_celery" for a host with {describe_host()}.
+
+            # Name of nodes to start, update_services runs one celery@<node>.service per node.
+            CELERYD_NODES="{' '.join(layout)}"
 
             CELERY_BIN="/opt/{PROJECT_NAME}/.venv/bin/celery"
 
@@ -103,7 +378,8 @@ class Command(BaseCommand):
 
             CELERYD_CHDIR="/opt/{PROJECT_NAME}/"
 
-            CELERYD_OPTS="--time-limit=300 --concurrency=8"
+            # Options namespaced with ":<node>" only apply to that node.
+            CELERYD_OPTS="{celeryd_opts}"
 
             CELERYD_LOG_FILE="/var/log/celery/%n%I.log"
             CELERYD_PID_FILE="/var/run/celery/%n.pid"
@@ -118,14 +394,56 @@ class Command(BaseCommand):
             # If enabled PID and log directories will be created if missing,
             # and owned by the userid/group configured.
             CELERY_CREATE_DIRS=1
+        '''
+
+        # Generate celerybeat.service file.
+        # Beat has its own config file so that node changes do not restart it.
+        beat_resources = resource_block(resource_directives(
+            options['resources'], 'worker', 256, 32
+        ), ' ' * 12)
+        celerybeat_service_template = f'''
+            [Unit]
+            Description = Celery Beat Service
+            After = network.target
+
+            [Service]
+            Type = simple
+            User = {PROJECT_NAME}
+            Group = {PROJECT_NAME}
 
+            EnvironmentFile = /etc/conf.d/celerybeat
+
+            WorkingDirectory = /opt/{PROJECT_NAME}
+
+            ExecStart   =   /bin/sh -c '${{CELERY_BIN}} -A ${{CELERY_APP}} beat \
+                            --pidfile=${{CELERYBEAT_PID_FILE}} \
+                            --logfile=${{CELERYBEAT_LOG_FILE}} --loglevel=${{CELERYBEAT_LOG_LEVEL}}'
+
+            Restart=always{beat_resources}
+
+            [Install]
+            WantedBy = multi-user.target
+        '''
+
+        # Generate celerybeat config file.
+        celerybeat_config_template = f'''
+            CELERY_BIN="/opt/{PROJECT_NAME}/.venv/bin/celery"
+
+            CELERY_APP="{PROJECT_NAME}"
 
             CELERYBEAT_PID_FILE="/var/run/celery/beat.pid"
             CELERYBEAT_LOG_FILE="/var/log/celery/beat.log"
+            CELERYBEAT_LOG_LEVEL="INFO"
         '''
 
-        generate_file(f'{service_files_path}/celery.service', celery_service_template)
+        self.remove_legacy_service(service_files_path)
+
+        generate_file(f'{service_files_path}/celery@.service', celery_service_template)
         generate_file(f'{config_files_path}/celery', celery_config_template)
 
+        if not options['no_beat']:
+            generate_file(f'{service_files_path}/celerybeat.service', celerybeat_service_template)
+            generate_file(f'{config_files_path}/celerybeat', celerybeat_config_template)
+
         create_and_set_permissions('/var/run/celery/', PROJECT_NAME, PROJECT_NAME)
         create_and_set_permissions('/var/log/celery/', PROJECT_NAME, PROJECT_NAME)
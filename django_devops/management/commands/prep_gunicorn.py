@@ -3,66 +3,278 @@ A programmatic way to prepare a gunicorn config file.
 '''
 
 import os
-from textwrap import dedent
+import math
+from importlib.util import find_spec
 from os.path import exists
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 
 from django.conf import settings
 
-from django_devops.utils.user_input import query_yes_no
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.files import generate_file
+from django_devops.utils.host import available_memory, describe_host, effective_cpus
+from django_devops.utils.resources import PROFILES, resource_block, resource_directives
 
 PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
 
+# Where update_services deploys the generated config file.
+GUNICORN_CONFIG = '/etc/conf.d/gunicorn.conf.py'
+SOCKET_PATH = f'/opt/{PROJECT_NAME}/{PROJECT_NAME}.sock'
 
-class Command(BaseCommand):
+# Options that override the auto-detected value of a gunicorn setting.
+OVERRIDES = [
+    ('workers', 'workers'),
+    ('threads', 'threads'),
+    ('worker_class', 'worker_class'),
+    ('max_requests', 'max_requests'),
+    ('max_requests_jitter', 'max_requests_jitter'),
+    ('backlog', 'backlog'),
+    ('keepalive', 'keep_alive'),
+    ('timeout', 'timeout'),
+    ('preload_app', 'preload'),
+]
+
+
+def uvicorn_worker_class():
+    '''
+    Returns the import path of the installed uvicorn worker class, or None if uvicorn is missing.
+    '''
+    if find_spec('uvicorn_worker'):
+        return 'uvicorn_worker.UvicornWorker'
+    if find_spec('uvicorn'):
+        return 'uvicorn.workers.UvicornWorker'
+    return None
+
+
+def asgi_application():
+    '''
+    Returns settings.ASGI_APPLICATION as a gunicorn "module:attribute" path, or None if unset.
+    '''
+    application = getattr(settings, 'ASGI_APPLICATION', None)
+    if not application:
+        return None
+    module, _, attribute = application.rpartition('.')
+    return f'{module}:{attribute}'
+
+
+def tune_gunicorn(cpus, memory, worker_memory_mb, asgi=False):
+    '''
+    Picks the gunicorn settings for a host with the given CPU count and available memory in bytes.
+    Workers follow the (2 x CPUs) + 1 rule unless memory cannot hold that many,
+    in which case threads make up for the missing processes.
+    '''
+    cpu_workers = 2 * cpus + 1
+    if memory:
+        memory_workers = max(1, int(memory * 0.75 // (worker_memory_mb * 2 ** 20)))
+    else:
+        memory_workers = cpu_workers
+
+    if asgi:
+        worker_class, workers, threads = 'uvicorn', min(cpus, memory_workers), 1
+    elif memory_workers < cpu_workers:
+        threads = min(8, math.ceil(cpu_workers / memory_workers))
+        worker_class, workers = 'gthread', memory_workers
+    else:
+        worker_class, workers, threads = 'sync', cpu_workers, 1
+
+    max_requests = 1000
+    return {
+        'worker_class': worker_class,
+        'workers': workers,
+        'threads': threads,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+        'backlog': 2048,
+        # Sync workers do not support keep-alive. The others outlive nginx's upstream
+        # keepalive_timeout (60s) so idle connections are always closed by nginx first.
+        'keepalive': 5 if worker_class == 'sync' else 75,
+        'timeout': 120,
+        # Opt-in with --preload: a HUP does not load new code into a preloaded application.
+        'preload_app': False,
+    }
+
+
+def detect_settings(options):
+    '''
+    Returns the gunicorn settings for this host with the command's overrides applied,
+    and the application gunicorn loads.
+    '''
+    asgi_app = asgi_application()
+    uvicorn_worker = uvicorn_worker_class()
+
+    tuning = tune_gunicorn(
+        effective_cpus(), available_memory(), options['worker_memory'],
+        asgi=bool(asgi_app and uvicorn_worker)
+    )
+
+    for setting, option in OVERRIDES:
+        if options[option] is not None:
+            tuning[setting] = options[option]
+
+    if tuning['worker_class'] != 'uvicorn':
+        return tuning, f'{PROJECT_NAME}.wsgi:application'
+    if not uvicorn_worker:
+        raise CommandError('The uvicorn worker class requires uvicorn to be installed.')
+    tuning['worker_class'] = uvicorn_worker
+    return tuning, asgi_app or f'{PROJECT_NAME}.asgi:application'
+
+
+class Command(ProfiledCommand):
     '''
     Programaticly generates a gunicorn config file.
     '''
 
     help = 'Prepare a gunicorn config file.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Number of worker processes.')
+        parser.add_argument('--threads', type=int, help='Number of threads per worker.')
+        parser.add_argument(
+            '--worker-class', choices=['sync', 'gthread', 'uvicorn'], help='Gunicorn worker class.'
+        )
+        parser.add_argument(
+            '--max-requests', type=int, help='Requests a worker serves before it is recycled.'
+        )
+        parser.add_argument(
+            '--max-requests-jitter', type=int, help='Random jitter added to --max-requests.'
+        )
+        parser.add_argument('--backlog', type=int, help='Maximum number of pending connections.')
+        parser.add_argument(
+            '--keep-alive', type=int,
+            help='Seconds to wait for requests on a keep-alive connection.'
+        )
+        parser.add_argument(
+            '--timeout', type=int, help='Seconds before a silent worker is killed.'
+        )
+        parser.add_argument(
+            '--preload', action='store_true', default=None,
+            help='Load the application before forking workers, to share its memory. '
+                 'Deploys then have to restart gunicorn instead of reloading it.'
+        )
+        parser.add_argument(
+            '--worker-memory', type=int, default=150,
+            help='Expected memory use of one worker in MB, used to size workers (default: 150).'
+        )
+        parser.add_argument(
+            '--lazy', action='store_true',
+            help='Only start gunicorn when the first request reaches gunicorn.socket.'
+        )
+        parser.add_argument(
+            '--resources', choices=PROFILES, default='shared',
+            help='systemd resource controls: "shared" favours gunicorn over celery, "isolated" '
+                 'also gives it its own CPUs (default: shared).'
+        )
+
     def handle(self, *args, **options):
         '''
         Verifies that the service folder exists for use with django_devops
         '''
-        if not exists(f'{settings.BASE_DIR}/{PROJECT_NAME}/service_files'):
-            raise CommandError(f'''
-                        {settings.BASE_DIR}/{PROJECT_NAME}/service_files does not exist.
-                        First run "python manage.py devops" to configure django_devops.
-                    ''')
-
-        # Check if the file exsists and confirm overwrite.
-        if exists(f'{settings.BASE_DIR}/{PROJECT_NAME}/service_files/gunicorn.service'):
-            if query_yes_no(f'{PROJECT_NAME}/service_files/gunicorn.service exists. Overwrite?'):
-                pass
-            else:
+        service_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/service_files'
+        config_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/config_files'
+
+        for folder_path in (service_files_path, config_files_path):
+            if not exists(folder_path):
                 raise CommandError(f'''
-                            {PROJECT_NAME}/service_files/gunicorn.service will not be overwritten.
+                            {folder_path} does not exist.
+                            First run "python manage.py devops" to configure django_devops.
                         ''')
 
+        # ------------------------------ Detect Settings ----------------------------- #
+        tuning, wsgi_app = detect_settings(options)
+
+        # Generate gunicorn.conf.py file.
+        config_template = f'''
+            # Generated by "python manage.py prep_gunicorn" for a host with {describe_host()}.
+            # Run the command again on each host, or use its options to override these values.
+
+            wsgi_app = {wsgi_app!r}
+            chdir = '/opt/{PROJECT_NAME}/'
+
+            # Only used when gunicorn is started without gunicorn.socket,
+            # otherwise the listening socket is inherited from systemd.
+            bind = 'unix:{SOCKET_PATH}'
+            backlog = {tuning['backlog']}
+
+            worker_class = {tuning['worker_class']!r}
+            workers = {tuning['workers']}
+            threads = {tuning['threads']}
+            timeout = {tuning['timeout']}
+            graceful_timeout = 30
+            keepalive = {tuning['keepalive']}
+
+            # Recycle workers to bound memory growth, with jitter so they do not restart together.
+            max_requests = {tuning['max_requests']}
+            max_requests_jitter = {tuning['max_requests_jitter']}
+
+            # A preloaded application is not reloaded by "systemctl reload gunicorn",
+            # code changes then require "systemctl restart gunicorn".
+            preload_app = {tuning['preload_app']!r}
+
+            accesslog = '-'
+            # The combined format with the request time, read by "python manage.py analyze_logs".
+            access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" rt=%(L)s'
+        '''
+
+        # Generate gunicorn.socket file.
+        # systemd owns the listening socket, so connections queue in the kernel
+        # while gunicorn restarts instead of nginx returning 502.
+        socket_template = f'''
+            [Unit]
+            Description = gunicorn socket for {PROJECT_NAME}
+
+            [Socket]
+            ListenStream = {SOCKET_PATH}
+            Backlog = {tuning['backlog']}
+            SocketUser = {PROJECT_NAME}
+            SocketGroup = www-data
+            SocketMode = 0660
+
+            [Install]
+            WantedBy = sockets.target
+        '''
+
+        # The master and the workers, each with its threads and a few of gunicorn's own.
+        resources = resource_block(resource_directives(
+            options['resources'], 'web',
+            memory_mb=(tuning['workers'] + 1) * options['worker_memory'],
+            tasks=tuning['workers'] * (tuning['threads'] + 4) + 8,
+        ), ' ' * 12)
+
+        # Without an [Install] section the service is only started by its socket.
+        install_section = '' if options['lazy'] else '''
+            [Install]
+            WantedBy = multi-user.target'''
+
         # Generate gunicorn.service file.
-        file_template = f'''[Unit]
-                            Description = gunicorn daemon for {PROJECT_NAME}
-                            After = network.target
+        service_template = f'''
+            [Unit]
+            Description = gunicorn daemon for {PROJECT_NAME}
+            Requires = gunicorn.socket
+            After = network.target gunicorn.socket
 
-                            [Service]
-                            User = {PROJECT_NAME}
-                            Group = {PROJECT_NAME}
-                            WorkingDirectory = /opt/{PROJECT_NAME}/
+            [Service]
+            Type = notify
+            NotifyAccess = main
+            User = {PROJECT_NAME}
+            Group = {PROJECT_NAME}
+            WorkingDirectory = /opt/{PROJECT_NAME}/
 
-                            ExecStart   =   /opt/{PROJECT_NAME}/.venv/bin/gunicorn --access-logfile - --workers 5 --timeout 120 --bind unix:/opt/{PROJECT_NAME}/{PROJECT_NAME}.sock {PROJECT_NAME}.wsgi:application --reload
+            # Shared by the workers for django_devops.metrics, emptied when gunicorn stops.
+            RuntimeDirectory = {PROJECT_NAME}/metrics
+            Environment = DJANGO_DEVOPS_METRICS_DIR=/run/{PROJECT_NAME}/metrics
 
-                            ExecReload  =   /opt/{PROJECT_NAME}/.venv/bin/gunicorn --access-logfile - --workers 5 --timeout 120 --bind unix:/opt/{PROJECT_NAME}/{PROJECT_NAME}.sock {PROJECT_NAME}.wsgi:application --reload
+            ExecStart   =   /opt/{PROJECT_NAME}/.venv/bin/gunicorn --config {GUNICORN_CONFIG}
 
-                            Restart = always
+            # Graceful reload: new workers are started before the old ones exit.
+            ExecReload  =   /bin/kill -s HUP $MAINPID
+            KillMode = mixed
+            TimeoutStopSec = 30
 
-                            [Install]
-                            WantedBy = multi-user.target
-                        '''
+            Restart = always{resources}
+            {install_section}
+        '''
 
-        file_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/service_files'
-        with open(f'{file_path}/gunicorn.service', 'w+', encoding='UTF-8') as file:
-            file.seek(0)
-            file.write(dedent(file_template))
-            file.truncate()
+        generate_file(f'{config_files_path}/gunicorn.conf.py', config_template)
+        generate_file(f'{service_files_path}/gunicorn.socket', socket_template)
+        generate_file(f'{service_files_path}/gunicorn.service', service_template)
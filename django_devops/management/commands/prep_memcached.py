@@ -0,0 +1,125 @@
+'''
+A programmatic way to prepare a Memcached instance for the cache.
+'''
+
+import os
+from os.path import exists
+
+from django.core.management.base import CommandError
+
+from django.conf import settings
+
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.files import generate_file
+from django_devops.utils.host import available_memory, describe_host, effective_cpus
+
+PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
+
+SERVICE_NAME = f'{PROJECT_NAME}-memcached'
+SOCKET_PATH = f'/run/{SERVICE_NAME}/memcached.sock'
+
+
+def tune_memcached(cpus, memory):
+    '''
+    Picks the Memcached settings for a host with the given CPU count and available memory
+    in bytes. Memcached evicts the least recently used items and never writes to disk.
+    '''
+    return {
+        'memory_mb': max(64, int((memory or 2 ** 30) * 0.25 // 2 ** 20)),
+        'threads': max(1, min(4, cpus)),
+        'max_connections': 4096,
+    }
+
+
+class Command(ProfiledCommand):
+    '''
+    Programmatically create the Memcached config and service files.
+    '''
+
+    help = 'Prepare a Memcached config and unit for the cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--memory', type=int, help='Memory limit in MB.')
+        parser.add_argument('--threads', type=int, help='Number of worker threads.')
+        parser.add_argument(
+            '--port', type=int, default=0,
+            help='Listen on 127.0.0.1:PORT instead of the unix socket, e.g. to benchmark TCP.'
+        )
+
+    def handle(self, *args, **options):
+        '''
+        Verifies that the service folder exists for use with django_devops
+        '''
+        service_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/service_files'
+        config_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/config_files'
+
+        for folder_path in (service_files_path, config_files_path):
+            if not exists(folder_path):
+                raise CommandError(f'''
+                    {folder_path} does not exist.
+                    First run "python manage.py devops" to configure django_devops.
+                ''')
+
+        tuning = tune_memcached(effective_cpus(), available_memory())
+        for setting, option in (('memory_mb', 'memory'), ('threads', 'threads')):
+            if options[option] is not None:
+                tuning[setting] = options[option]
+
+        # Memcached listens on either the unix socket or TCP, UDP is always disabled.
+        if options['port']:
+            listen = f'-l 127.0.0.1 -p {options["port"]}'
+            location = f'127.0.0.1:{options["port"]}'
+        else:
+            listen = f'-s {SOCKET_PATH} -a 0770'
+            location = f'unix:{SOCKET_PATH}'
+
+        memcached_opts = (
+            f"-m {tuning['memory_mb']} -t {tuning['threads']} "
+            f"-c {tuning['max_connections']} -U 0 {listen}"
+        )
+
+        # Generate the memcached config file.
+        config_template = f'''
+            # Generated by "python manage.py prep_memcached" for a host with {describe_host()}.
+
+            MEMCACHED_OPTS="{memcached_opts}"
+        '''
+
+        # Generate the memcached service file.
+        # The group is the project's, so Django can use the socket.
+        service_template = f'''
+            [Unit]
+            Description = Memcached for {PROJECT_NAME}
+            After = network.target
+
+            [Service]
+            Type = simple
+            User = memcache
+            Group = {PROJECT_NAME}
+
+            RuntimeDirectory = {SERVICE_NAME}
+            RuntimeDirectoryMode = 0750
+            EnvironmentFile = /etc/conf.d/memcached
+
+            ExecStart = /usr/bin/memcached $MEMCACHED_OPTS
+            LimitNOFILE = {tuning['max_connections'] + 1024}
+            Restart = always
+
+            [Install]
+            WantedBy = multi-user.target
+        '''
+
+        generate_file(f'{config_files_path}/memcached', config_template)
+        generate_file(f'{service_files_path}/{SERVICE_NAME}.service', service_template)
+
+        print(f'✓ - Memcached with {tuning["memory_mb"]} MB, listening on {location}.')
+
+        # ------------------------------ Recommendations ----------------------------- #
+        print(f'''
+    CACHES = {{
+        'default': {{
+            'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+            'LOCATION': '{location}',
+        }},
+    }}''')
+        print('\nMemcached can not be a celery broker, use "prep_redis --purpose broker".')
@@ -3,24 +3,53 @@ A programatic way to prepare the nginx config file.
 '''
 
 import os
-from textwrap import dedent
+import re
 from os.path import exists
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 
 from django.conf import settings
 
-from django_devops.utils.user_input import query_yes_no
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.files import generate_file
 
 PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
 
-class Command(BaseCommand):
+# Upstream, map and cache zone names are shared by every site, so they are prefixed.
+NGINX_PREFIX = re.sub(r'\W', '_', PROJECT_NAME)
+
+
+def url_location(url):
+    '''
+    Returns the nginx location for a STATIC_URL/MEDIA_URL value,
+    or None if the files are served from another host.
+    '''
+    if not url or '://' in url or url.startswith('//'):
+        return None
+    return '/' + url.strip('/') + '/'
+
+
+def server_names():
+    '''
+    Returns the nginx server_name value for settings.ALLOWED_HOSTS.
+    '''
+    hosts = [host for host in getattr(settings, 'ALLOWED_HOSTS', []) if host and host != '*']
+    return ' '.join(hosts) or '_'
+
+
+class Command(ProfiledCommand):
     '''
     Programmatically create the sites-available file.
     '''
 
     help = 'Prepare the nginx config file.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--microcache', type=int, metavar='TTL',
+            help='Cache anonymous GET responses from Django for TTL seconds (e.g. 1).'
+        )
+
     def handle(self, *args, **options):
         '''
         Verifies that the service folder exsis for use with django_devops
@@ -31,33 +60,112 @@ class Command(BaseCommand):
                         First run "python manage.py devops" to configure django_devops.
                     ''')
 
-        # Check if the file exsists and confirm overwrite.
-        if exists(f'{settings.BASE_DIR}/{PROJECT_NAME}/config_files/{PROJECT_NAME}'):
-            if query_yes_no(f'{PROJECT_NAME}/config_files/{PROJECT_NAME} exists. Overwrite?'):
-                pass
-            else:
-                raise CommandError(f'''
-                            {PROJECT_NAME}/config_files/{PROJECT_NAME} will not be overwritten.
-                        ''')
+        # ------------------------------ Static & Media ------------------------------ #
+        static_root = getattr(settings, 'STATIC_ROOT', None) or f'/var/www/{PROJECT_NAME}/static'
+        static_location = url_location(getattr(settings, 'STATIC_URL', '/static/'))
+
+        static_block = ''
+        if static_location:
+            static_block = f'''
+                # Files hashed by ManifestStaticFilesStorage never change and are cached forever.
+                location {static_location} {{
+                    alias {str(static_root).rstrip('/')}/;
+                    access_log off;
+                    add_header Cache-Control ${NGINX_PREFIX}_static_cache_control;
+
+                    # Serve the .gz files written by "python manage.py precompress_static".
+                    gzip_static on;
+                }}
+            '''
+
+        media_block = ''
+        media_root = getattr(settings, 'MEDIA_ROOT', None)
+        media_location = url_location(getattr(settings, 'MEDIA_URL', None))
+        if media_root and media_location:
+            media_block = f'''
+                location {media_location} {{
+                    alias {str(media_root).rstrip('/')}/;
+                    access_log off;
+                    expires 1h;
+                }}
+            '''
+
+        # -------------------------------- Microcache -------------------------------- #
+        cache_zone = ''
+        cache_block = ''
+        if options['microcache']:
+            session_cookie = getattr(settings, 'SESSION_COOKIE_NAME', 'sessionid')
+            cache_zone = f'''
+
+            proxy_cache_path /var/cache/nginx/{PROJECT_NAME} levels=1:2 use_temp_path=off
+                             keys_zone={NGINX_PREFIX}_microcache:10m max_size=256m inactive=10m;'''
+            # Responses that set cookies are never cached by nginx.
+            cache_block = f'''
+
+                    # Microcache anonymous GET/HEAD responses, one request refreshes the entry.
+                    proxy_cache {NGINX_PREFIX}_microcache;
+                    proxy_cache_valid 200 301 302 {options['microcache']}s;
+                    proxy_cache_lock on;
+                    proxy_cache_use_stale updating error timeout;
+                    proxy_cache_bypass $cookie_{session_cookie} $http_authorization;
+                    proxy_no_cache $cookie_{session_cookie} $http_authorization;
+                    add_header X-Cache-Status $upstream_cache_status;'''
 
         # Generate nginx config file.
         file_template = f'''
-                           server {{
-                                server_name
+            # Generated by "python manage.py prep_nginx".
+
+            upstream {NGINX_PREFIX}_app {{
+                server unix:/opt/{PROJECT_NAME}/{PROJECT_NAME}.sock fail_timeout=0;
+                keepalive 32;
+            }}
+
+            # The combined format with the request and upstream time, read by "analyze_logs".
+            log_format {NGINX_PREFIX}_timed '$remote_addr - $remote_user [$time_local] "$request" '
+                '$status $body_bytes_sent "$http_referer" "$http_user_agent" '
+                'rt=$request_time urt=$upstream_response_time';
 
-                                location /static/ {{
-                                    root /var/www/{PROJECT_NAME};
-                                }}
+            map $uri ${NGINX_PREFIX}_static_cache_control {{
+                "~\\.[0-9a-f]{{12}}\\.[A-Za-z0-9]+$" "public, max-age=31536000, immutable";
+                default "public, max-age=3600";
+            }}{cache_zone}
 
-                                location / {{
-                                    include proxy_params;
-                                    proxy_pass http://unix:/opt/{PROJECT_NAME}/{PROJECT_NAME}.sock;
-                                }}
-                           }}
-                        '''
+            server {{
+                server_name {server_names()};
+                access_log /var/log/nginx/{PROJECT_NAME}.access.log {NGINX_PREFIX}_timed;
+
+                sendfile on;
+                tcp_nopush on;
+                tcp_nodelay on;
+
+                gzip on;
+                gzip_vary on;
+                gzip_proxied any;
+                gzip_comp_level 5;
+                gzip_min_length 256;
+                gzip_types text/plain text/css text/xml text/javascript application/javascript
+                           application/json application/xml application/rss+xml image/svg+xml;
+
+                open_file_cache max=10000 inactive=60s;
+                open_file_cache_valid 120s;
+                open_file_cache_min_uses 2;
+                open_file_cache_errors on;
+                {static_block}{media_block}
+                location / {{
+                    include proxy_params;
+                    proxy_pass http://{NGINX_PREFIX}_app;
+
+                    # Reuse upstream connections instead of opening one per request.
+                    proxy_http_version 1.1;
+                    proxy_set_header Connection "";
+
+                    proxy_buffering on;
+                    proxy_buffer_size 16k;
+                    proxy_buffers 32 16k;
+                    proxy_busy_buffers_size 64k;{cache_block}
+                }}
+            }}
+        '''
 
         file_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/config_files'
-        with open(f'{file_path}/{PROJECT_NAME}', 'w+', encoding='UTF-8') as file:
-            file.seek(0)
-            file.write(dedent(file_template))
-            file.truncate()
+        generate_file(f'{file_path}/{PROJECT_NAME}', file_template)
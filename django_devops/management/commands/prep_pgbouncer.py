@@ -0,0 +1,239 @@
+'''
+A programmatic way to prepare a pgbouncer config in front of the project's Postgres databases.
+'''
+
+import os
+import math
+from os.path import exists
+
+from django.core.management.base import CommandError
+
+from django.conf import settings
+
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.connections import celery_clients, gunicorn_clients
+from django_devops.utils.files import atomic_write, generate_file
+from django_devops.utils.user_input import query_yes_no
+
+PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
+
+# Where update_services deploys the generated config file.
+PGBOUNCER_CONFIG = '/etc/conf.d/pgbouncer.ini'
+# Written in place with the database passwords, it is never part of the project.
+USERLIST = '/etc/conf.d/userlist.txt'
+
+SERVICE_NAME = f'{PROJECT_NAME}-pgbouncer'
+SOCKET_DIR = f'/run/{SERVICE_NAME}'
+PORT = 6432
+
+POSTGRES_ENGINES = ('django.db.backends.postgresql', 'django.db.backends.postgresql_psycopg2')
+
+
+def postgres_databases():
+    '''
+    Returns {alias: database settings} of the Postgres databases in settings.DATABASES.
+    '''
+    return {
+        alias: database for alias, database in settings.DATABASES.items()
+        if database.get('ENGINE') in POSTGRES_ENGINES
+    }
+
+
+def tune_pgbouncer(clients, pool_size=None):
+    '''
+    Picks the pool settings for the given number of Django clients (threads that may
+    hold a connection). In transaction mode a server connection is only used for the
+    length of a transaction, so the pool is a fraction of the clients.
+    During a graceful gunicorn reload old and new workers are connected at the same time.
+    The minimum and reserve pools follow pool_size when it is given.
+    '''
+    pool_size = pool_size or min(max(5, math.ceil(clients / 2)), 50)
+    return {
+        'max_client_conn': 2 * clients + 20,
+        'default_pool_size': pool_size,
+        'min_pool_size': max(1, pool_size // 5),
+        'reserve_pool_size': max(1, pool_size // 4),
+    }
+
+
+def database_entries(databases):
+    '''
+    Returns the [databases] lines of pgbouncer.ini and the {user: password} of the databases.
+    '''
+    database_lines = []
+    users = {}
+    for database in databases.values():
+        host = database.get('HOST') or 'localhost'
+        port = database.get('PORT') or 5432
+        database_lines.append(
+            f"{database['NAME']} = host={host} port={port} dbname={database['NAME']}"
+        )
+        if database.get('USER'):
+            users[database['USER']] = database.get('PASSWORD', '')
+    return database_lines, users
+
+
+def print_recommendations(databases):
+    '''
+    Prints the DATABASES settings that point Django at pgbouncer.
+    '''
+    print('\nPoint Django at pgbouncer in settings.DATABASES:')
+    for alias in databases:
+        print(f'''
+    DATABASES['{alias}'].update({{
+        'HOST': '{SOCKET_DIR}',
+        'PORT': {PORT},
+        # Connections to pgbouncer are cheap to keep, health checks drop broken ones.
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        # Server side cursors do not survive transaction pooling.
+        'DISABLE_SERVER_SIDE_CURSORS': True,
+    }})''')
+
+
+class Command(ProfiledCommand):
+    '''
+    Programmatically create the pgbouncer config, userlist and service files.
+    '''
+
+    help = 'Prepare a pgbouncer config sized for the gunicorn and celery configs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pool-size', type=int,
+            help='Server connections per database and user (default: from the worker count).'
+        )
+        parser.add_argument(
+            '--max-db-connections', type=int, default=0,
+            help='Server connections per database on this host, 0 is unlimited. Set it to '
+                 'max_connections divided by the number of hosts.'
+        )
+        parser.add_argument(
+            '--userlist', default=USERLIST,
+            help=f'Where the userlist with the database passwords is written, readable by '
+                 f'root only (default: {USERLIST}).'
+        )
+
+    def write_userlist(self, path, users, config_files_path):
+        '''
+        Writes the userlist of {user: password} with mode 0600 outside of the project,
+        so the passwords are neither committed nor deployed with config_files.
+        '''
+        # Double quotes are escaped by doubling them.
+        content = ''.join(
+            f'''"{user.replace('"', '""')}" "{password.replace('"', '""')}"\n'''
+            for user, password in sorted(users.items())
+        )
+
+        # Older versions generated it into config_files, update_services would deploy it.
+        legacy_userlist = f'{config_files_path}/userlist.txt'
+        if exists(legacy_userlist) and \
+                query_yes_no(f'{legacy_userlist} holds the database passwords. Remove it?'):
+            os.remove(legacy_userlist)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, content.encode('UTF-8'), mode=0o600)
+        except OSError as err:
+            raise CommandError(f'Unable to write {path}: {err}') from err
+        self.stdout.write(f'✓ - {path} written, readable by its owner only.')
+
+    def handle(self, *args, **options):
+        '''
+        Sizes the pools from the generated gunicorn.conf.py and celery files.
+        '''
+        service_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/service_files'
+        config_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/config_files'
+
+        if not exists(service_files_path):
+            raise CommandError(f'''
+                {service_files_path} does not exist.
+                First run "python manage.py devops" to configure django_devops.
+            ''')
+
+        databases = postgres_databases()
+        if not databases:
+            raise CommandError('settings.DATABASES has no PostgreSQL database.')
+
+        # ------------------------------ Detect Settings ----------------------------- #
+        web_clients = gunicorn_clients(f'{config_files_path}/gunicorn.conf.py')
+        task_clients = celery_clients(f'{config_files_path}/celery')
+        if not web_clients and not task_clients:
+            raise CommandError(
+                'Run "prep_gunicorn" and/or "prep_celery" first, the pools are sized from them.'
+            )
+
+        # Every database a client uses is a connection of its own.
+        clients = (web_clients + task_clients) * len(databases)
+        tuning = tune_pgbouncer(clients, options['pool_size'])
+
+        database_lines, users = database_entries(databases)
+        database_section = '\n            '.join(database_lines)
+
+        # Generate pgbouncer.ini file.
+        config_template = f'''
+            ; Generated by "python manage.py prep_pgbouncer" for {web_clients} gunicorn threads
+            ; and {task_clients} celery processes/threads per database.
+
+            [databases]
+            {database_section}
+
+            [pgbouncer]
+            listen_addr = 127.0.0.1
+            listen_port = {PORT}
+            unix_socket_dir = {SOCKET_DIR}
+
+            ; A server connection is only held for the length of a transaction.
+            pool_mode = transaction
+
+            max_client_conn = {tuning['max_client_conn']}
+            default_pool_size = {tuning['default_pool_size']}
+            min_pool_size = {tuning['min_pool_size']}
+            reserve_pool_size = {tuning['reserve_pool_size']}
+            reserve_pool_timeout = 3
+            max_db_connections = {options['max_db_connections']}
+            server_idle_timeout = 600
+
+            auth_type = scram-sha-256
+            ; Copied from {options['userlist']} by systemd (LoadCredential), readable by pgbouncer only.
+            auth_file = /run/credentials/{SERVICE_NAME}.service/userlist
+
+            ignore_startup_parameters = extra_float_digits,options
+            log_connections = 0
+            log_disconnections = 0
+        '''
+
+        # Generate the pgbouncer service file.
+        # Named after the project so it does not replace the unit of the pgbouncer package.
+        service_template = f'''
+            [Unit]
+            Description = pgbouncer for {PROJECT_NAME}
+            After = network.target
+
+            [Service]
+            Type = simple
+            User = postgres
+            Group = postgres
+
+            RuntimeDirectory = {SERVICE_NAME}
+            LoadCredential = userlist:{options['userlist']}
+
+            ExecStart = /usr/sbin/pgbouncer {PGBOUNCER_CONFIG}
+            # No ExecReload: the userlist credential is only copied when the service starts.
+
+            LimitNOFILE = {tuning['max_client_conn'] + 2 * tuning['default_pool_size'] + 100}
+            Restart = always
+
+            [Install]
+            WantedBy = multi-user.target
+        '''
+
+        generate_file(f'{config_files_path}/pgbouncer.ini', config_template)
+        generate_file(f'{service_files_path}/{SERVICE_NAME}.service', service_template)
+        self.write_userlist(options['userlist'], users, config_files_path)
+
+        print(f'✓ - pgbouncer sized for {clients} clients: '
+              f'{tuning["default_pool_size"]} server connections per database and user.')
+
+        # ------------------------------ Recommendations ----------------------------- #
+        print_recommendations(databases)
@@ -0,0 +1,175 @@
+'''
+A programmatic way to prepare a Redis instance for the cache or the celery broker.
+'''
+
+import os
+from os.path import exists
+
+from django.core.management.base import CommandError
+
+from django.conf import settings
+
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.files import generate_file
+from django_devops.utils.host import available_memory, describe_host, effective_cpus
+
+PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
+
+
+def tune_redis(cpus, memory, purpose):
+    '''
+    Picks the Redis settings for a host with the given CPU count and available memory in bytes.
+    A cache evicts the least recently used keys and keeps nothing on disk, a broker must
+    never drop a message, so it refuses writes when full and appends every write to disk.
+    '''
+    share = 0.25 if purpose == 'cache' else 0.1
+    maxmemory_mb = max(64, int((memory or 2 ** 30) * share // 2 ** 20))
+
+    # I/O threads only pay off with 4 or more CPUs, one CPU is left for the main thread.
+    io_threads = min(4, cpus - 1) if cpus >= 4 else 1
+
+    return {
+        'maxmemory_mb': maxmemory_mb,
+        'maxmemory_policy': 'allkeys-lru' if purpose == 'cache' else 'noeviction',
+        'appendonly': 'no' if purpose == 'cache' else 'yes',
+        'io_threads': io_threads,
+    }
+
+
+def detect_settings(options):
+    '''
+    Returns the Redis settings for this host with the command's overrides applied.
+    '''
+    purpose = options['purpose']
+    tuning = tune_redis(effective_cpus(), available_memory(), purpose)
+    for setting, option in (
+            ('maxmemory_mb', 'maxmemory'), ('maxmemory_policy', 'eviction'),
+            ('io_threads', 'io_threads')):
+        if options[option] is not None:
+            tuning[setting] = options[option]
+
+    if purpose == 'broker' and tuning['maxmemory_policy'] != 'noeviction':
+        raise CommandError('A broker must use the noeviction policy, or messages are lost.')
+    return tuning
+
+
+class Command(ProfiledCommand):
+    '''
+    Programmatically create the Redis config and service files.
+    '''
+
+    help = 'Prepare a Redis config and unit for the cache or the celery broker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--purpose', choices=['cache', 'broker'], default='cache',
+            help='A cache evicts keys and is not persisted, a broker keeps every message.'
+        )
+        parser.add_argument('--maxmemory', type=int, help='Memory limit in MB.')
+        parser.add_argument(
+            '--eviction', help='maxmemory-policy, e.g. allkeys-lfu (default: by purpose).'
+        )
+        parser.add_argument('--io-threads', type=int, help='Number of I/O threads.')
+        parser.add_argument(
+            '--port', type=int, default=0,
+            help='Also listen on 127.0.0.1:PORT, e.g. to benchmark TCP against the socket.'
+        )
+
+    def handle(self, *args, **options):
+        '''
+        Verifies that the service folder exists for use with django_devops
+        '''
+        service_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/service_files'
+        config_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/config_files'
+
+        for folder_path in (service_files_path, config_files_path):
+            if not exists(folder_path):
+                raise CommandError(f'''
+                    {folder_path} does not exist.
+                    First run "python manage.py devops" to configure django_devops.
+                ''')
+
+        purpose = options['purpose']
+        tuning = detect_settings(options)
+
+        service_name = f'{PROJECT_NAME}-redis-{purpose}'
+        socket_path = f'/run/{service_name}/redis.sock'
+        config_name = f'redis-{purpose}.conf'
+
+        if purpose == 'broker':
+            persistence = 'appendfsync everysec'
+        else:
+            persistence = '# Nothing is written to disk.'
+
+        # Generate the redis config file.
+        config_template = f'''
+            # Generated by "python manage.py prep_redis" for a host with {describe_host()}.
+
+            # Clients connect over the unix socket, TCP is only used if a port is set.
+            bind 127.0.0.1
+            port {options['port']}
+            unixsocket {socket_path}
+            unixsocketperm 770
+            tcp-backlog 511
+            timeout 0
+            tcp-keepalive 300
+
+            supervised systemd
+            daemonize no
+            dir /var/lib/{service_name}
+
+            maxmemory {tuning['maxmemory_mb']}mb
+            maxmemory-policy {tuning['maxmemory_policy']}
+            maxmemory-samples 10
+            lazyfree-lazy-eviction yes
+            lazyfree-lazy-expire yes
+
+            save ""
+            appendonly {tuning['appendonly']}
+            {persistence}
+
+            io-threads {tuning['io_threads']}
+            io-threads-do-reads yes
+        '''
+
+        # Generate the redis service file.
+        # The group is the project's, so Django and celery can use the socket.
+        service_template = f'''
+            [Unit]
+            Description = Redis {purpose} for {PROJECT_NAME}
+            After = network.target
+
+            [Service]
+            Type = notify
+            User = redis
+            Group = {PROJECT_NAME}
+
+            RuntimeDirectory = {service_name}
+            RuntimeDirectoryMode = 0750
+            StateDirectory = {service_name}
+
+            ExecStart = /usr/bin/redis-server /etc/conf.d/{config_name}
+            LimitNOFILE = 65536
+            Restart = always
+
+            [Install]
+            WantedBy = multi-user.target
+        '''
+
+        generate_file(f'{config_files_path}/{config_name}', config_template)
+        generate_file(f'{service_files_path}/{service_name}.service', service_template)
+
+        print(f'✓ - Redis {purpose} with {tuning["maxmemory_mb"]} MB and '
+              f'{tuning["maxmemory_policy"]}, listening on {socket_path}.')
+
+        # ------------------------------ Recommendations ----------------------------- #
+        if purpose == 'cache':
+            print(f'''
+    CACHES = {{
+        'default': {{
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': 'unix://{socket_path}',
+        }},
+    }}''')
+        else:
+            print(f"\n    CELERY_BROKER_URL = 'redis+socket://{socket_path}'")
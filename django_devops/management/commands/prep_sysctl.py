@@ -0,0 +1,93 @@
+'''
+A programmatic way to prepare the kernel parameters and open file limits of the host.
+'''
+
+import os
+from os.path import exists
+
+from django.core.management.base import CommandError
+
+from django.conf import settings
+
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.files import generate_file
+from django_devops.utils.kernel import (
+    NGINX_CONF, SERVICE_PORTS, TUNED_SYSCTLS, configured_ports, consistency_report,
+    gunicorn_backlog, nginx_settings, read_sysctl, tune_kernel
+)
+
+PROJECT_NAME = os.path.basename(os.path.normpath(settings.BASE_DIR))
+
+# The open file limit of the project user outside of systemd, e.g. "manage.py" over ssh.
+NOFILE_LIMIT = 65536
+
+
+class Command(ProfiledCommand):
+    '''
+    Programmatically create the sysctl.d and limits.d files.
+    '''
+
+    help = 'Prepare kernel parameters that fit the gunicorn backlog and nginx workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--nginx-conf', default=NGINX_CONF,
+            help=f'The nginx.conf to read the worker settings from (default: {NGINX_CONF}).'
+        )
+
+    def handle(self, *args, **options):
+        '''
+        Sizes the kernel parameters from the generated gunicorn files and nginx.conf.
+        '''
+        service_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/service_files'
+        config_files_path = f'{settings.BASE_DIR}/{PROJECT_NAME}/config_files'
+
+        for folder_path in (service_files_path, config_files_path):
+            if not exists(folder_path):
+                raise CommandError(f'''
+                    {folder_path} does not exist.
+                    First run "python manage.py devops" to configure django_devops.
+                ''')
+
+        # ------------------------------ Detect Settings ----------------------------- #
+        backlog = gunicorn_backlog(
+            f'{config_files_path}/gunicorn.conf.py', f'{service_files_path}/gunicorn.socket'
+        )
+        nginx = nginx_settings(options['nginx_conf'])
+        running = {parameter: read_sysctl(parameter) for parameter in TUNED_SYSCTLS}
+        ports = set(SERVICE_PORTS) | configured_ports(service_files_path, config_files_path)
+        tuning = tune_kernel(backlog, nginx, running, ports)
+
+        sysctl_lines = '\n            '.join(
+            f'{parameter} = {value}' for parameter, value in tuning.items()
+        )
+
+        # Generate the sysctl.d file, applied by update_services with "sysctl --system".
+        sysctl_template = f'''
+            # Generated by "python manage.py prep_sysctl" for a gunicorn backlog of {backlog}
+            # and nginx with {nginx["worker_processes"]} x {nginx["worker_connections"]} worker_connections.
+            # listen() backlogs are silently capped at net.core.somaxconn.
+            # Parameters whose running value is already high enough are left out.
+
+            {sysctl_lines}
+        '''
+
+        # Generate the limits.d file.
+        # Only login sessions read it, services get LimitNOFILE from their unit.
+        limits_template = f'''
+            # Generated by "python manage.py prep_sysctl".
+            {PROJECT_NAME} soft nofile {NOFILE_LIMIT}
+            {PROJECT_NAME} hard nofile {NOFILE_LIMIT}
+        '''
+
+        generate_file(f'{config_files_path}/{PROJECT_NAME}.sysctl.conf', sysctl_template)
+        generate_file(f'{config_files_path}/{PROJECT_NAME}.limits.conf', limits_template)
+
+        # The kernel runs with the running values plus the generated ones.
+        sysctl = dict(running, **tuning)
+        print(f'✓ - net.core.somaxconn = {sysctl["net.core.somaxconn"]} '
+              f'for a gunicorn backlog of {backlog}.')
+
+        # ------------------------------ Recommendations ----------------------------- #
+        for check_passed, message in consistency_report(sysctl, backlog, nginx):
+            print(f'{"✓" if check_passed else "✗"} - {message}')
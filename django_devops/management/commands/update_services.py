@@ -1,18 +1,65 @@
 ''' Deploys configuration and services for the application '''
 
 import os
+import re
 import subprocess
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 
-from django_devops.utils.logger import log
+from django_devops.management.base import ProfiledCommand
+from django_devops.utils.celery_nodes import changed_nodes
+from django_devops.utils.health import (
+    measure_http, ping_celery_node, wait_for_http, wait_for_unit
+)
+from django_devops.utils.kernel import (
+    REPORTED_SYSCTLS, consistency_report, gunicorn_backlog, nginx_settings, read_sysctl
+)
+from django_devops.utils.logger import add_span, log, span, timed
+from django_devops.utils.manifest import MANIFEST_FILE, load_manifest, save_manifest
+from django_devops.utils.systemctl import (
+    disable_units, enable_units, log_restarts, restart_batch, set_unit_properties
+)
+from django_devops.utils.systemd import (
+    dependency_levels, instance_unit, is_installable, live_property_changes, parse_env_file,
+    parse_unit_file, socket_service, supports_reload, template_unit
+)
+from django_devops.utils.transaction import DeployTransaction, deploy_file
+from django_devops.utils.transports import SSH_COMMAND, deploy_targets, file_set, parse_target
+from django_devops.utils.watch import watch_files
 
 
 CONFIG_DIR = '/etc/conf.d'
 NGINX_SITES_AVAILABLE = '/etc/nginx/sites-available'
 NGINX_SITES_ENABLED = '/etc/nginx/sites-enabled'
 SYSTEMD_DIR = '/etc/systemd/system'
+SYSCTL_DIR = '/etc/sysctl.d'
+LIMITS_DIR = '/etc/security/limits.d'
+
+# Units replaced by a template unit, e.g. by an older "python manage.py prep_celery".
+# Deploying the template stops, disables and removes them.
+REPLACED_UNITS = {
+    'celery@.service': ['celery.service'],
+}
+
+# Overridden by settings.DJANGO_DEVOPS_HEALTH_CHECK.
+HEALTH_CHECK_DEFAULTS = {
+    'URL': '/',
+    'HOST': None,               # Defaults to the first entry of ALLOWED_HOSTS.
+    'SOCKET': None,             # Defaults to the gunicorn socket, /opt/<project>/<project>.sock.
+    'TIMEOUT': 5,               # Seconds each probe may take.
+    'STARTUP_TIMEOUT': 30,      # Seconds a restarted service may take to answer.
+    'PROBES': 5,                # Requests timed once the application answers, at least 1.
+    'LATENCY_BUDGET_MS': 1000,  # Median latency above which the deploy fails.
+    'REGRESSION_FACTOR': 3.0,   # ...or this many times the latency before the deploy.
+}
+
+def target_path(root: str, path: str) -> str:
+    """
+    Returns where an absolute path of the target system is found below root,
+    e.g. ("/srv/image", "/etc/conf.d") -> "/srv/image/etc/conf.d".
+    """
+    return os.path.join(root, path.lstrip('/'))
 
 def ensure_directory_exists(dir_path: str) -> None:
     """
@@ -22,151 +69,887 @@ def ensure_directory_exists(dir_path: str) -> None:
         os.makedirs(dir_path)
         log(f"Created directory: {dir_path}", "INFO")
 
-def deploy_file(src_path: str, dst_path: str) -> bool:
+def referenced_config_files(unit_path: str) -> set:
     """
-    Deploys a single file from src_path to dst_path.
-    Backs up the old version to dst_path + '.old' if content differs.
-    Returns True if the file was updated, False otherwise.
+    Returns the names of the files in CONFIG_DIR that a unit file refers to.
+    e.g. "EnvironmentFile = /etc/conf.d/celery" -> {"celery"}
     """
-    # Read new content
     try:
-        with open(src_path, 'r', encoding='UTF-8') as src_file:
-            new_content = src_file.read()
+        with open(unit_path, 'r', encoding='UTF-8') as unit_file:
+            content = unit_file.read()
     except FileNotFoundError:
-        log(f"Source file not found: {src_path}", "WARNING")
-        return False
+        return set()
 
-    # Read existing content (if any)
-    try:
-        with open(dst_path, 'r', encoding='UTF-8') as dst_file:
-            old_content = dst_file.read()
-    except FileNotFoundError:
-        old_content = ""
-
-    # Compare and update if different
-    if new_content != old_content:
-        # Make a backup
-        if old_content:
-            backup_path = dst_path + '.old'
-            with open(backup_path, 'w', encoding='UTF-8') as backup_file:
-                backup_file.write(old_content)
-            log(f"Backed up old file to {backup_path}", "INFO")
-
-        # Ensure the file exists (like touch) and write new content
-        with open(dst_path, 'w', encoding='UTF-8') as dst_file:
-            dst_file.write(new_content)
-        log(f"Updated file: {dst_path}", "INFO")
-        return True
+    return set(re.findall(re.escape(CONFIG_DIR) + r'/([^\s\'";]+)', content))
+
+def template_instances(unit_path: str, config_dir: str = CONFIG_DIR) -> list:
+    """
+    Returns the instances to run for a template unit (name@.service):
+    the nodes listed in CELERYD_NODES of the config files the unit refers to,
+    read from config_dir.
+    """
+    instances = []
+    for config in sorted(referenced_config_files(unit_path)):
+        env = parse_env_file(os.path.join(config_dir, config))
+        instances.extend(env.get('CELERYD_NODES', '').split())
+    return instances
 
-    # If no change, do nothing
-    log(f"No changes for {dst_path}", "INFO")
-    return False
+def instance_changes(
+        unit_path: str, changed_configs: set, config_dir: str, deployed_dir: str = CONFIG_DIR
+    ):
+    """
+    Compares the deployed versions (in deployed_dir) of the changed config files of a
+    template unit with the new versions in config_dir.
+    Returns the (added, changed, removed) instance names.
+    """
+    added, changed, removed = [], [], []
+    for config in sorted(referenced_config_files(unit_path) & changed_configs):
+        config_changes = changed_nodes(
+            parse_env_file(os.path.join(deployed_dir, config)),
+            parse_env_file(os.path.join(config_dir, config))
+        )
+        for names, config_names in zip((added, changed, removed), config_changes):
+            names.extend(config_names)
+    return added, changed, removed
 
-def manage_systemd_services(services: list) -> None:
+def split_sockets(changed_units: list) -> tuple:
+    """
+    Returns (sockets, units to restart) of the changed units. The service of a changed
+    socket is restarted too, it has to pick up the new listening socket.
     """
-    Reloads systemd daemons and restarts/enables each service in the given list.
-    Raises subprocess.CalledProcessError if systemctl commands fail.
+    sockets = [unit for unit in changed_units if unit.endswith('.socket')]
+    restart_units = [unit for unit in changed_units if not unit.endswith('.socket')]
+    for socket in sockets:
+        service = socket_service(os.path.join(SYSTEMD_DIR, socket))
+        if service not in restart_units:
+            restart_units.append(service)
+    return sockets, restart_units
+
+def reload_commands(units: list) -> dict:
+    """
+    Returns {(systemctl arguments): [units]} that reload units affected by a config change.
+    Plain reload-or-restart also starts stopped units, the try- variants
+    leave socket activated services stopped until they are needed.
+    """
+    commands = {}
+    for service in units:
+        unit_path = os.path.join(SYSTEMD_DIR, template_unit(service))
+        prefix = '' if is_installable(unit_path) else 'try-'
+        verb = 'reload-or-restart' if supports_reload(unit_path) else 'restart'
+        commands.setdefault((f'{prefix}{verb}',), []).append(service)
+    return commands
+
+@timed('manage_systemd_services')
+def manage_systemd_services(
+        changed_units: list, affected_units: list = None, removed_units: list = None,
+        live_units: dict = None, timeout: float = 90
+    ) -> dict:
     """
-    if not services:
+    Stops and disables removed units, reloads systemd daemons and enables/restarts each
+    unit whose file changed, then reloads the units affected by a changed config file.
+    Units without an ExecReload command are restarted instead.
+    Units whose file only changed in resource controls ({unit: {property: value}} in
+    live_units) get them applied with "systemctl set-property" instead of a restart.
+    Sockets are started before the services they activate, and units without an
+    [Install] section (started by their socket) are only touched if already running.
+    Units are enabled with one systemctl call and restarted in levels ordered by their
+    After=/Requires= dependencies: the units of a level restart in parallel and each is
+    waited for as long as systemd lets its job run (timeout seconds if unlimited).
+    Returns {unit: (seconds, None or an error)}, failures do not stop the other units.
+    """
+    affected_units = affected_units or []
+    removed_units = removed_units or []
+    live_units = live_units or {}
+    results = {}
+
+    if not changed_units and not affected_units and not removed_units and not live_units:
         log("No services to manage.", "INFO")
-        return
+        return results
+
+    if removed_units:
+        results.update(disable_units(removed_units))
+
+    # Only unit file changes require systemd to re-read its configuration.
+    if changed_units or removed_units or live_units:
+        try:
+            with span('daemon-reload'):
+                subprocess.run(['systemctl', 'daemon-reload'], check=True)
+        except subprocess.CalledProcessError as err:
+            # Restarting now would start the units with their old files.
+            results['daemon-reload'] = (0.0, str(err))
+            return results
+
+    # Sockets go first so the listening socket exists before its service starts.
+    sockets, restart_units = split_sockets(changed_units)
+
+    installable = [
+        unit for unit in sockets + restart_units
+        if is_installable(os.path.join(SYSTEMD_DIR, template_unit(unit)))
+    ]
+    if installable:
+        results.update(enable_units(installable))
+
+    levels = ([sockets] if sockets else []) + dependency_levels(restart_units, SYSTEMD_DIR)
+    for level in levels:
+        level = [unit for unit in level if unit not in results]
+        commands = {
+            ('restart',): [unit for unit in level if unit in installable],
+            ('try-restart',): [unit for unit in level if unit not in installable],
+        }
+        results.update(restart_batch(commands, timeout))
+
+    results.update(set_unit_properties({
+        service: properties for service, properties in live_units.items()
+        if service not in restart_units and properties
+    }))
+
+    affected_units = [unit for unit in affected_units if unit not in restart_units]
+    for level in dependency_levels(affected_units, SYSTEMD_DIR):
+        results.update(restart_batch(reload_commands(level), timeout))
+
+    log_restarts(results, restart_units + affected_units)
+    return results
+
+def health_check_settings(project_name: str) -> dict:
+    """
+    Returns HEALTH_CHECK_DEFAULTS updated with settings.DJANGO_DEVOPS_HEALTH_CHECK.
+    Raises CommandError if PROBES is below 1, the latency is the median of the probes.
+    """
+    config = dict(HEALTH_CHECK_DEFAULTS, **getattr(settings, 'DJANGO_DEVOPS_HEALTH_CHECK', {}))
+    if config['PROBES'] < 1:
+        raise CommandError(
+            f"DJANGO_DEVOPS_HEALTH_CHECK['PROBES'] must be at least 1, got {config['PROBES']}"
+        )
+    if not config['HOST']:
+        hosts = [host for host in getattr(settings, 'ALLOWED_HOSTS', []) if host != '*']
+        config['HOST'] = hosts[0].lstrip('.') if hosts else 'localhost'
+    if not config['SOCKET']:
+        config['SOCKET'] = f'/opt/{project_name}/{project_name}.sock'
+    return config
+
+def measure_app(config: dict, startup_timeout: float) -> tuple:
+    """
+    Probes the health URL over the gunicorn socket.
+    Returns (error, median seconds), or (None, None) if the socket does not exist.
+    """
+    if not os.path.exists(config['SOCKET']):
+        return None, None
+    error = wait_for_http(
+        config['SOCKET'], config['URL'], config['HOST'], config['TIMEOUT'], startup_timeout
+    )
+    if error:
+        return error, None
+    return measure_http(
+        config['SOCKET'], config['URL'], config['HOST'], config['PROBES'], config['TIMEOUT']
+    )
+
+@timed('verify_services')
+def verify_services(units: list, config: dict, baseline: float = None) -> list:
+    """
+    Checks the restarted units and the application after a deploy.
+    Enabled units must become active, celery nodes must answer a ping and the health URL
+    must answer within the latency budget without regressing past the baseline.
+    Returns the errors found.
+    """
+    errors = []
+    for unit in units:
+        unit_path = os.path.join(SYSTEMD_DIR, template_unit(unit))
+        # Units started by their socket may rightfully be inactive, the HTTP probe covers them.
+        if not is_installable(unit_path):
+            continue
+
+        error = wait_for_unit(unit, config['STARTUP_TIMEOUT'])
+        if error is None and template_unit(unit) != unit:
+            for config_file in sorted(referenced_config_files(unit_path)):
+                env = parse_env_file(os.path.join(CONFIG_DIR, config_file))
+                if env.get('CELERY_BIN') and env.get('CELERY_APP'):
+                    node = unit.split('@', 1)[1].rpartition('.')[0]
+                    error = ping_celery_node(
+                        env['CELERY_BIN'], env['CELERY_APP'], node,
+                        config['TIMEOUT'], env.get('CELERYD_CHDIR')
+                    )
+        if error:
+            errors.append(error)
+
+    error, latency = measure_app(config, config['STARTUP_TIMEOUT'])
+    if error:
+        errors.append(error)
+    elif latency is not None:
+        budget = config['LATENCY_BUDGET_MS'] / 1000
+        log(f"{config['URL']} answered in {latency * 1000:.0f}ms", "INFO")
+        if latency > budget:
+            errors.append(f"{config['URL']} took {latency * 1000:.0f}ms, "
+                          f"the budget is {config['LATENCY_BUDGET_MS']}ms")
+        elif baseline and latency > baseline * config['REGRESSION_FACTOR']:
+            errors.append(f"{config['URL']} took {latency * 1000:.0f}ms, "
+                          f"{baseline * 1000:.0f}ms before the deploy")
+    return errors
+
+@timed('apply_sysctl')
+def apply_sysctl() -> None:
+    """
+    Loads every sysctl.d file, so changed kernel parameters apply without a reboot.
+    """
+    subprocess.run(['sysctl', '--system'], check=True, stdout=subprocess.DEVNULL)
+    log("Kernel parameters applied", "INFO")
+
+
+def kernel_report() -> list:
+    """
+    Compares the running kernel parameters with the deployed gunicorn and nginx settings.
+    Returns [(passed, message)].
+    """
+    backlog = gunicorn_backlog(
+        os.path.join(CONFIG_DIR, 'gunicorn.conf.py'), os.path.join(SYSTEMD_DIR, 'gunicorn.socket')
+    )
+    sysctl = {parameter: read_sysctl(parameter) for parameter in REPORTED_SYSCTLS}
+    return consistency_report(sysctl, backlog, nginx_settings())
+
+
+@timed('rollback_services')
+def rollback_services(transaction: DeployTransaction, units: list, timeout: float = 90) -> list:
+    """
+    Restores the files of the deploy and restarts its units with them.
+    Units that did not exist before the deploy are stopped first.
+    Returns the errors of the units that could not be restarted.
+    systemd reloads the restored files before the restarts. If no unit is restarted,
+    subprocess.CalledProcessError is raised when it can not reload them.
+    """
+    new_files = transaction.created()
+    stop_units = [
+        unit for unit in units if os.path.join(SYSTEMD_DIR, template_unit(unit)) in new_files
+    ]
+    for unit in stop_units:
+        subprocess.run(['systemctl', 'disable', '--now', unit], check=False)
+
+    transaction.rollback()
+
+    restart_units = []
+    for unit in units:
+        if unit in stop_units or unit in restart_units:
+            continue
+        template_path = os.path.join(SYSTEMD_DIR, template_unit(unit))
+        node = unit.split('@', 1)[1].rpartition('.')[0] if '@' in unit else None
+        if node is not None and node not in template_instances(template_path):
+            # Nodes added by the deploy are no longer in the restored config.
+            subprocess.run(['systemctl', 'disable', '--now', unit], check=False)
+        else:
+            restart_units.append(unit)
+
+    if not restart_units:
+        subprocess.run(['systemctl', 'daemon-reload'], check=True)
+        return []
+    # Reloads systemd before restarting the units.
+    results = manage_systemd_services(restart_units, timeout=timeout)
+    return [error for _, error in results.values() if error]
+
+def enable_offline(root: str, units: list, removed_units: list = None) -> None:
+    """
+    Enables the installable units in a target root that does not run systemd,
+    e.g. an image being built. They are started when the target boots.
+    The removed units are disabled first.
+    Raises subprocess.CalledProcessError if systemctl fails.
+    """
+    if removed_units:
+        subprocess.run(['systemctl', f'--root={root}', 'disable', *removed_units], check=True)
+        log(f"Disabled {', '.join(removed_units)} in {root}", "INFO")
+
+    installable = [
+        unit for unit in units
+        if is_installable(os.path.join(target_path(root, SYSTEMD_DIR), template_unit(unit)))
+    ]
+    if installable:
+        subprocess.run(['systemctl', f'--root={root}', 'enable', *installable], check=True)
+        log(f"Enabled {', '.join(installable)} in {root}", "INFO")
+
+@timed('reload_nginx')
+def reload_nginx() -> None:
+    """
+    Validates the nginx configuration, then reloads nginx without dropping connections.
+    Raises subprocess.CalledProcessError if the configuration is invalid or the reload fails.
+    """
+    subprocess.run(['nginx', '-t'], check=True)
+    subprocess.run(['systemctl', 'reload-or-restart', 'nginx'], check=True)
+
+class DeployPlan:
+    """
+    The changes of a deploy, and the units they restart, reload or stop.
+    nginx and sysctl are None when the project has no such file, else whether it changed.
+    """
+
+    def __init__(self):
+        # Names of the files in CONFIG_DIR whose content changed during this run.
+        self.configs = set()
+        self.changed = []
+        self.affected = []
+        self.removed = []
+        self.live = {}
+        self.nginx = None
+        self.sysctl = None
+
+    def has_unit_changes(self) -> bool:
+        """
+        True if a unit has to be restarted, reloaded, stopped or updated.
+        """
+        return bool(self.changed or self.affected or self.removed or self.live)
+
+    def restarted_units(self) -> list:
+        """
+        Returns the units that run with the new files once the services are updated.
+        """
+        return self.changed + self.affected + list(self.live)
+
+class FileStager:
+    """
+    Compares the config and service files of a project with the files deployed in root,
+    and stages the changed ones in a single DeployTransaction.
+    only is a set of source files to compare, the other files are not compared.
+    The deployed copies of the files in only that no longer exist are removed.
+    """
+
+    def __init__(self, project_dir: str, root: str, manifest: dict, only: set = None):
+        self.project_dir = project_dir
+        self.root = root
+        self.manifest = manifest
+        self.only = only
+        # Changed files are only written once every file of the run is staged.
+        self.transaction = DeployTransaction()
+        self.plan = DeployPlan()
+
+    def stages(self, src_file: str, dst_file: str) -> bool:
+        """
+        Stages src_file if it is compared in this run and differs from dst_file,
+        or the removal of dst_file if src_file was deleted.
+        Returns whether it was staged.
+        """
+        if self.only is not None and src_file not in self.only:
+            return False
+        if not os.path.exists(src_file):
+            return self.stage_removal(dst_file)
+        return deploy_file(src_file, dst_file, self.manifest, self.transaction)
+
+    def deleted_files(self, dir_path: str) -> list:
+        """
+        Returns the names of the files in dir_path that are compared in this run but
+        no longer exist, e.g. deleted while --watch runs.
+        """
+        return [
+            os.path.basename(path) for path in sorted(self.only or [])
+            if os.path.dirname(path) == dir_path and not os.path.lexists(path)
+        ]
+
+    def stage_config_files(self) -> bool:
+        """
+        Stages the changed config files.
+        Returns False if the project has no config_files directory.
+        """
+        config_files_path = os.path.join(self.project_dir, 'config_files')
+        if not os.path.isdir(config_files_path):
+            return False
+
+        project_name = os.path.basename(self.project_dir)
+        plan = self.plan
+        for filename in os.listdir(config_files_path) + self.deleted_files(config_files_path):
+            src_file = os.path.join(config_files_path, filename)
+
+            # If the filename matches the project, treat it as Nginx config
+            if filename == project_name:
+                plan.nginx = plan.nginx or False
+                dst_path = os.path.join(target_path(self.root, NGINX_SITES_AVAILABLE), filename)
+            elif filename.endswith('.sysctl.conf'):
+                plan.sysctl = plan.sysctl or False
+                dst_path = os.path.join(target_path(self.root, SYSCTL_DIR), filename)
+            elif filename.endswith('.limits.conf'):
+                dst_path = os.path.join(target_path(self.root, LIMITS_DIR), filename)
+            else:
+                dst_path = os.path.join(target_path(self.root, CONFIG_DIR), filename)
+
+            if not self.stages(src_file, dst_path):
+                continue
+            if filename == project_name:
+                plan.nginx = True
+            elif filename.endswith('.sysctl.conf'):
+                plan.sysctl = True
+            elif not filename.endswith('.limits.conf'):
+                plan.configs.add(filename)
+        return True
+
+    def stage_service_files(self) -> bool:
+        """
+        Stages the changed unit files, and sorts the units by what they need:
+        a restart, a reload of their config, a stop or new live properties.
+        Returns False if the project has no service_files directory.
+        """
+        service_files_path = os.path.join(self.project_dir, 'service_files')
+        if not os.path.isdir(service_files_path):
+            return False
+
+        systemd_dir = target_path(self.root, SYSTEMD_DIR)
+        plan = self.plan
+        filenames = sorted(os.listdir(service_files_path))
+        for filename in filenames + self.deleted_files(service_files_path):
+            src_file = os.path.join(service_files_path, filename)
+            dst_file = os.path.join(systemd_dir, filename)
+
+            if not os.path.exists(src_file):
+                self.stage_removal(dst_file, self.deployed_units(dst_file))
+            elif '@.' in filename:
+                self.stage_template(src_file, dst_file)
+            elif self.stages(src_file, dst_file):
+                # Only resource controls changed: apply them without a restart.
+                properties = live_property_changes(
+                    parse_unit_file(dst_file), parse_unit_file(src_file)
+                )
+                if properties is None:
+                    plan.changed.append(filename)
+                else:
+                    plan.live[filename] = properties
+            elif referenced_config_files(src_file) & plan.configs:
+                plan.affected.append(filename)
 
-    # Reload once for all changes
-    subprocess.run(['systemctl', 'daemon-reload'], check=True)
+        for template, units in REPLACED_UNITS.items():
+            for unit in units:
+                if template in filenames and unit not in filenames:
+                    self.stage_removal(os.path.join(systemd_dir, unit), [unit])
+        return True
+
+    def deployed_units(self, unit_path: str) -> list:
+        """
+        Returns the units that run from a deployed unit file: the unit itself, or the
+        instances of a template listed in the deployed config files.
+        """
+        filename = os.path.basename(unit_path)
+        if '@.' not in filename:
+            return [filename]
+        return [
+            instance_unit(filename, node)
+            for node in template_instances(unit_path, target_path(self.root, CONFIG_DIR))
+        ]
+
+    def stage_removal(self, dst_path: str, units: list = ()) -> bool:
+        """
+        Stages the removal of a deployed file, units are stopped and disabled.
+        Returns whether it was staged, False if dst_path was not deployed.
+        """
+        if not os.path.exists(dst_path):
+            return False
+        try:
+            self.transaction.stage_removal(dst_path)
+        except OSError:
+            self.transaction.discard()
+            raise
+        self.plan.removed.extend(units)
+        return True
 
-    for service in services:
-        subprocess.run(['systemctl', 'enable', service], check=True)
-        subprocess.run(['systemctl', 'restart', service], check=True)
-        log(f"Enabled and restarted {service}", "INFO")
+    def stage_template(self, src_file: str, dst_file: str) -> None:
+        """
+        Template units run one instance per node, only the nodes
+        whose options changed are restarted.
+        """
+        filename = os.path.basename(src_file)
+        config_files_path = os.path.join(self.project_dir, 'config_files')
+        plan = self.plan
 
-class Command(BaseCommand):
+        added, changed, removed = instance_changes(
+            src_file, plan.configs, config_files_path, target_path(self.root, CONFIG_DIR)
+        )
+        if self.stages(src_file, dst_file):
+            # The deployed unit is only replaced when the transaction is committed.
+            properties = live_property_changes(
+                parse_unit_file(dst_file), parse_unit_file(src_file)
+            )
+            if properties is None:
+                added = template_instances(src_file, config_files_path)
+                changed = []
+            else:
+                for node in template_instances(src_file, config_files_path):
+                    if node not in added:
+                        plan.live[instance_unit(filename, node)] = properties
+
+        plan.changed.extend(instance_unit(filename, node) for node in added)
+        plan.affected.extend(instance_unit(filename, node) for node in changed)
+        plan.removed.extend(instance_unit(filename, node) for node in removed)
+
+class Command(ProfiledCommand):
     '''
     Checks that configuration and service files exist and have not been deployed before deploying
     '''
 
     help = 'Deploys configuration and services for the application'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Compare the content of every file instead of trusting the deploy manifest.'
+        )
+        parser.add_argument(
+            '--manifest',
+            help=f'Path of the deploy manifest (default: {MANIFEST_FILE} below --root).'
+        )
+        parser.add_argument(
+            '--no-health-check', action='store_true',
+            help='Do not verify the services after restarting them, or roll back on failure.'
+        )
+        parser.add_argument(
+            '--root',
+            help='Deploy into this directory, e.g. a chroot or an image being built. '
+                 'Units are enabled with "systemctl --root" but not started.'
+        )
+        parser.add_argument(
+            '--target', action='append', default=[],
+            help='Deploy to this target instead of this machine: a directory (see --root) or '
+                 'ssh://[user@]host. Repeat it to deploy to several targets at once.'
+        )
+        parser.add_argument(
+            '--parallel', type=int, default=8,
+            help='Number of targets deployed at the same time (default: 8).'
+        )
+        parser.add_argument(
+            '--ssh-command',
+            default=getattr(settings, 'DJANGO_DEVOPS_SSH_COMMAND', SSH_COMMAND),
+            help=f'Command used to reach ssh targets, called with the host and a script '
+                 f'(default: "{SSH_COMMAND}").'
+        )
+        parser.add_argument(
+            '--remote-dir',
+            help='Directory of manage.py on ssh targets (default: /opt/<project>).'
+        )
+        parser.add_argument(
+            '--remote-python',
+            help='Python that runs manage.py on ssh targets '
+                 '(default: /opt/<project>/.venv/bin/python).'
+        )
+        parser.add_argument(
+            '--watch', action='store_true',
+            help='Keep running and deploy the config and service files as they change.'
+        )
+        parser.add_argument(
+            '--debounce', type=float, default=0.3,
+            help='Seconds without changes before --watch deploys a burst of edits (default: 0.3).'
+        )
+
+    def fan_out(self, project_name: str, options: dict) -> None:
+        """
+        Deploys the config and service files of this project to every --target at once,
+        then prints a summary of the targets.
+        """
+        remote_dir = options['remote_dir'] or f'/opt/{project_name}'
+        remote_python = options['remote_python'] or f'/opt/{project_name}/.venv/bin/python'
+        manage_py = os.path.join(settings.BASE_DIR, 'manage.py')
+        transports = [
+            parse_target(target, manage_py, options['ssh_command'], remote_dir, remote_python)
+            for target in options['target']
+        ]
+        arguments = []
+        if options['force']:
+            arguments.append('--force')
+        if options['no_health_check']:
+            arguments.append('--no-health-check')
+        files = file_set(os.path.join(settings.BASE_DIR, project_name))
+
+        results = []
+        for transport, returncode, seconds, output in deploy_targets(
+                transports, arguments, files, options['parallel']):
+            add_span('deploy_target', seconds, target=transport.name)
+            for line in output.splitlines():
+                self.stdout.write(f"[{transport.name}] {line}")
+            results.append((transport.name, returncode, seconds))
+        self.report_targets(results)
+
+    def report_targets(self, results: list) -> None:
+        """
+        Prints the result of each target, results is [(name, exit code, seconds)].
+        Raises CommandError if a target failed.
+        """
+        width = max(len(name) for name, _, _ in results)
+        self.stdout.write(f"\n{'Target':<{width}}  Result  {'Time':>8}")
+        for name, returncode, seconds in sorted(results):
+            status = 'ok' if returncode == 0 else 'failed'
+            self.stdout.write(f"{name:<{width}}  {status:<6}  {seconds:>7.1f}s")
+
+        failed = [name for name, returncode, _ in results if returncode != 0]
+        if failed:
+            raise CommandError(
+                f"The deploy failed on {len(failed)} of {len(results)} targets: {', '.join(failed)}"
+            )
+
+    def finish_offline(self, root: str, project_name: str, plan: DeployPlan) -> None:
+        """
+        Enables the changed units and the nginx site in a target root, and disables the
+        removed units. Nothing is started, reloaded or applied: the target picks the files
+        up when it boots.
+        """
+        try:
+            enable_offline(root, plan.changed, plan.removed)
+        except subprocess.CalledProcessError as err:
+            raise CommandError(f"Error enabling the units in {root}: {err}") from err
+
+        # The link is resolved inside the target, so it points to the path there.
+        available_path = os.path.join(NGINX_SITES_AVAILABLE, project_name)
+        enabled_path = target_path(root, os.path.join(NGINX_SITES_ENABLED, project_name))
+        site_exists = os.path.exists(target_path(root, available_path))
+        if plan.nginx is not None and site_exists and not os.path.lexists(enabled_path):
+            os.symlink(available_path, enabled_path)
+            log(f"Enabled the nginx site {project_name} in {root}", "INFO")
+        elif plan.nginx and not site_exists and os.path.islink(enabled_path):
+            os.remove(enabled_path)
+            log(f"Disabled the nginx site {project_name} in {root}", "INFO")
+
+        self.stdout.write(self.style.SUCCESS(f"-- Deployed to {root} --"))
+
     def handle(self, *args, **options):
         '''
-        Deploys configuration and services for the application
+        Deploys configuration and services for the application, once or on every change
         '''
         project_name = os.path.basename(os.path.normpath(settings.BASE_DIR))
-        config_files_path = os.path.join(settings.BASE_DIR, project_name, 'config_files')
-        service_files_path = os.path.join(settings.BASE_DIR, project_name, 'service_files')
 
-        # Ensure config directory exists
-        ensure_directory_exists(CONFIG_DIR)
+        if options['target']:
+            for option in ('watch', 'root', 'manifest'):
+                if options[option]:
+                    raise CommandError(f'--{option} can not be combined with --target.')
+            self.fan_out(project_name, options)
+        elif options['watch']:
+            self.watch(project_name, options)
+        else:
+            self.deploy(options)
 
-        # Flag to know if we found a project-specific (Nginx) config
-        nginx_project_config_deployed = False
+    def watch(self, project_name: str, options: dict) -> None:
+        """
+        Deploys everything once, then deploys the files that change until interrupted.
+        Only the changed files are compared, and only the units they affect are
+        restarted or reloaded. A failed deploy is reported and the watch goes on.
+        """
+        dir_paths = [
+            os.path.join(settings.BASE_DIR, project_name, 'config_files'),
+            os.path.join(settings.BASE_DIR, project_name, 'service_files'),
+        ]
+        changes = watch_files(dir_paths, options['debounce'])
+        changed = None
+        try:
+            while True:
+                try:
+                    with span('watch_deploy'):
+                        self.deploy(options, changed)
+                except CommandError as err:
+                    log(str(err), "ERROR")
 
-       # ---------------------------- Update Config Files --------------------------- #
-        if os.path.isdir(config_files_path):
-            for filename in os.listdir(config_files_path):
-                src_file = os.path.join(config_files_path, filename)
+                # Later deploys trust the manifest, the first one honoured --force.
+                options['force'] = False
+                log(f"Watching {' and '.join(dir_paths)} for changes", "INFO")
+                changed = next(changes)
+                log(f"Changed: {', '.join(sorted(changed or ['every file']))}", "INFO")
+        except KeyboardInterrupt:
+            self.stdout.write("Stopped watching.")
+        finally:
+            changes.close()
 
-                # If the filename matches the project, treat it as Nginx config
-                if filename == project_name:
-                    nginx_project_config_deployed = True
-                    dst_path = os.path.join(NGINX_SITES_AVAILABLE, filename)
-                else:
-                    dst_path = os.path.join(CONFIG_DIR, filename)
+    def deploy(self, options: dict, only: set = None) -> None:
+        """
+        Deploys configuration and services for the application.
+        only is a set of source files to deploy, the other files are not compared.
+        """
+        project_name = os.path.basename(os.path.normpath(settings.BASE_DIR))
 
-                # "Touch" the file by simply opening in append mode if it doesn't exist
-                if not os.path.exists(dst_path):
-                    with open(dst_path, 'a', encoding='UTF-8'):
-                        pass
+        # The services of another root are not running on this machine.
+        root = os.path.abspath(options['root'] or '/')
+        offline = root != '/'
+        options['manifest'] = options['manifest'] or target_path(root, MANIFEST_FILE)
 
-                deploy_file(src_file, dst_path)
-        else:
+        # Ensure config directory exists
+        ensure_directory_exists(target_path(root, CONFIG_DIR))
+        if offline:
+            for dir_path in (NGINX_SITES_AVAILABLE, NGINX_SITES_ENABLED, SYSTEMD_DIR,
+                             SYSCTL_DIR, LIMITS_DIR):
+                ensure_directory_exists(target_path(root, dir_path))
+
+        manifest = {} if options['force'] else load_manifest(options['manifest'])
+        stager = FileStager(os.path.join(settings.BASE_DIR, project_name), root, manifest, only)
+
+        # ---------------------------- Update Config Files --------------------------- #
+        if not stager.stage_config_files():
             self.stdout.write(self.style.WARNING("No config_files directory found."))
 
         # --------------------------- Update Service Files --------------------------- #
-        services = []
-        if os.path.isdir(service_files_path):
-            for filename in os.listdir(service_files_path):
-                src_file = os.path.join(service_files_path, filename)
-                dst_file = os.path.join(SYSTEMD_DIR, filename)
-
-                if not os.path.exists(dst_file):
-                    with open(dst_file, 'a', encoding='UTF-8'):
-                        pass
-
-                deploy_file(src_file, dst_file)
-                services.append(filename)
-        else:
+        if not stager.stage_service_files():
             self.stdout.write(self.style.WARNING("No service_files directory found."))
 
-        # --------------------------- Reload and Start Services --------------------------- #
-        if services:
+        try:
+            stager.transaction.commit(manifest)
+        except OSError as err:
+            raise CommandError(f"Deploy failed, no files were changed: {err}") from err
+
+        try:
+            save_manifest(manifest, options['manifest'])
+        except OSError as err:
+            log(f"Unable to save the deploy manifest: {err}", "WARNING")
+
+        if offline:
+            self.finish_offline(root, project_name, stager.plan)
+            return
+
+        self.apply_changes(project_name, stager, options)
+
+    def apply_changes(self, project_name: str, stager: FileStager, options: dict) -> None:
+        """
+        Applies the committed files to this machine: kernel parameters, services and nginx.
+        Then checks the services, and rolls the deploy back if they fail.
+        """
+        plan = stager.plan
+        health_check = not options['no_health_check'] and bool(stager.transaction.committed)
+        config = health_check_settings(project_name)
+        errors = []
+
+        # ----------------------------- Kernel Parameters ---------------------------- #
+        # Applied before the restarts, so services open their sockets with the new limits.
+        if plan.sysctl:
             try:
-                manage_systemd_services(services)
-                self.stdout.write(self.style.SUCCESS("-- Services Updated and Restarted --"))
+                apply_sysctl()
             except subprocess.CalledProcessError as err:
-                self.stderr.write(self.style.ERROR(f"Error managing systemd services: {err}"))
-        else:
-            self.stdout.write("No services to reload or restart.")
+                self.stderr.write(self.style.ERROR(f"Error applying kernel parameters: {err}"))
+                errors.append(str(err))
 
-        # --------------------------- Handle Nginx --------------------------- #
-        if nginx_project_config_deployed:
-            # Link site if not already enabled
-            available_path = os.path.join(NGINX_SITES_AVAILABLE, project_name)
-            enabled_path = os.path.join(NGINX_SITES_ENABLED, project_name)
+        baseline = None
+        if health_check:
+            # Measured before the restart, so a slower deploy can be detected.
+            with span('baseline'):
+                _, baseline = measure_app(config, 0)
 
-            if not os.path.exists(enabled_path) and os.path.exists(available_path):
-                try:
-                    subprocess.run(['ln', '-s', available_path, enabled_path], check=True)
-                    log(f"Linked {available_path} to {enabled_path}", "INFO")
-                except subprocess.CalledProcessError as err:
-                    self.stderr.write(self.style.ERROR(f"Error linking Nginx config: {err}"))
+        errors.extend(self.restart_services(plan))
+        errors.extend(self.update_nginx(project_name, plan))
 
-                # Restart Nginx to load the new site
-                try:
-                    subprocess.run(['systemctl', 'restart', 'nginx'], check=True)
-                    log("Nginx restarted", "INFO")
-                except subprocess.CalledProcessError as err:
-                    self.stderr.write(self.style.ERROR(f"Error restarting Nginx: {err}"))
-            else:
-                log(f"Enabled Nginx site: {project_name}", "INFO")
-        else:
+        if plan.sysctl is not None:
+            for check_passed, message in kernel_report():
+                if check_passed:
+                    self.stdout.write(f"✓ - {message}")
+                else:
+                    self.stdout.write(self.style.WARNING(f"✗ - {message}"))
+
+        # ------------------------------- Health Check ------------------------------- #
+        if not health_check:
+            return
+
+        errors.extend(verify_services(plan.restarted_units(), config, baseline))
+        if not errors:
+            self.stdout.write(self.style.SUCCESS("-- Services passed their health checks --"))
+            return
+
+        self.roll_back(stager, errors, options['manifest'])
+
+    def restart_services(self, plan: DeployPlan) -> list:
+        """
+        Restarts, reloads, stops and updates the units of the plan.
+        Returns the errors.
+        """
+        if not plan.has_unit_changes():
+            self.stdout.write("No services to reload or restart.")
+            return []
+
+        results = manage_systemd_services(
+            plan.changed, plan.affected, plan.removed, plan.live
+        )
+        failed = [error for _, error in results.values() if error]
+        for error in failed:
+            self.stderr.write(self.style.ERROR(f"Error managing systemd services: {error}"))
+        if not failed:
+            self.stdout.write(self.style.SUCCESS("-- Services Updated and Reloaded --"))
+        return failed
+
+    def update_nginx(self, project_name: str, plan: DeployPlan) -> list:
+        """
+        Enables the nginx site of the project, or disables it if it was removed, and reloads
+        nginx if the site is new, changed or removed.
+        Returns the errors, an invalid config fails the deploy so it is rolled back.
+        """
+        if plan.nginx is None:
             log("No project-specific Nginx config file found.", "INFO")
+            return []
+
+        # Link site if not already enabled
+        available_path = os.path.join(NGINX_SITES_AVAILABLE, project_name)
+        enabled_path = os.path.join(NGINX_SITES_ENABLED, project_name)
+
+        # The site was removed, nginx -t fails on a dangling link.
+        if not os.path.exists(available_path) and os.path.islink(enabled_path):
+            try:
+                os.remove(enabled_path)
+            except OSError as err:
+                self.stderr.write(self.style.ERROR(f"Error disabling Nginx site: {err}"))
+                return [f"Error disabling Nginx site: {err}"]
+            log(f"Removed {enabled_path}", "INFO")
+
+        site_linked = False
+        if not os.path.exists(enabled_path) and os.path.exists(available_path):
+            try:
+                subprocess.run(['ln', '-s', available_path, enabled_path], check=True)
+                log(f"Linked {available_path} to {enabled_path}", "INFO")
+                site_linked = True
+            except subprocess.CalledProcessError as err:
+                self.stderr.write(self.style.ERROR(f"Error linking Nginx config: {err}"))
+                return [f"Error linking Nginx config: {err}"]
+
+        # Reload Nginx only when the site is new or its config changed
+        if not site_linked and not plan.nginx:
+            log(f"Nginx site unchanged: {project_name}", "INFO")
+            return []
+        try:
+            reload_nginx()
+        except subprocess.CalledProcessError as err:
+            self.stderr.write(self.style.ERROR(f"Error reloading Nginx: {err}"))
+            return [f"Error reloading Nginx: {err}"]
+        log("Nginx reloaded", "INFO")
+        return []
+
+    def roll_back(self, stager: FileStager, errors: list, manifest_path: str) -> None:
+        """
+        Reports the errors of a failed deploy, then restores the previous files
+        and restarts the services with them. Always raises CommandError.
+        """
+        # A unit that failed to restart also fails its health check.
+        for error in dict.fromkeys(errors):
+            log(error, "ERROR")
+
+        log("Rolling back the deploy", "WARNING")
+        plan = stager.plan
+        deployed = [dst_path for _, dst_path, _, _, _ in stager.transaction.committed]
+        # A site that is new in this deploy is disabled again, nginx -t fails on a dangling link.
+        new_sites = [
+            os.path.join(NGINX_SITES_ENABLED, os.path.basename(dst_path))
+            for dst_path in stager.transaction.created()
+            if os.path.dirname(dst_path) == NGINX_SITES_AVAILABLE
+        ]
+        # A site removed by this deploy is enabled again once it is restored.
+        removed_sites = [
+            dst_path for dst_path in stager.transaction.removed()
+            if os.path.dirname(dst_path) == NGINX_SITES_AVAILABLE
+        ]
+        units = list(dict.fromkeys(
+            plan.changed + plan.affected + plan.removed + list(plan.live)
+        ))
+        try:
+            rollback_errors = rollback_services(stager.transaction, units)
+            for enabled_path in new_sites:
+                if os.path.islink(enabled_path):
+                    os.remove(enabled_path)
+                    log(f"Removed {enabled_path}", "WARNING")
+            for available_path in removed_sites:
+                enabled_path = os.path.join(NGINX_SITES_ENABLED, os.path.basename(available_path))
+                if not os.path.lexists(enabled_path):
+                    os.symlink(available_path, enabled_path)
+                    log(f"Linked {available_path} to {enabled_path}", "WARNING")
+            if plan.nginx:
+                reload_nginx()
+            if plan.sysctl:
+                apply_sysctl()
+        except (subprocess.CalledProcessError, OSError) as err:
+            raise CommandError(f"The rollback failed: {err}") from err
+        finally:
+            for dst_path in deployed:
+                stager.manifest.pop(dst_path, None)
+            try:
+                save_manifest(stager.manifest, manifest_path)
+            except OSError as err:
+                log(f"Unable to save the deploy manifest: {err}", "WARNING")
+
+        if rollback_errors:
+            raise CommandError(f"The rollback failed: {'; '.join(rollback_errors)}")
+        raise CommandError("The deploy failed its health checks and was rolled back.")
@@ -0,0 +1,155 @@
+'''
+Request metrics shared between the gunicorn workers, exposed in the Prometheus text format.
+
+Values are kept as fixed bucket counters, every request only adds to a few of them.
+Set DJANGO_DEVOPS_METRICS_DIR (setting or environment variable) to a directory shared by
+the workers, the gunicorn.service written by "prep_gunicorn" sets it to /run/<project>/metrics.
+Without it every process only reports its own requests.
+'''
+
+import os
+import json
+import bisect
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+
+from django_devops.metrics.store import DirectoryStore, MemoryStore
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKET_LABELS = tuple(repr(bucket) for bucket in BUCKETS) + ('+Inf',)
+
+REQUESTS = 'django_http_requests_total'
+DURATION = 'django_http_request_duration_seconds'
+IN_PROGRESS = 'django_http_requests_in_progress'
+
+HELP = {
+    REQUESTS: 'Requests by view, method and status code.',
+    DURATION: 'Request duration in seconds by view.',
+    IN_PROGRESS: 'Requests currently being handled.',
+}
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_store():
+    '''
+    Returns the store of the process, created from the settings on first use.
+    '''
+    global _STORE  # pylint: disable=global-statement
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                directory = getattr(settings, 'DJANGO_DEVOPS_METRICS_DIR', None) or \
+                    os.environ.get('DJANGO_DEVOPS_METRICS_DIR')
+                _STORE = DirectoryStore(directory) if directory else MemoryStore()
+    return _STORE
+
+
+@lru_cache(maxsize=4096)
+def metric_key(kind, name, labels=()):
+    '''
+    Returns the store key of a metric, labels is a tuple of (name, value) pairs.
+    '''
+    return json.dumps([kind, name, sorted(labels)], separators=(',', ':'))
+
+
+def observe_request(view, method, status, duration):
+    '''
+    Counts a finished request and adds its duration to the histogram of its view.
+    '''
+    store = get_store()
+    store.inc(metric_key('counter', REQUESTS, (
+        ('method', method), ('status', str(status)), ('view', view)
+    )))
+
+    bucket = BUCKET_LABELS[bisect.bisect_left(BUCKETS, duration)]
+    store.inc(metric_key('histogram', f'{DURATION}_bucket', (('le', bucket), ('view', view))))
+    store.inc(metric_key('histogram', f'{DURATION}_sum', (('view', view),)), duration)
+
+
+def track_in_progress(delta):
+    '''
+    Adds delta to the requests in progress of the current process.
+    '''
+    get_store().inc(metric_key('gauge', IN_PROGRESS), delta)
+
+
+def _escape(value):
+    '''
+    Escapes a label value for the text format.
+    '''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    '''
+    Formats labels as {name="value",...}.
+    '''
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _group(collected):
+    '''
+    Sorts the collected values into counters, gauges, histogram buckets and histogram sums.
+    '''
+    counters = {}
+    gauges = {IN_PROGRESS: {(): 0.0}}
+    buckets = {}
+    sums = {}
+
+    for key, value in collected.items():
+        kind, name, labels = json.loads(key)
+        labels = tuple(tuple(label) for label in labels)
+        if kind == 'counter':
+            counters.setdefault(name, {})[labels] = value
+        elif kind == 'gauge':
+            gauges.setdefault(name, {})[labels] = value
+        elif name.endswith('_bucket'):
+            le = dict(labels)['le']
+            series = tuple(label for label in labels if label[0] != 'le')
+            buckets.setdefault(series, {})[le] = value
+        else:
+            sums[labels] = value
+    return counters, gauges, buckets, sums
+
+
+def _histogram_lines(buckets, sums):
+    '''
+    Returns the lines of the request duration histogram, with cumulative buckets.
+    '''
+    lines = []
+    if buckets:
+        lines.append(f'# HELP {DURATION} {HELP[DURATION]}')
+        lines.append(f'# TYPE {DURATION} histogram')
+    for series, counts in sorted(buckets.items()):
+        total = 0.0
+        for bucket in BUCKET_LABELS:
+            total += counts.get(bucket, 0.0)
+            lines.append(f'{DURATION}_bucket{_labels(series + (("le", bucket),))} {total}')
+        lines.append(f'{DURATION}_sum{_labels(series)} {sums.get(series, 0.0)}')
+        lines.append(f'{DURATION}_count{_labels(series)} {total}')
+    return lines
+
+
+def exposition():
+    '''
+    Returns the metrics of every process in the Prometheus text format.
+    Histogram buckets are stored on their own and made cumulative here.
+    '''
+    counters, gauges, buckets, sums = _group(get_store().collect())
+
+    lines = []
+    for kind, metrics in (('counter', counters), ('gauge', gauges)):
+        for name, series in sorted(metrics.items()):
+            lines.append(f'# HELP {name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(series.items()):
+                lines.append(f'{name}{_labels(labels)} {value}')
+
+    lines.extend(_histogram_lines(buckets, sums))
+    return '\n'.join(lines) + '\n'
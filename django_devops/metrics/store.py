@@ -0,0 +1,242 @@
+'''
+Metric values shared between the worker processes of a server.
+
+Each process writes its values to its own memory mapped file in a shared directory and
+readers add up the files of every process. The files of processes that exited are
+merged into a single archive so the directory does not grow with every recycled worker.
+Gauges only describe live processes, so the gauges of exited processes are dropped.
+'''
+
+import os
+import json
+import mmap
+import glob
+import fcntl
+import struct
+import threading
+from collections import Counter
+
+USED = struct.Struct('Q')
+KEY_LENGTH = struct.Struct('I')
+VALUE = struct.Struct('d')
+
+INITIAL_SIZE = 64 * 1024
+FILE_PATTERN = 'metrics_{pid}.db'
+ARCHIVE_FILE = 'archive.json'
+LOCK_FILE = 'collect.lock'
+
+
+def _align(offset):
+    '''
+    Aligns a value offset to 8 bytes.
+    '''
+    return (offset + 7) & ~7
+
+
+def iter_entries(buffer, used):
+    '''
+    Yields (key, value, value offset) for every entry of a metrics file.
+    '''
+    position = USED.size
+    while position < used:
+        (length,) = KEY_LENGTH.unpack_from(buffer, position)
+        key_start = position + KEY_LENGTH.size
+        key = bytes(buffer[key_start:key_start + length]).decode('UTF-8')
+        value_offset = _align(key_start + length)
+        (value,) = VALUE.unpack_from(buffer, value_offset)
+        yield key, value, value_offset
+        position = value_offset + VALUE.size
+
+
+def read_values(path):
+    '''
+    Returns the [(key, value)] stored in a metrics file.
+    '''
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < USED.size:
+            return []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            (used,) = USED.unpack_from(buffer, 0)
+            return [(key, value) for key, value, _ in iter_entries(buffer, used)]
+
+
+def is_gauge(key):
+    '''
+    True for the keys of gauges, see metrics.metric_key.
+    '''
+    return key.startswith('["gauge"')
+
+
+def pid_alive(pid):
+    '''
+    True if a process with the given pid is running.
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Only written through inc(), the files are read by iter_entries() without an instance.
+class MmapFile:  # pylint: disable=too-few-public-methods
+    '''
+    The metrics file of a single process.
+    Entries are a key length, the key and an 8 byte aligned double. The number of used
+    bytes at the start of the file is written last, so readers never see partial entries.
+    '''
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+b')  # pylint: disable=consider-using-with
+
+        if os.fstat(self._file.fileno()).st_size < INITIAL_SIZE:
+            self._file.truncate(INITIAL_SIZE)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+
+        self._used = USED.unpack_from(self._mmap, 0)[0] or USED.size
+        self._positions = {key: offset for key, _, offset in iter_entries(self._mmap, self._used)}
+
+    def _grow(self, size):
+        '''
+        Doubles the file until it can hold size bytes.
+        '''
+        new_size = len(self._mmap)
+        while new_size < size:
+            new_size *= 2
+        self._mmap.close()
+        self._file.truncate(new_size)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+
+    def _position(self, key):
+        '''
+        Returns the value offset of a key, adding the key if it is new.
+        '''
+        position = self._positions.get(key)
+        if position is not None:
+            return position
+
+        encoded = key.encode('UTF-8')
+        key_start = self._used + KEY_LENGTH.size
+        position = _align(key_start + len(encoded))
+        end = position + VALUE.size
+        if end > len(self._mmap):
+            self._grow(end)
+
+        KEY_LENGTH.pack_into(self._mmap, self._used, len(encoded))
+        self._mmap[key_start:key_start + len(encoded)] = encoded
+        VALUE.pack_into(self._mmap, position, 0.0)
+        self._used = end
+        USED.pack_into(self._mmap, 0, self._used)
+
+        self._positions[key] = position
+        return position
+
+    def inc(self, key, amount=1.0):
+        '''
+        Adds amount to the value of a key.
+        '''
+        with self._lock:
+            position = self._position(key)
+            (value,) = VALUE.unpack_from(self._mmap, position)
+            VALUE.pack_into(self._mmap, position, value + amount)
+
+
+class MemoryStore:
+    '''
+    Keeps the values of a single process, used when no metrics directory is configured.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = Counter()
+
+    def inc(self, key, amount=1.0):
+        '''
+        Adds amount to the value of a key.
+        '''
+        with self._lock:
+            self._values[key] += amount
+
+    def collect(self):
+        '''
+        Returns {key: value}.
+        '''
+        with self._lock:
+            return dict(self._values)
+
+
+class DirectoryStore:
+    '''
+    Keeps the values of every process using the same directory.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+
+    def _current_file(self):
+        '''
+        Returns the file of the current process, opening a new one after a fork.
+        '''
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    os.makedirs(self.directory, exist_ok=True)
+                    path = os.path.join(self.directory, FILE_PATTERN.format(pid=pid))
+                    self._file = MmapFile(path)
+                    self._pid = pid
+        return self._file
+
+    def inc(self, key, amount=1.0):
+        '''
+        Adds amount to the value of a key for the current process.
+        '''
+        self._current_file().inc(key, amount)
+
+    def collect(self):
+        '''
+        Returns {key: value} summed over every process, merging exited processes into the archive.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+
+        with open(os.path.join(self.directory, LOCK_FILE), 'a', encoding='UTF-8') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            try:
+                with open(archive_path, 'r', encoding='UTF-8') as archive_file:
+                    archive = Counter(json.load(archive_file))
+            except (FileNotFoundError, ValueError):
+                archive = Counter()
+
+            totals = Counter(archive)
+            exited = []
+            for path in glob.glob(os.path.join(self.directory, FILE_PATTERN.format(pid='*'))):
+                pid = int(os.path.basename(path)[len('metrics_'):-len('.db')])
+                alive = pid == os.getpid() or pid_alive(pid)
+
+                for key, value in read_values(path):
+                    if alive:
+                        totals[key] += value
+                    elif not is_gauge(key):
+                        totals[key] += value
+                        archive[key] += value
+
+                if not alive:
+                    exited.append(path)
+
+            if exited:
+                tmp_path = f'{archive_path}.tmp'
+                with open(tmp_path, 'w', encoding='UTF-8') as archive_file:
+                    json.dump(archive, archive_file)
+                os.replace(tmp_path, archive_path)
+                for path in exited:
+                    os.remove(path)
+
+        return dict(totals)
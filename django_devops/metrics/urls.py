@@ -0,0 +1,11 @@
+'''
+Include with path('', include('django_devops.metrics.urls')) to serve /metrics.
+'''
+
+from django.urls import path
+
+from django_devops.metrics.views import metrics_view
+
+urlpatterns = [
+    path('metrics', metrics_view, name='django_devops_metrics'),
+]
@@ -0,0 +1,18 @@
+'''
+Serves the metrics of every worker to Prometheus.
+'''
+
+from django.http import HttpResponse
+from django.views.decorators.cache import never_cache
+
+from django_devops.metrics import exposition
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+@never_cache
+def metrics_view(request):  # pylint: disable=unused-argument
+    '''
+    Returns the metrics in the Prometheus text format.
+    '''
+    return HttpResponse(exposition(), content_type=CONTENT_TYPE)
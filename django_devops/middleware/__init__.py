@@ -0,0 +1,3 @@
+'''
+Middleware to observe the application deployed by django_devops.
+'''
@@ -0,0 +1,47 @@
+'''
+Request latency, status and concurrency metrics.
+
+Add "django_devops.middleware.metrics.MetricsMiddleware" at the top of MIDDLEWARE and
+include "django_devops.metrics.urls" in the URLconf, see django_devops.metrics.
+'''
+
+import time
+
+from django_devops.metrics import observe_request, track_in_progress
+
+# Other methods are counted together so clients can not create new series.
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+def view_name(request):
+    '''
+    Returns the name of the view that handled the request, requests that did not
+    resolve share one name so 404s can not create new series.
+    '''
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return match.view_name or match.route or '<unnamed>'
+
+
+# Django middleware is a callable, __call__ is its whole interface.
+class MetricsMiddleware:  # pylint: disable=too-few-public-methods
+    '''
+    Records the duration and status of every request.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        track_in_progress(1)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            track_in_progress(-1)
+
+        method = request.method if request.method in METHODS else 'other'
+        observe_request(view_name(request), method, response.status_code,
+                        time.perf_counter() - start)
+        return response
@@ -0,0 +1,135 @@
+'''
+Per request database query profiling with N+1 detection.
+
+Add "django_devops.middleware.queries.QueryProfilerMiddleware" to MIDDLEWARE and
+configure it with the DJANGO_DEVOPS_QUERY_PROFILER setting:
+
+    DJANGO_DEVOPS_QUERY_PROFILER = {
+        'SAMPLE_RATE': 0.01,          # Share of requests that are profiled.
+        'SLOW_REQUEST_MS': 500,       # Report requests slower than this...
+        'QUERY_COUNT_THRESHOLD': 50,  # ...or running more queries than this...
+        'N_PLUS_ONE_THRESHOLD': 5,    # ...or repeating one query this many times.
+        'SINK': None,                 # Dotted path of a callable receiving each report.
+    }
+'''
+
+import re
+import json
+import time
+import random
+from collections import Counter
+from contextlib import ExitStack
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from django_devops.utils.logger import log
+
+DEFAULTS = {
+    'SAMPLE_RATE': 0.01,
+    'SLOW_REQUEST_MS': 500,
+    'QUERY_COUNT_THRESHOLD': 50,
+    'N_PLUS_ONE_THRESHOLD': 5,
+    'SINK': None,
+}
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+IN_LIST = re.compile(r'\bIN\s*\((?:\s*(?:%s|\?)\s*,?)+\)', re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=2048)
+def fingerprint(sql):
+    '''
+    Normalizes a SQL statement so that queries differing only in their values match.
+    '''
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = IN_LIST.sub('IN (...)', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+
+# An execute_wrapper is any callable, __call__ is its whole interface.
+class QueryRecorder:  # pylint: disable=too-few-public-methods
+    '''
+    A connection.execute_wrapper that counts and times the queries of a request.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+
+def log_report(report):
+    '''
+    The default sink, writes the report as a single JSON line through the logger.
+    '''
+    log(f'Query profile {json.dumps(report, sort_keys=True)}', 'WARNING')
+
+
+# Django middleware is a callable, __call__ is its whole interface.
+class QueryProfilerMiddleware:  # pylint: disable=too-few-public-methods
+    '''
+    Records the query count, database time and repeated queries of sampled requests,
+    and reports the requests that cross one of the configured thresholds.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        config = dict(DEFAULTS, **getattr(settings, 'DJANGO_DEVOPS_QUERY_PROFILER', {}))
+        self.sample_rate = config['SAMPLE_RATE']
+        self.slow_request = config['SLOW_REQUEST_MS'] / 1000
+        self.query_count_threshold = config['QUERY_COUNT_THRESHOLD']
+        self.n_plus_one_threshold = config['N_PLUS_ONE_THRESHOLD']
+        self.sink = import_string(config['SINK']) if config['SINK'] else log_report
+
+        # Removes the middleware entirely instead of adding a check to every request.
+        if self.sample_rate <= 0:
+            raise MiddlewareNotUsed('Query profiling is disabled (SAMPLE_RATE is 0).')
+
+    def __call__(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        repeated = [
+            {'sql': sql, 'count': count}
+            for sql, count in recorder.fingerprints.most_common()
+            if count >= self.n_plus_one_threshold
+        ]
+
+        if repeated or duration >= self.slow_request or \
+                recorder.count >= self.query_count_threshold:
+            self.sink({
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round(duration * 1000, 2),
+                'query_count': recorder.count,
+                'query_ms': round(recorder.duration * 1000, 2),
+                'n_plus_one': repeated,
+            })
+
+        return response
@@ -34,6 +34,7 @@ pip3 install --force-reinstall --upgrade --upgrade-strategy=only-if-needed -r re
 
 echo "Collecting static files..."
 python3 "$dir_path"/manage.py collectstatic --noinput
+python3 "$dir_path"/manage.py precompress_static
 
 echo "Applying migrations..."
 python3 "$dir_path"/manage.py migrate
@@ -49,10 +50,16 @@ python3 "$dir_path"/manage.py update_services
 
 
 # ---------------------------------------------------------------------------- #
-#                               Restart Services                               #
+#                               Reload Services                                #
 # ---------------------------------------------------------------------------- #
 
-echo "Restarting gunicorn..."
-systemctl restart gunicorn
+# A preloaded application only loads new code when the master process restarts.
+if grep -q '^preload_app = True' /etc/conf.d/gunicorn.conf.py 2>/dev/null; then
+    echo "Restarting gunicorn..."
+    systemctl restart gunicorn
+else
+    echo "Reloading gunicorn..."
+    systemctl reload-or-restart gunicorn
+fi
 
 echo "Update completed successfully." >&3
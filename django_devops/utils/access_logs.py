@@ -0,0 +1,199 @@
+'''
+Streams access logs in the format written by the gunicorn and nginx configs of django_devops.
+
+Both use the combined log format followed by "rt=<request time>" and, for nginx,
+"urt=<upstream response time>". Files are read line by line and latencies are kept in
+log scale histograms, so the memory used does not depend on the size of the logs.
+'''
+
+import io
+import re
+import sys
+import gzip
+import math
+import heapq
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+
+LINE = re.compile(
+    r'\[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<url>\S+)[^"]*" (?P<status>\d{3}) '
+    # A retried request logs every upstream, e.g. "urt=0.5, 0.3 : 0.1".
+    r'.*? rt=(?P<request_time>[\d.]+)(?: urt=(?P<upstream_time>.+?))?\s*$'
+)
+
+# Each histogram bucket is 5% wider than the previous one, percentiles are within 5%.
+BUCKET_GROWTH = 1.05
+LOG_GROWTH = math.log(BUCKET_GROWTH)
+MIN_LATENCY = 0.0001
+
+
+@lru_cache(maxsize=1024)
+def _day_start(day, zone):
+    '''
+    Returns the epoch seconds of the start of a "10/Oct/2000" day in the given zone.
+    '''
+    return int(datetime.strptime(f'{day} {zone}', '%d/%b/%Y %z').timestamp())
+
+
+def parse_time(text):
+    '''
+    Returns the epoch seconds of a "10/Oct/2000:13:55:36 -0700" timestamp.
+    Only the day is parsed by strptime, which is slow, and cached.
+    '''
+    return _day_start(text[:11], text[21:]) + \
+        int(text[12:14]) * 3600 + int(text[15:17]) * 60 + int(text[18:20])
+
+
+def upstream_seconds(value):
+    '''
+    Returns nginx's $upstream_response_time in seconds, adding the time of every
+    upstream that was tried. Returns None if no upstream was contacted.
+    '''
+    if not value or value == '-':
+        return None
+    if ',' not in value and ':' not in value:
+        return float(value)
+    total = 0.0
+    for part in re.split(r'[,:]\s*', value):
+        if part not in ('', '-'):
+            total += float(part)
+    return total
+
+
+class LatencyHistogram:
+    '''
+    A fixed resolution histogram of latencies in seconds.
+    '''
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        '''
+        Adds one latency.
+        '''
+        self.buckets[int(math.log(max(seconds, MIN_LATENCY) / MIN_LATENCY) / LOG_GROWTH)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def merge(self, other):
+        '''
+        Adds the latencies of another histogram.
+        '''
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+
+    def percentile(self, percent):
+        '''
+        Returns the upper bound of the bucket holding the given percentile.
+        '''
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return MIN_LATENCY * BUCKET_GROWTH ** (bucket + 1)
+        return 0.0
+
+
+# A record of the statistics, each field is documented below.
+class LogStats:  # pylint: disable=too-many-instance-attributes
+    '''
+    The statistics of one or more access logs.
+        routes            - {route: LatencyHistogram}
+        upstream          - LatencyHistogram of the upstream response times
+        errors            - {route: responses with a 5xx status}
+        throughput        - {interval start: requests}
+        throughput_errors - {interval start: responses with a 5xx status}
+        slowest           - heap of the slowest (request time, url, status)
+    '''
+
+    def __init__(self, interval=3600, top=10):
+        self.interval = interval
+        self.top = top
+        self.routes = {}
+        self.upstream = LatencyHistogram()
+        self.errors = Counter()
+        self.throughput = Counter()
+        self.throughput_errors = Counter()
+        self.slowest = []
+        self.lines = 0
+        self.skipped = 0
+
+    def add(self, route, match):
+        '''
+        Adds a parsed log line for the given route.
+        '''
+        request_time = float(match['request_time'])
+        status = int(match['status'])
+
+        histogram = self.routes.get(route)
+        if histogram is None:
+            histogram = self.routes[route] = LatencyHistogram()
+        histogram.add(request_time)
+
+        upstream_time = upstream_seconds(match['upstream_time'])
+        if upstream_time is not None:
+            self.upstream.add(upstream_time)
+
+        interval_start = parse_time(match['time']) // self.interval * self.interval
+        self.throughput[interval_start] += 1
+        if status >= 500:
+            self.errors[route] += 1
+            self.throughput_errors[interval_start] += 1
+
+        entry = (request_time, match['url'], status)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def merge(self, other):
+        '''
+        Adds the statistics of another LogStats, e.g. one built by another process.
+        '''
+        for route, histogram in other.routes.items():
+            self.routes.setdefault(route, LatencyHistogram()).merge(histogram)
+        self.upstream.merge(other.upstream)
+        self.errors.update(other.errors)
+        self.throughput.update(other.throughput)
+        self.throughput_errors.update(other.throughput_errors)
+        self.slowest = heapq.nlargest(self.top, self.slowest + other.slowest)
+        heapq.heapify(self.slowest)
+        self.lines += other.lines
+        self.skipped += other.skipped
+
+
+def read_lines(path):
+    '''
+    Yields the lines of a plain or gzip compressed log, "-" reads stdin.
+    '''
+    if path == '-':
+        yield from io.TextIOWrapper(sys.stdin.buffer, encoding='UTF-8', errors='replace')
+        return
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='UTF-8', errors='replace') as log_file:
+        yield from log_file
+
+
+def analyze_lines(lines, route_of, interval=3600, top=10):
+    '''
+    Returns the LogStats of the given lines, route_of maps a path to its route.
+    Lines that are not in the expected format are counted as skipped.
+    '''
+    stats = LogStats(interval, top)
+    for line in lines:
+        stats.lines += 1
+        match = LINE.search(line)
+        if match is None:
+            stats.skipped += 1
+            continue
+        stats.add(route_of(match['url'].split('?', 1)[0]), match)
+    return stats
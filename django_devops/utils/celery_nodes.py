@@ -0,0 +1,78 @@
+'''
+Reads the per-node options of a "celery multi" environment file.
+'''
+
+import shlex
+
+# Variables that only describe which nodes run and how, all others apply to every node.
+NODE_VARIABLES = ('CELERYD_NODES', 'CELERYD_OPTS')
+
+
+def parse_options(opts: str) -> list:
+    '''
+    Splits a CELERYD_OPTS value into (option, [node names]) pairs.
+    Options are (name, value) tuples, positional arguments are returned as they are.
+    The node names of an option without a ":node" namespace are empty.
+    '''
+    args = shlex.split(opts)
+    options = []
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        index += 1
+        if not arg.startswith('-'):
+            options.append((arg, []))
+            continue
+
+        key, equals, value = arg.partition('=')
+        if not equals and index < len(args) and not args[index].startswith('-'):
+            value = args[index]
+            index += 1
+        name, _, namespace = key.partition(':')
+        options.append(((name, value), namespace.split(',') if namespace else []))
+    return options
+
+
+def node_options(env: dict) -> dict:
+    '''
+    Returns the effective CELERYD_OPTS of each node in CELERYD_NODES.
+    Options namespaced with celery multi's "-c:node" syntax only apply to that node.
+    '''
+    nodes = env.get('CELERYD_NODES', '').split()
+    shared = []
+    per_node = {node: [] for node in nodes}
+
+    for option, targets in parse_options(env.get('CELERYD_OPTS', '')):
+        if not targets:
+            shared.append(option)
+        for target in targets:
+            if target in per_node:
+                per_node[target].append(option)
+            elif target.replace('-', '').isdigit():
+                # Numeric ranges ("-c:1-3") are treated as applying to every node.
+                for node in nodes:
+                    per_node[node].append(option)
+
+    return {node: shared + per_node[node] for node in nodes}
+
+
+def changed_nodes(old_env: dict, new_env: dict):
+    '''
+    Compares two versions of a celery environment file.
+    Returns the (added, changed, removed) node names.
+    '''
+    old_nodes = node_options(old_env)
+    new_nodes = node_options(new_env)
+
+    shared_changed = any(
+        old_env.get(key) != new_env.get(key)
+        for key in set(old_env) | set(new_env) if key not in NODE_VARIABLES
+    )
+
+    added = [node for node in new_nodes if node not in old_nodes]
+    removed = [node for node in old_nodes if node not in new_nodes]
+    changed = [
+        node for node in new_nodes
+        if node in old_nodes and (shared_changed or old_nodes[node] != new_nodes[node])
+    ]
+    return added, changed, removed
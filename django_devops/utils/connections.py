@@ -0,0 +1,53 @@
+'''
+Counts the database connections the generated gunicorn and celery configs can open.
+Django opens one connection per thread, so every worker thread and every celery
+child process or thread is a client of the database.
+'''
+
+import os
+import runpy
+
+from django_devops.utils.celery_nodes import node_options
+from django_devops.utils.systemd import parse_env_file
+
+
+def gunicorn_settings(config_path):
+    '''
+    Returns the settings of a gunicorn.conf.py, or an empty dict if it does not exist.
+    '''
+    if not os.path.exists(config_path):
+        return {}
+    return runpy.run_path(config_path)
+
+
+def gunicorn_clients(config_path):
+    '''
+    Returns workers x threads of a gunicorn.conf.py, or 0 if it does not exist.
+    '''
+    config = gunicorn_settings(config_path)
+    if not config:
+        return 0
+    return int(config.get('workers', 1)) * int(config.get('threads', 1))
+
+
+def node_concurrency(options):
+    '''
+    Returns the concurrency of a celery node from its (option, value) pairs,
+    the maximum for --autoscale and the CPU count (celery's default) if it is not set.
+    '''
+    concurrency = os.cpu_count() or 1
+    for name, value in options:
+        if name in ('-c', '--concurrency') and value:
+            concurrency = int(value)
+        elif name == '--autoscale' and value:
+            concurrency = int(value.split(',')[0])
+    return concurrency
+
+
+def celery_clients(env_path):
+    '''
+    Returns the total concurrency of the nodes in a celery environment file,
+    or 0 if it does not exist.
+    '''
+    env = parse_env_file(env_path)
+    return sum(node_concurrency(options) for options in node_options(env).values())
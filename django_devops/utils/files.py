@@ -0,0 +1,89 @@
+'''
+Helpers for writing the files generated by the prep_* commands and the files they deploy.
+'''
+
+import os
+import stat
+import tempfile
+from os.path import exists
+from textwrap import dedent
+
+from django.core.management.base import CommandError
+
+from django_devops.utils.logger import span
+from django_devops.utils.user_input import query_yes_no
+
+
+def generate_file(file_path, file_template):
+    '''
+    Generates a file from a template.
+    '''
+    if exists(file_path):
+        if query_yes_no(f'{file_path} exists. Overwrite?'):
+            pass
+        else:
+            raise CommandError(f'{file_path} will not be overwritten.')
+
+    with span('generate_file', path=file_path), open(file_path, 'w+', encoding='UTF-8') as file:
+        file.seek(0)
+        file.write(dedent(file_template))
+        file.truncate()
+
+
+def fsync_directory(dir_path):
+    '''
+    Flushes a directory so that files renamed into it survive a crash.
+    '''
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_temp_file(dst_path, content, mode_from=None, mode=None):
+    '''
+    Writes content to a hidden temporary file next to dst_path and flushes it to disk.
+    The file gets the mode and owner of dst_path, or the mode of mode_from if dst_path
+    does not exist yet. mode overrides both. Returns the path of the temporary file.
+    '''
+    dir_path, name = os.path.split(dst_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=f'.{name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            try:
+                current = os.stat(dst_path)
+            except FileNotFoundError:
+                current = None
+
+            if mode is not None:
+                os.fchmod(tmp_file.fileno(), mode)
+            elif current is not None:
+                os.fchmod(tmp_file.fileno(), stat.S_IMODE(current.st_mode))
+                try:
+                    os.fchown(tmp_file.fileno(), current.st_uid, current.st_gid)
+                except PermissionError:
+                    pass
+            else:
+                os.fchmod(
+                    tmp_file.fileno(),
+                    stat.S_IMODE(os.stat(mode_from).st_mode) if mode_from else 0o644
+                )
+
+            tmp_file.write(content)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def atomic_write(dst_path, content, mode_from=None, mode=None):
+    '''
+    Replaces dst_path with content in a single step, readers see the old or the new file
+    but never a partially written one.
+    '''
+    tmp_path = write_temp_file(dst_path, content, mode_from, mode)
+    os.replace(tmp_path, dst_path)
+    fsync_directory(os.path.dirname(dst_path) or '.')
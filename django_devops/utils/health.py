@@ -0,0 +1,231 @@
+""" Health checks run against the deployed services, every check is bounded by a timeout """
+
+import re
+import time
+import socket
+import statistics
+import subprocess
+import http.client
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    An HTTPConnection to a server listening on a unix socket, e.g. gunicorn.
+    """
+
+    def __init__(self, socket_path: str, host: str = 'localhost', timeout: float = 5):
+        super().__init__(host, timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def probe_http(socket_path: str, url: str, host: str, timeout: float) -> tuple:
+    """
+    Sends one GET request over a unix socket.
+    Returns (status, seconds), raises OSError or http.client.HTTPException on failure.
+    """
+    connection = UnixHTTPConnection(socket_path, host, timeout)
+    start = time.perf_counter()
+    try:
+        connection.request('GET', url, headers={'Host': host, 'User-Agent': 'django_devops'})
+        response = connection.getresponse()
+        response.read()
+    finally:
+        connection.close()
+    return response.status, time.perf_counter() - start
+
+
+def wait_for_http(
+        socket_path: str, url: str, host: str, timeout: float = 5, startup_timeout: float = 30
+    ) -> str:
+    """
+    Waits up to startup_timeout for a healthy response (status below 400).
+    Returns None once one was received, else the last error.
+    """
+    deadline = time.monotonic() + startup_timeout
+    while True:
+        try:
+            status, _ = probe_http(socket_path, url, host, timeout)
+            if status < 400:
+                return None
+            error = f'{url} returned {status}'
+        except (OSError, http.client.HTTPException) as err:
+            error = f'{url} failed: {err}'
+        if time.monotonic() >= deadline:
+            return error
+        time.sleep(1)
+
+
+def measure_http(
+        socket_path: str, url: str, host: str, probes: int = 5, timeout: float = 5
+    ) -> tuple:
+    """
+    Sends probes requests, at least one. Returns (error, median seconds),
+    error is None if every probe was healthy.
+    """
+    if probes < 1:
+        raise ValueError(f'probes must be at least 1, got {probes}')
+
+    latencies = []
+    for _ in range(probes):
+        try:
+            status, seconds = probe_http(socket_path, url, host, timeout)
+        except (OSError, http.client.HTTPException) as err:
+            return f'{url} failed: {err}', None
+        if status >= 400:
+            return f'{url} returned {status}', None
+        latencies.append(seconds)
+    return None, statistics.median(latencies)
+
+
+# States a unit passes through while a job runs.
+TRANSITIONAL_STATES = ('activating', 'reloading', 'deactivating')
+
+
+def unit_states(units: list, timeout: float = 5) -> dict:
+    """
+    Returns {unit: (ActiveState, True if a job is queued for it)} with one systemctl call.
+    """
+    try:
+        result = subprocess.run(
+            ['systemctl', 'show', '--property=ActiveState,Job', '--', *units],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+            timeout=timeout, check=False
+        )
+    except subprocess.TimeoutExpired:
+        return {unit: ('timeout', False) for unit in units}
+
+    # One block of properties per unit, in the order they were given.
+    states = {}
+    for unit, block in zip(units, result.stdout.strip().split('\n\n')):
+        properties = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+        states[unit] = (
+            properties.get('ActiveState') or 'unknown',
+            properties.get('Job', '') not in ('', '0')
+        )
+    return states
+
+
+# Units of systemctl show's time spans, in seconds.
+TIMESPAN_UNITS = {
+    'us': 1e-6, 'ms': 1e-3, 's': 1, 'min': 60, 'h': 3600, 'd': 86400, 'w': 604800,
+    'M': 2629800, 'y': 31557600,
+}
+
+# Time for systemd to act on a job timeout, e.g. fail the unit, before a wait gives up.
+JOB_TIMEOUT_MARGIN = 5
+
+
+def parse_timespan(value: str) -> float:
+    """
+    Converts a time span printed by systemctl show, e.g. "1min 30s", to seconds.
+    Returns None for "infinity" or a value that is not a time span.
+    """
+    if not re.fullmatch(r'( ?\d+(\.\d+)?[a-zA-Z]+)+', value):
+        return None
+    parts = re.findall(r'(\d+(?:\.\d+)?)([a-zA-Z]+)', value)
+    if any(unit not in TIMESPAN_UNITS for _, unit in parts):
+        return None
+    return sum(float(number) * TIMESPAN_UNITS[unit] for number, unit in parts)
+
+
+def job_timeouts(units: list, default: float, timeout: float = 5) -> dict:
+    """
+    Returns {unit: seconds} that systemd lets a restart job of each unit run, its
+    TimeoutStopSec plus TimeoutStartSec, with one systemctl call.
+    Units with an infinite or unknown timeout get default seconds.
+    """
+    if not units:
+        return {}
+    try:
+        result = subprocess.run(
+            ['systemctl', 'show', '--property=TimeoutStartUSec,TimeoutStopUSec', '--', *units],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+            timeout=timeout, check=False
+        )
+    except subprocess.TimeoutExpired:
+        return {unit: default for unit in units}
+
+    # One block of properties per unit, in the order they were given.
+    timeouts = {unit: default for unit in units}
+    for unit, block in zip(units, result.stdout.strip().split('\n\n')):
+        properties = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+        spans = [
+            parse_timespan(properties.get(name, ''))
+            for name in ('TimeoutStopUSec', 'TimeoutStartUSec')
+        ]
+        if None not in spans:
+            timeouts[unit] = sum(spans) + JOB_TIMEOUT_MARGIN
+    return timeouts
+
+
+def wait_for_units(
+        units: list, timeout: float = 30, inactive_ok: bool = False, timeouts: dict = None
+    ) -> dict:
+    """
+    Waits for units to finish their queued jobs and leave the activating/reloading
+    states, up to timeout seconds, or the seconds of the unit in timeouts.
+    Returns {unit: (seconds until it settled, None or an error)}. A unit is fine once it
+    is active, or also inactive with inactive_ok (e.g. after "try-restart").
+    """
+    timeouts = timeouts or {}
+    limits = {unit: timeouts.get(unit, timeout) for unit in units}
+    start = time.monotonic()
+    results = {}
+    pending = list(units)
+
+    while pending:
+        states = unit_states(pending)
+        elapsed = time.monotonic() - start
+        for unit in pending:
+            state, job_queued = states.get(unit, ('unknown', False))
+            if (job_queued or state in TRANSITIONAL_STATES) and elapsed < limits[unit]:
+                continue
+            if job_queued:
+                results[unit] = (elapsed, f'{unit} is {state}, its job is still queued')
+            elif state == 'active' or (state == 'inactive' and inactive_ok):
+                results[unit] = (elapsed, None)
+            else:
+                results[unit] = (elapsed, f'{unit} is {state}')
+
+        pending = [unit for unit in pending if unit not in results]
+        if pending:
+            deadline = start + min(limits[unit] for unit in pending)
+            time.sleep(min(0.25, max(0, deadline - time.monotonic())))
+    return results
+
+
+def wait_for_unit(unit: str, timeout: float = 30) -> str:
+    """
+    Waits for a unit to leave the activating/reloading states.
+    Returns None once it is active, or an error describing the state it ended up in.
+    """
+    return wait_for_units([unit], timeout)[unit][1]
+
+
+def ping_celery_node(
+        celery_bin: str, app: str, node: str, timeout: float = 5, cwd: str = None
+    ) -> str:
+    """
+    Pings a celery node started by "celery multi" on this host through the broker.
+    Returns None if it replied, or an error.
+    """
+    destination = f'{node}@{socket.gethostname()}'
+    try:
+        result = subprocess.run(
+            [celery_bin, '-A', app, 'inspect', 'ping', '-d', destination,
+             '--timeout', str(timeout)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+            timeout=timeout + 30, check=False, cwd=cwd
+        )
+    except subprocess.TimeoutExpired:
+        return f'{destination} did not reply to ping'
+    except OSError as err:
+        return f'Unable to ping {destination}: {err}'
+    if result.returncode != 0:
+        return f'{destination} did not reply to ping'
+    return None
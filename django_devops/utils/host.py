@@ -0,0 +1,109 @@
+'''
+Probes the host for the resources available to the services django_devops configures.
+'''
+
+import math
+import os
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+MEMINFO_FILE = '/proc/meminfo'
+
+
+def _read_first_line(path):
+    '''
+    Returns the first line of a file, or None if it cannot be read.
+    '''
+    try:
+        with open(path, 'r', encoding='UTF-8') as file:
+            return file.readline().strip()
+    except OSError:
+        return None
+
+
+def cpu_count() -> int:
+    '''
+    Returns the number of CPUs this process is allowed to run on.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def cgroup_cpu_limit() -> float:
+    '''
+    Returns the CPU quota of the current cgroup in CPUs (e.g. 1.5), or None if unlimited.
+    Supports both cgroup v2 (cpu.max) and v1 (cpu.cfs_quota_us).
+    '''
+    cpu_max = _read_first_line(os.path.join(CGROUP_ROOT, 'cpu.max'))
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+        return None
+
+    quota = _read_first_line(os.path.join(CGROUP_ROOT, 'cpu', 'cpu.cfs_quota_us'))
+    period = _read_first_line(os.path.join(CGROUP_ROOT, 'cpu', 'cpu.cfs_period_us'))
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def effective_cpus() -> int:
+    '''
+    Returns the number of CPUs that can actually be used, taking the cgroup quota into account.
+    '''
+    cpus = cpu_count()
+    quota = cgroup_cpu_limit()
+    if quota:
+        cpus = min(cpus, math.ceil(quota))
+    return max(cpus, 1)
+
+
+def cgroup_memory_limit() -> int:
+    '''
+    Returns the memory limit of the current cgroup in bytes, or None if unlimited.
+    '''
+    limit = _read_first_line(os.path.join(CGROUP_ROOT, 'memory.max'))
+    if limit is None:
+        limit = _read_first_line(os.path.join(CGROUP_ROOT, 'memory', 'memory.limit_in_bytes'))
+
+    # cgroup v1 reports "unlimited" as a very large number.
+    if not limit or limit == 'max' or int(limit) >= 2 ** 60:
+        return None
+    return int(limit)
+
+
+def available_memory() -> int:
+    '''
+    Returns the memory available for new processes in bytes.
+    Uses MemAvailable from /proc/meminfo, capped by the cgroup limit.
+    '''
+    available = None
+    try:
+        with open(MEMINFO_FILE, 'r', encoding='UTF-8') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+
+    if available is None and hasattr(os, 'sysconf'):
+        try:
+            available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+        except (ValueError, OSError):
+            pass
+
+    limit = cgroup_memory_limit()
+    if limit and (available is None or limit < available):
+        return limit
+    return available
+
+
+def describe_host() -> str:
+    '''
+    Returns a short description of the host resources, used in generated file headers.
+    '''
+    memory = available_memory()
+    memory_text = f'{memory / 2 ** 30:.1f} GiB' if memory else 'unknown'
+    return f'{effective_cpus()} CPUs, {memory_text} available memory'
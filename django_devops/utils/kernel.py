@@ -0,0 +1,206 @@
+'''
+Kernel limits that have to match the listen backlogs and connection counts of gunicorn
+and nginx, otherwise the kernel silently caps them and drops connections under load.
+'''
+
+import os
+import re
+
+from django_devops.utils.connections import gunicorn_settings
+from django_devops.utils.host import cpu_count
+from django_devops.utils.systemd import parse_unit_file, unit_directive
+
+SYSCTL_ROOT = '/proc/sys'
+NGINX_CONF = '/etc/nginx/nginx.conf'
+
+# nginx's own defaults, used when nginx.conf does not set a value.
+NGINX_DEFAULTS = {'worker_processes': 1, 'worker_connections': 512, 'worker_rlimit_nofile': None}
+NGINX_BACKLOG = 511
+GUNICORN_BACKLOG = 2048
+
+# Parameters compared by the consistency report.
+REPORTED_SYSCTLS = ('net.core.somaxconn', 'net.ipv4.tcp_max_syn_backlog', 'fs.file-max')
+
+# Parameters picked by tune_kernel, compared with their running values.
+TUNED_SYSCTLS = (
+    'net.core.somaxconn', 'net.ipv4.tcp_max_syn_backlog', 'net.core.netdev_max_backlog',
+    'net.ipv4.ip_local_port_range', 'net.ipv4.ip_local_reserved_ports', 'net.ipv4.tcp_tw_reuse',
+    'fs.file-max',
+)
+
+# Default ports of the local services a project talks to:
+# PostgreSQL, pgbouncer, Redis and memcached.
+SERVICE_PORTS = (5432, 6432, 6379, 11211)
+
+
+def read_sysctl(name):
+    '''
+    Returns the current value of a kernel parameter, or None if it does not exist.
+    '''
+    try:
+        with open(os.path.join(SYSCTL_ROOT, *name.split('.')), 'r', encoding='UTF-8') as file:
+            return ' '.join(file.read().split())
+    except OSError:
+        return None
+
+
+def nginx_settings(path=NGINX_CONF):
+    '''
+    Returns the worker settings of nginx.conf, with nginx's defaults for missing ones.
+    '''
+    settings = dict(NGINX_DEFAULTS)
+    try:
+        with open(path, 'r', encoding='UTF-8') as conf_file:
+            conf = conf_file.read()
+    except OSError:
+        return settings
+
+    for name in settings:
+        match = re.search(rf'^\s*{name}\s+(\w+)\s*;', conf, re.MULTILINE)
+        if match:
+            value = match.group(1)
+            settings[name] = cpu_count() if value == 'auto' else int(value)
+    return settings
+
+
+def gunicorn_backlog(config_path, socket_path):
+    '''
+    Returns the larger backlog of a gunicorn.conf.py and its gunicorn.socket,
+    or gunicorn's default if neither sets one.
+    '''
+    backlogs = [int(gunicorn_settings(config_path).get('backlog', 0))]
+    backlogs += [int(value) for value in
+                 unit_directive(parse_unit_file(socket_path), 'Socket', 'Backlog')]
+    return max(backlogs) or GUNICORN_BACKLOG
+
+
+def configured_ports(*folder_paths):
+    '''
+    Returns the TCP ports that the generated config and service files listen on,
+    e.g. "port 6379" in redis.conf or "-p 11211" in a memcached unit.
+    '''
+    pattern = re.compile(r'^\s*(?:port|listen_port\s*=)\s*(\d+)|\s-p\s+(\d+)', re.MULTILINE)
+    ports = set()
+    for folder_path in folder_paths:
+        for file_name in sorted(os.listdir(folder_path)):
+            try:
+                with open(os.path.join(folder_path, file_name), 'r', encoding='UTF-8') as file:
+                    content = file.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+            for match in pattern.finditer(content):
+                ports.add(int(match.group(1) or match.group(2)))
+    ports.discard(0)
+    return ports
+
+
+def _raises(value, current):
+    '''
+    True if a kernel parameter value allows more than the current one, or that is unknown.
+    '''
+    if current is None:
+        return True
+    if isinstance(value, int):
+        return value > int(current)
+    low, high = (int(port) for port in value.split())
+    current_low, current_high = (int(port) for port in current.split())
+    return low < current_low or high > current_high
+
+
+def _reserve_ports(ports, port_range, reserved):
+    '''
+    Returns the ip_local_reserved_ports value that adds the ports inside the ephemeral
+    port range to the reserved ones, or None if they are reserved already.
+    '''
+    low, high = (int(port) for port in port_range.split())
+    tokens = [token for token in (reserved or '').split(',') if token]
+    covered = set()
+    for token in tokens:
+        first, _, last = token.partition('-')
+        covered.update(range(int(first), int(last or first) + 1))
+
+    missing = sorted(port for port in ports if low <= port <= high and port not in covered)
+    if not missing:
+        return None
+    return ','.join(tokens + [str(port) for port in missing])
+
+
+def tune_kernel(backlog, nginx, running, ports=SERVICE_PORTS):
+    '''
+    Picks the kernel parameters for a gunicorn listen backlog and the nginx worker settings.
+    running is {parameter: current value} as returned by read_sysctl, only parameters that
+    raise the current value are returned, the distribution's defaults are never lowered.
+    Local service ports inside the ephemeral port range are reserved.
+    Returns {parameter: value}.
+    '''
+    # listen() backlogs are capped at somaxconn, round it up to a power of two.
+    somaxconn = 4096
+    while somaxconn < max(backlog, NGINX_BACKLOG):
+        somaxconn *= 2
+
+    # nginx uses two descriptors per proxied connection.
+    nginx_files = nginx['worker_processes'] * nginx['worker_connections'] * 2
+
+    wanted = {
+        'net.core.somaxconn': somaxconn,
+        'net.ipv4.tcp_max_syn_backlog': somaxconn * 2,
+        'net.core.netdev_max_backlog': somaxconn * 4,
+        'net.ipv4.ip_local_port_range': '10240 65535',
+        'net.ipv4.tcp_tw_reuse': 1,
+        'fs.file-max': max(2097152, nginx_files * 4),
+    }
+    tuning = {
+        parameter: value for parameter, value in wanted.items()
+        if _raises(value, running.get(parameter))
+    }
+
+    # Without a reservation, outgoing connections may take the port a local service
+    # (e.g. memcached on 11211) binds to when it restarts.
+    port_range = tuning.get('net.ipv4.ip_local_port_range',
+                            running.get('net.ipv4.ip_local_port_range'))
+    if port_range:
+        reserved = _reserve_ports(ports, port_range,
+                                  running.get('net.ipv4.ip_local_reserved_ports'))
+        if reserved:
+            tuning['net.ipv4.ip_local_reserved_ports'] = reserved
+
+    return tuning
+
+
+def consistency_report(sysctl, backlog, nginx):
+    '''
+    Compares kernel parameters ({parameter: value}) with the gunicorn backlog
+    and the nginx worker settings.
+    Returns [(passed, message)].
+    '''
+    results = []
+
+    somaxconn = int(sysctl.get('net.core.somaxconn') or 0)
+    if somaxconn < backlog:
+        results.append((False, f'net.core.somaxconn is {somaxconn}, the gunicorn backlog of '
+                               f'{backlog} is capped to it'))
+    else:
+        results.append((True, f'net.core.somaxconn ({somaxconn}) fits the gunicorn backlog '
+                              f'({backlog})'))
+
+    syn_backlog = int(sysctl.get('net.ipv4.tcp_max_syn_backlog') or 0)
+    if syn_backlog < somaxconn:
+        results.append((False, f'net.ipv4.tcp_max_syn_backlog ({syn_backlog}) is below '
+                               f'net.core.somaxconn ({somaxconn})'))
+
+    needed = nginx['worker_connections'] * 2
+    rlimit = nginx['worker_rlimit_nofile']
+    if rlimit is None or rlimit < needed:
+        results.append((False, f'nginx worker_rlimit_nofile is {rlimit or "not set"}, '
+                               f'{nginx["worker_connections"]} worker_connections need {needed}'))
+    else:
+        results.append((True, f'nginx worker_rlimit_nofile ({rlimit}) fits '
+                              f'{nginx["worker_connections"]} worker_connections'))
+
+    file_max = int(sysctl.get('fs.file-max') or 0)
+    total = nginx['worker_processes'] * needed
+    if file_max and file_max < total:
+        results.append((False, f'fs.file-max ({file_max}) is below the {total} descriptors '
+                               f'nginx may open'))
+
+    return results
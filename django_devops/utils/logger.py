@@ -1,6 +1,11 @@
-""" A clean logging formatter utility """
+""" A clean logging formatter utility, with timing spans for profiling commands """
 
+import os
 import sys
+import json
+import time
+import functools
+from contextlib import contextmanager
 
 # ANSI escape codes for different colors
 COLOR_MAP = {
@@ -13,6 +18,12 @@ COLOR_MAP = {
 
 RESET_CODE = '\033[0m'
 
+# State of the running profile, see start_profile().
+# stdout holds the original sys.stdout while "--profile-json -" sends other output to stderr.
+_PROFILE = {
+    'enabled': False, 'stream': None, 'stdout': None, 'spans': [], 'depth': 0, 'start': 0.0
+}
+
 def log(message: str, level: str = "INFO") -> None:
     """
     Print a log message to stdout with colored level labels.
@@ -23,7 +34,179 @@ def log(message: str, level: str = "INFO") -> None:
                      Defaults to INFO.
     """
     level = level.upper()
+    if _PROFILE['stream'] is not None:
+        _write_json({'event': 'log', 'level': level, 'message': message})
+
     color = COLOR_MAP.get(level, '')  # Default to no color if level is unknown
     label = f"[{level}]"
     formatted_label = f"{color}{label}{RESET_CODE}" if color else label
     print(f"{formatted_label} {message}", file=sys.stdout)
+
+
+def _write_json(record: dict) -> None:
+    """
+    Writes a record as one JSON line to the profile stream, with the seconds since the
+    profile started.
+    """
+    record = {'t': round(time.monotonic() - _PROFILE['start'], 6), **record}
+    _PROFILE['stream'].write(json.dumps(record, default=str) + '\n')
+    _PROFILE['stream'].flush()
+
+
+def start_profile(json_path: str = None) -> None:
+    """
+    Starts recording spans.
+
+    Args:
+        json_path (str): Append spans and log records as JSON lines to this file,
+                         "-" writes them to stdout and everything else to stderr.
+    """
+    stream = None
+    stdout = None
+    if json_path == '-':
+        stdout = sys.stdout
+        stream = _redirect_stdout()
+    elif json_path:
+        stream = open(json_path, 'a', encoding='UTF-8')  # pylint: disable=consider-using-with
+    _PROFILE.update(
+        enabled=True, stream=stream, stdout=stdout, spans=[], depth=0, start=time.monotonic()
+    )
+
+
+def _redirect_stdout():
+    """
+    Sends everything written to stdout, also by child processes, to stderr.
+    Returns a stream to the original stdout for the JSON lines.
+    """
+    sys.stdout.flush()
+    stream = sys.stdout
+    try:
+        fd = sys.stdout.fileno()
+        stream = os.fdopen(os.dup(fd), 'w', encoding='UTF-8')
+        os.dup2(sys.stderr.fileno(), fd)
+    except (AttributeError, OSError, ValueError):
+        # Not a file, e.g. captured output, only output written by Python is redirected.
+        pass
+    sys.stdout = sys.stderr
+    return stream
+
+
+def _restore_stdout() -> None:
+    """
+    Undoes _redirect_stdout().
+    """
+    sys.stdout.flush()
+    sys.stdout = _PROFILE['stdout']
+    stream = _PROFILE['stream']
+    if stream is not sys.stdout:
+        os.dup2(stream.fileno(), sys.stdout.fileno())
+
+
+@contextmanager
+def span(name: str, **fields):
+    """
+    Times a step while a profile is running, e.g. "with span('restart', unit=unit):".
+    Spans can be nested. Steps that raise are recorded with the exception name.
+    Does nothing when no profile is running.
+    """
+    if not _PROFILE['enabled']:
+        yield
+        return
+
+    depth = _PROFILE['depth']
+    _PROFILE['depth'] = depth + 1
+    start = time.monotonic()
+    error = None
+    try:
+        yield
+    except BaseException as err:
+        error = type(err).__name__
+        raise
+    finally:
+        _PROFILE['depth'] = depth
+        if error:
+            fields['error'] = error
+        add_span(name, time.monotonic() - start, **fields)
+
+
+def add_span(name: str, seconds: float, **fields) -> None:
+    """
+    Records a step timed elsewhere, e.g. the restarts of units that ran in parallel.
+    Does nothing when no profile is running.
+    """
+    if not _PROFILE['enabled']:
+        return
+
+    record = {
+        'event': 'span', 'name': name, 'seconds': round(seconds, 6),
+        'depth': _PROFILE['depth'], **fields
+    }
+    _PROFILE['spans'].append(record)
+    if _PROFILE['stream'] is not None:
+        _write_json(record)
+
+
+def timed(name: str):
+    """
+    Decorator that runs every call of a function in a span named name.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profile_summary(limit: int = 10) -> list:
+    """
+    Groups the recorded spans by name.
+    Returns up to limit (name, calls, total seconds, slowest seconds), slowest total first.
+    Nested spans are also counted in the spans around them.
+    """
+    steps = {}
+    for record in _PROFILE['spans']:
+        calls, total, slowest = steps.get(record['name'], (0, 0.0, 0.0))
+        steps[record['name']] = (
+            calls + 1, total + record['seconds'], max(slowest, record['seconds'])
+        )
+    summary = [(name, *values) for name, values in steps.items()]
+    summary.sort(key=lambda step: step[2], reverse=True)
+    return summary[:limit]
+
+
+def finish_profile(limit: int = 10) -> None:
+    """
+    Prints a table of the slowest steps and stops recording spans.
+    The table goes to stderr when the JSON lines are written to stdout.
+    """
+    if not _PROFILE['enabled']:
+        return
+
+    elapsed = time.monotonic() - _PROFILE['start']
+    summary = profile_summary(limit)
+    stream = _PROFILE['stream']
+
+    width = max([len(name) for name, *_ in summary] + [4])
+    print(f"\n{'Step':<{width}}  {'Calls':>6}  {'Total':>9}  {'Slowest':>9}  {'Run':>5}")
+    for name, calls, total, slowest in summary:
+        share = total / elapsed * 100 if elapsed else 0
+        print(f"{name:<{width}}  {calls:>6}  {total:>8.3f}s  {slowest:>8.3f}s  {share:>4.0f}%")
+    print(f"Finished in {elapsed:.3f}s")
+
+    if stream is not None:
+        _write_json({
+            'event': 'summary', 'seconds': round(elapsed, 6),
+            'steps': [
+                {'name': name, 'calls': calls, 'seconds': round(total, 6),
+                 'slowest': round(slowest, 6)}
+                for name, calls, total, slowest in summary
+            ],
+        })
+        if _PROFILE['stdout'] is not None:
+            _restore_stdout()
+        if stream is not sys.stdout:
+            stream.close()
+
+    _PROFILE.update(enabled=False, stream=None, stdout=None, spans=[], depth=0)
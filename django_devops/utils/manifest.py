@@ -0,0 +1,67 @@
+""" A persistent record of deployed files, used to skip deployments that have not changed """
+
+import json
+import os
+
+MANIFEST_DIR = '/var/lib/django_devops'
+MANIFEST_FILE = os.path.join(MANIFEST_DIR, 'manifest.json')
+
+
+def stat_signature(path: str) -> dict:
+    """
+    Returns the size and modification time of a file, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def load_manifest(path: str = MANIFEST_FILE) -> dict:
+    """
+    Loads the manifest, returning an empty one if it is missing or unreadable.
+    """
+    try:
+        with open(path, 'r', encoding='UTF-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_manifest(manifest: dict, path: str = MANIFEST_FILE) -> None:
+    """
+    Writes the manifest, replacing the previous version in a single step.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='UTF-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def is_current(manifest: dict, src_path: str, dst_path: str) -> bool:
+    """
+    True when neither the source nor the deployed file changed since they were recorded.
+    Only the file metadata is compared, no content is read.
+    """
+    entry = manifest.get(dst_path)
+    if not entry:
+        return False
+
+    return (
+        entry.get('source') == dict(stat_signature(src_path) or {}, path=src_path)
+        and entry.get('deployed') == stat_signature(dst_path)
+    )
+
+
+def record(manifest: dict, src_path: str, dst_path: str, digest: str) -> None:
+    """
+    Records the current state of a deployed file and the source it came from.
+    """
+    manifest[dst_path] = {
+        'digest': digest,
+        'source': dict(stat_signature(src_path) or {}, path=src_path),
+        'deployed': stat_signature(dst_path),
+    }
@@ -0,0 +1,147 @@
+'''
+Audits a pinned requirements file against the installed distributions without running pip.
+'''
+
+from collections import namedtuple
+
+try:
+    from importlib import metadata
+except ImportError:  # Python < 3.8
+    import importlib_metadata as metadata
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import canonicalize_name
+from packaging.version import InvalidVersion, Version
+
+# Packaging tools that "pip freeze" leaves out as well.
+IGNORED_DISTRIBUTIONS = {'pip', 'setuptools', 'wheel', 'distribute'}
+
+RequirementsAudit = namedtuple('RequirementsAudit', ['unpinned', 'drift', 'missing', 'unlisted'])
+
+
+def installed_distributions():
+    '''
+    Returns {canonical name: (name, version)} of the installed distributions.
+    The first distribution found on sys.path wins, like it does for imports.
+    '''
+    installed = {}
+    for distribution in metadata.distributions():
+        name = distribution.metadata['Name']
+        if not name:
+            continue
+        installed.setdefault(canonicalize_name(name), (name, distribution.version))
+    return installed
+
+
+def freeze_lines(installed=None):
+    '''
+    Returns "name==version" lines for the installed distributions, like "pip freeze".
+    '''
+    installed = installed_distributions() if installed is None else installed
+    return [
+        f'{name}=={version}' for key, (name, version) in sorted(installed.items())
+        if key not in IGNORED_DISTRIBUTIONS
+    ]
+
+
+def parse_requirement(line):
+    '''
+    Returns the Requirement on a requirements file line,
+    or None for blank lines, comments, pip options and requirements for other environments.
+    '''
+    line = line.split(' #', 1)[0].strip()
+    if not line or line.startswith(('#', '-')):
+        return None
+    try:
+        requirement = Requirement(line)
+    except InvalidRequirement:
+        return None
+    if requirement.marker and not requirement.marker.evaluate():
+        return None
+    return requirement
+
+
+def pinned_version(requirement):
+    '''
+    Returns the version a requirement is pinned to with "==", or None if it is not pinned.
+    '''
+    specifiers = list(requirement.specifier)
+    if len(specifiers) == 1 and specifiers[0].operator in ('==', '===') \
+            and not specifiers[0].version.endswith('*'):
+        return specifiers[0].version
+    return None
+
+
+def same_version(pinned, installed):
+    '''
+    Compares two versions, so that e.g. 1.0 and 1.0.0 are the same.
+    '''
+    try:
+        return Version(pinned) == Version(installed)
+    except InvalidVersion:
+        return pinned == installed
+
+
+def audit_requirements(lines, installed=None):
+    '''
+    Compares the lines of a requirements file with the installed distributions in one pass.
+    Returns a RequirementsAudit of:
+        unpinned - names without an exact "==" version
+        drift    - (name, pinned version, installed version)
+        missing  - names that are pinned but not installed
+        unlisted - (name, version) installed but not in the file
+    '''
+    installed = installed_distributions() if installed is None else installed
+    unpinned, drift, missing = [], [], []
+    listed = set()
+
+    for line in lines:
+        requirement = parse_requirement(line)
+        if requirement is None:
+            continue
+
+        key = canonicalize_name(requirement.name)
+        listed.add(key)
+        version = pinned_version(requirement)
+
+        if key not in installed:
+            missing.append(requirement.name)
+        elif version is None:
+            unpinned.append(requirement.name)
+        elif not same_version(version, installed[key][1]):
+            drift.append((requirement.name, version, installed[key][1]))
+
+    unlisted = [
+        installed[key] for key in sorted(installed)
+        if key not in listed and key not in IGNORED_DISTRIBUTIONS
+    ]
+    return RequirementsAudit(unpinned, drift, missing, unlisted)
+
+
+def fixed_requirements(lines, installed=None):
+    '''
+    Returns the requirements file lines with every installed requirement pinned to its
+    installed version and the unlisted distributions appended.
+    Comments, options and the order of the file are kept.
+    '''
+    installed = installed_distributions() if installed is None else installed
+    fixed = []
+    listed = set()
+
+    for line in lines:
+        requirement = parse_requirement(line)
+        key = canonicalize_name(requirement.name) if requirement else None
+        if key in installed:
+            listed.add(key)
+            name, version = installed[key]
+            extras = f'[{",".join(sorted(requirement.extras))}]' if requirement.extras else ''
+            marker = f'; {requirement.marker}' if requirement.marker else ''
+            fixed.append(f'{name}{extras}=={version}{marker}')
+        else:
+            fixed.append(line.rstrip('\n'))
+
+    fixed.extend(
+        line for line in freeze_lines(installed)
+        if canonicalize_name(line.split('==', 1)[0]) not in listed
+    )
+    return fixed
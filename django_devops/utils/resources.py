@@ -0,0 +1,89 @@
+'''
+systemd resource controls for the units generated by the prep_* commands.
+
+Web workers get a larger share of the CPU and disk than celery workers, so a busy batch
+does not slow down requests. With the "isolated" profile they also run on separate CPUs.
+'''
+
+import os
+
+PROFILES = ('none', 'shared', 'isolated')
+
+ROLES = {
+    'web': {'CPUWeight': 200, 'IOWeight': 200, 'Nice': 0, 'LimitNOFILE': 65536},
+    'worker': {'CPUWeight': 50, 'IOWeight': 50, 'Nice': 10, 'LimitNOFILE': 16384},
+}
+
+
+def cpu_ids() -> list:
+    '''
+    Returns the ids of the CPUs this process is allowed to run on.
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_split(cpus: list) -> dict:
+    '''
+    Splits the CPUs between the roles, a third (at least one) goes to the workers.
+    Returns {role: [cpu ids]}, or an empty dict if there are too few CPUs to split.
+    '''
+    if len(cpus) < 2:
+        return {}
+    workers = max(1, len(cpus) // 3)
+    return {'web': cpus[:-workers], 'worker': cpus[-workers:]}
+
+
+def cpu_list(cpus: list) -> str:
+    '''
+    Formats CPU ids as ranges, e.g. [0, 1, 2, 5] -> "0-2 5".
+    '''
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ' '.join(str(first) if first == last else f'{first}-{last}' for first, last in ranges)
+
+
+def resource_directives(profile: str, role: str, memory_mb: int, tasks: int) -> list:
+    '''
+    Returns the [Service] directives of a profile for a unit that is expected to use
+    memory_mb of memory and run up to tasks processes and threads.
+    MemoryHigh only throttles the unit at 1.5 times the expected use, so a normal peak is
+    not slowed down, and MemoryMax is the hard cap at twice the expected use.
+    '''
+    if profile == 'none':
+        return []
+
+    settings = ROLES[role]
+    directives = [
+        f"CPUWeight = {settings['CPUWeight']}",
+        f"IOWeight = {settings['IOWeight']}",
+        f"MemoryHigh = {int(memory_mb * 1.5)}M",
+        f"MemoryMax = {memory_mb * 2}M",
+        f"TasksMax = {max(512, tasks * 2)}",
+        f"LimitNOFILE = {settings['LimitNOFILE']}",
+        f"Nice = {settings['Nice']}",
+    ]
+
+    split = cpu_split(cpu_ids()) if profile == 'isolated' else {}
+    if split:
+        directives.insert(0, f'AllowedCPUs = {cpu_list(split[role])}')
+    return directives
+
+
+def resource_block(directives: list, indent: str) -> str:
+    '''
+    Joins directives for a unit file template, placed at the end of a line in the
+    [Service] section. Explains what update_services applies to the running unit.
+    '''
+    if not directives:
+        return ''
+    lines = [
+        '# Resource controls, all but LimitNOFILE and Nice are applied to the running',
+        '# service by update_services without restarting it.',
+    ] + directives
+    return f'\n\n{indent}' + f'\n{indent}'.join(lines)
@@ -0,0 +1,114 @@
+""" Runs systemctl for batches of units and reports how long each took """
+
+import subprocess
+
+from django_devops.utils.health import job_timeouts, wait_for_units
+from django_devops.utils.logger import add_span, log, span
+
+
+def run_systemctl(args: list, units: list) -> dict:
+    """
+    Runs one systemctl command for a batch of units, e.g. ['restart', '--no-block'].
+    If the batch fails, the units are retried one at a time to find the failing ones.
+    Returns {unit: error} of the units that failed.
+    """
+    if not units:
+        return {}
+    try:
+        subprocess.run(['systemctl', *args, *units], check=True)
+        return {}
+    except subprocess.CalledProcessError as err:
+        if len(units) == 1:
+            return {units[0]: str(err)}
+
+    errors = {}
+    for unit in units:
+        try:
+            subprocess.run(['systemctl', *args, unit], check=True)
+        except subprocess.CalledProcessError as err:
+            errors[unit] = str(err)
+    return errors
+
+
+def restart_batch(commands: dict, timeout: float) -> dict:
+    """
+    Queues the jobs of independent units without waiting for each, then waits for all
+    of them together. commands is {(systemctl arguments): [units]}.
+    Each unit is waited for as long as systemd lets its job run, its TimeoutStopSec plus
+    TimeoutStartSec, or timeout seconds if those are unlimited.
+    Returns {unit: (seconds, None or an error)}.
+    """
+    results = {}
+    for args, units in commands.items():
+        for unit, error in run_systemctl([*args, '--no-block'], units).items():
+            results[unit] = (0.0, error)
+
+    for args, units in commands.items():
+        started = [unit for unit in units if unit not in results]
+        # try- commands leave units that were not running stopped.
+        results.update(wait_for_units(
+            started, timeout, inactive_ok=args[0].startswith('try-'),
+            timeouts=job_timeouts(started, timeout)
+        ))
+
+    for unit, (seconds, error) in results.items():
+        add_span('restart', seconds, unit=unit, **({'error': error} if error else {}))
+    return results
+
+
+def disable_units(units: list) -> dict:
+    """
+    Stops and disables removed units.
+    Returns {unit: (seconds, None or an error)}.
+    """
+    with span('disable', units=len(units)):
+        errors = run_systemctl(['disable', '--now'], units)
+    for unit in units:
+        if unit not in errors:
+            log(f"Stopped and disabled {unit}", "INFO")
+    return {unit: (0.0, errors.get(unit)) for unit in units}
+
+
+def enable_units(units: list) -> dict:
+    """
+    Enables units with one systemctl call.
+    Returns {unit: (seconds, error)} of the units that could not be enabled.
+    """
+    with span('enable', units=len(units)):
+        errors = run_systemctl(['enable'], units)
+    return {unit: (0.0, error) for unit, error in errors.items()}
+
+
+def set_unit_properties(live_units: dict) -> dict:
+    """
+    Applies resource controls ({unit: {property: value}}) to running units.
+    Returns {unit: (seconds, None or an error)}.
+    """
+    results = {}
+    for service, properties in live_units.items():
+        # --runtime keeps the unit file the only persistent source of the values.
+        assignments = [f"{key}={value}" for key, value in sorted(properties.items())]
+        try:
+            with span('set-property', unit=service):
+                subprocess.run(
+                    ['systemctl', 'set-property', '--runtime', service, *assignments], check=True
+                )
+        except subprocess.CalledProcessError as err:
+            results[service] = (0.0, str(err))
+            continue
+        results[service] = (0.0, None)
+        log(f"Applied {', '.join(assignments)} to {service} without a restart", "INFO")
+    return results
+
+
+def log_restarts(results: dict, units: list) -> None:
+    """
+    Logs how long the restart of each unit took, or why it failed.
+    """
+    for unit in units:
+        if unit in results:
+            seconds, error = results[unit]
+            if error is None:
+                log(f"Restarted {unit} in {seconds:.1f}s", "INFO")
+            else:
+                log(f"Restarting {unit} failed: {error}", "ERROR")
@@ -0,0 +1,193 @@
+""" Helpers for reading systemd unit files """
+
+import os
+
+
+def parse_unit_file(unit_path: str) -> dict:
+    """
+    Parses a systemd unit file into {section: {directive: [values]}}.
+    Continuation lines (ending with a backslash) are joined and comments are skipped.
+    Returns an empty dict if the file does not exist.
+    """
+    try:
+        with open(unit_path, 'r', encoding='UTF-8') as unit_file:
+            lines = unit_file.read().splitlines()
+    except FileNotFoundError:
+        return {}
+
+    sections = {}
+    section = None
+    logical_line = ''
+
+    for line in lines:
+        stripped = line.strip()
+        if not logical_line and (not stripped or stripped[0] in '#;'):
+            continue
+
+        if stripped.endswith('\\'):
+            logical_line += stripped[:-1] + ' '
+            continue
+        logical_line += stripped
+
+        if logical_line.startswith('[') and logical_line.endswith(']'):
+            section = sections.setdefault(logical_line[1:-1], {})
+        elif '=' in logical_line and section is not None:
+            key, value = logical_line.split('=', 1)
+            section.setdefault(key.strip(), []).append(value.strip())
+        logical_line = ''
+
+    return sections
+
+
+def unit_directive(unit: dict, section: str, key: str) -> list:
+    """
+    Returns every value set for a directive, or an empty list if it is not set.
+    """
+    return unit.get(section, {}).get(key, [])
+
+
+def supports_reload(unit_path: str) -> bool:
+    """
+    True if the unit defines an ExecReload command.
+    """
+    return bool(unit_directive(parse_unit_file(unit_path), 'Service', 'ExecReload'))
+
+
+def is_installable(unit_path: str) -> bool:
+    """
+    True if the unit has an [Install] section and can be enabled.
+    Units without one are only started by something else, e.g. their socket.
+    """
+    return bool(parse_unit_file(unit_path).get('Install'))
+
+
+def socket_service(socket_path: str) -> str:
+    """
+    Returns the service activated by a .socket unit: its Service= directive,
+    or the service with the same name as the socket.
+    """
+    service = unit_directive(parse_unit_file(socket_path), 'Socket', 'Service')
+    if service:
+        return service[-1]
+    return os.path.basename(socket_path)[:-len('.socket')] + '.service'
+
+
+def template_unit(unit: str) -> str:
+    """
+    Returns the template an instance unit is created from,
+    e.g. celery@worker.service -> celery@.service.
+    Units that are not instances are returned unchanged.
+    """
+    name, _, suffix = unit.rpartition('.')
+    if '@' in name:
+        return f"{name.split('@', 1)[0]}@.{suffix}"
+    return unit
+
+
+def instance_unit(template: str, instance: str) -> str:
+    """
+    Returns the name of an instance of a template unit,
+    e.g. celery@.service -> celery@worker.service.
+    """
+    return template.replace('@.', f'@{instance}.', 1)
+
+
+def unit_dependencies(unit: dict) -> set:
+    """
+    Returns the units a parsed unit is ordered after or requires (After= and Requires=).
+    """
+    names = set()
+    for key in ('After', 'Requires'):
+        for value in unit_directive(unit, 'Unit', key):
+            names.update(value.split())
+    return names
+
+
+def dependency_levels(units: list, unit_dir: str) -> list:
+    """
+    Groups units into levels that can be started together: a unit comes one level after
+    every other unit of the list it is ordered After= or Requires=.
+    Instances are read from their template in unit_dir. The units of a dependency cycle
+    share the last level, systemd orders them itself.
+    """
+    batch = set(units)
+    pending = {
+        unit: unit_dependencies(parse_unit_file(os.path.join(unit_dir, template_unit(unit))))
+        & batch - {unit}
+        for unit in units
+    }
+
+    levels = []
+    started = set()
+    while pending:
+        level = [unit for unit in pending if pending[unit] <= started] or list(pending)
+        levels.append(level)
+        started.update(level)
+        for unit in level:
+            del pending[unit]
+    return levels
+
+
+def parse_env_file(env_path: str) -> dict:
+    """
+    Parses a file in the EnvironmentFile= format into a dict.
+    Returns an empty dict if the file does not exist.
+    """
+    try:
+        with open(env_path, 'r', encoding='UTF-8') as env_file:
+            lines = env_file.read().splitlines()
+    except FileNotFoundError:
+        return {}
+
+    env = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in '#;' or '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        value = value.strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+            value = value[1:-1]
+        env[key.strip()] = value
+    return env
+
+
+# Resource controls that "systemctl set-property" applies to a running unit,
+# with the value that restores the default when a directive is removed.
+LIVE_PROPERTIES = {
+    'AllowedCPUs': '',
+    'CPUWeight': '100',
+    'CPUQuota': '',
+    'IOWeight': '100',
+    'MemoryLow': '0',
+    'MemoryHigh': 'infinity',
+    'MemoryMax': 'infinity',
+    'TasksMax': 'infinity',
+}
+
+
+def live_property_changes(old_unit: dict, new_unit: dict) -> dict:
+    """
+    Compares two parsed versions of a unit.
+    Returns {property: new value} if only live resource controls in [Service] changed,
+    or None if anything else changed and the unit has to be restarted.
+    """
+    if not old_unit or not new_unit:
+        return None
+
+    for section in set(old_unit) | set(new_unit):
+        old_section = old_unit.get(section, {})
+        new_section = new_unit.get(section, {})
+        ignored = LIVE_PROPERTIES if section == 'Service' else {}
+        for key in set(old_section) | set(new_section):
+            if key not in ignored and old_section.get(key) != new_section.get(key):
+                return None
+
+    old_service = old_unit.get('Service', {})
+    new_service = new_unit.get('Service', {})
+    changes = {}
+    for key, default in LIVE_PROPERTIES.items():
+        if old_service.get(key) != new_service.get(key):
+            values = new_service.get(key)
+            changes[key] = values[-1] if values else default
+    return changes
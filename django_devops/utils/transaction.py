@@ -0,0 +1,170 @@
+""" Deploys a batch of files at once, and restores them if the deploy is rolled back """
+
+import os
+import hashlib
+
+from django_devops.utils.files import atomic_write, fsync_directory, write_temp_file
+from django_devops.utils.logger import log, timed
+from django_devops.utils.manifest import is_current, record, stat_signature
+
+
+class DeployTransaction:
+    """
+    Deploys a batch of files as one unit.
+    Files are staged as temporary files next to their destination and only renamed into
+    place on commit, so systemd and nginx never read a partially written file. If a rename
+    fails, or the deploy is rolled back later, every file of the batch is restored.
+    Files staged for removal are only removed on commit, and restored on rollback.
+    """
+
+    def __init__(self):
+        # (src_path, dst_path, temporary path, previous content or None, digest),
+        # src_path, the temporary path and digest are None for a removed file.
+        self.staged = []
+        self.committed = []
+
+    def stage(
+            self, src_path: str, dst_path: str, content: bytes, old_content: bytes, digest: str
+        ) -> None:
+        """
+        Writes the new content of dst_path to a temporary file.
+        """
+        tmp_path = write_temp_file(dst_path, content, mode_from=src_path)
+        self.staged.append((src_path, dst_path, tmp_path, old_content, digest))
+
+    def stage_removal(self, dst_path: str) -> None:
+        """
+        Removes dst_path when the transaction is committed.
+        """
+        with open(dst_path, 'rb') as dst_file:
+            old_content = dst_file.read()
+        self.staged.append((None, dst_path, None, old_content, None))
+
+    def discard(self) -> None:
+        """
+        Removes the staged files that were not committed.
+        """
+        for _, _, tmp_path, _, _ in self.staged:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.staged = []
+
+    @timed('commit')
+    def commit(self, manifest: dict = None) -> None:
+        """
+        Backs up the previous versions to dst_path + '.old', renames every staged file
+        into place and removes the files staged for removal, then records them in the manifest.
+        Raises OSError after restoring the files already replaced if a step fails.
+        """
+        try:
+            for entry in self.staged:
+                _, dst_path, tmp_path, old_content, _ = entry
+                if old_content is not None:
+                    atomic_write(dst_path + '.old', old_content)
+                    log(f"Backed up old file to {dst_path}.old", "INFO")
+                if tmp_path is None:
+                    os.remove(dst_path)
+                    log(f"Removed file: {dst_path}", "INFO")
+                else:
+                    os.replace(tmp_path, dst_path)
+                    log(f"Updated file: {dst_path}", "INFO")
+                self.committed.append(entry)
+
+            for dir_path in {os.path.dirname(entry[1]) for entry in self.committed}:
+                fsync_directory(dir_path)
+        except OSError:
+            self.rollback()
+            raise
+        finally:
+            self.discard()
+
+        if manifest is not None:
+            for src_path, dst_path, _, _, digest in self.committed:
+                if src_path is None:
+                    manifest.pop(dst_path, None)
+                else:
+                    record(manifest, src_path, dst_path, digest)
+
+    def created(self) -> set:
+        """
+        Returns the committed files that did not exist before, an empty file did exist.
+        """
+        return {
+            dst_path for _, dst_path, _, old_content, _ in self.committed if old_content is None
+        }
+
+    def removed(self) -> set:
+        """
+        Returns the committed removals.
+        """
+        return {dst_path for src_path, dst_path, _, _, _ in self.committed if src_path is None}
+
+    def rollback(self) -> None:
+        """
+        Restores the previous version of every committed file, new files are removed.
+        """
+        for _, dst_path, _, old_content, _ in reversed(self.committed):
+            if old_content is not None:
+                atomic_write(dst_path, old_content)
+                log(f"Restored {dst_path}", "WARNING")
+            elif os.path.exists(dst_path):
+                os.remove(dst_path)
+                log(f"Removed {dst_path}", "WARNING")
+        self.committed = []
+
+
+@timed('deploy_file')
+def deploy_file(
+        src_path: str, dst_path: str, manifest: dict = None, transaction=None
+    ) -> bool:
+    """
+    Deploys a single file from src_path to dst_path.
+    Skips files the manifest shows as unchanged without reading them.
+    Changed files are staged in the DeployTransaction and only written when it is
+    committed, without a transaction the file is written right away.
+    The old version is backed up to dst_path + '.old' if content differs.
+    Returns True if the file was updated, False otherwise.
+    """
+    if stat_signature(src_path) is None:
+        log(f"Source file not found: {src_path}", "WARNING")
+        return False
+
+    if manifest is not None and is_current(manifest, src_path, dst_path):
+        log(f"No changes for {dst_path}", "INFO")
+        return False
+
+    # Read new content
+    with open(src_path, 'rb') as src_file:
+        new_content = src_file.read()
+    new_digest = hashlib.sha256(new_content).hexdigest()
+
+    # Read existing content (if any)
+    try:
+        with open(dst_path, 'rb') as dst_file:
+            old_content = dst_file.read()
+    except FileNotFoundError:
+        old_content = None
+
+    # If no change, do nothing
+    if new_content == old_content:
+        log(f"No changes for {dst_path}", "INFO")
+        if manifest is not None:
+            record(manifest, src_path, dst_path, new_digest)
+        return False
+
+    entry = (manifest or {}).get(dst_path)
+    if entry and old_content is not None and \
+            hashlib.sha256(old_content).hexdigest() != entry.get('digest'):
+        log(f"{dst_path} was modified outside of django_devops", "WARNING")
+
+    if transaction is None:
+        single = DeployTransaction()
+        single.stage(src_path, dst_path, new_content, old_content, new_digest)
+        single.commit(manifest)
+    else:
+        try:
+            transaction.stage(src_path, dst_path, new_content, old_content, new_digest)
+        except OSError:
+            transaction.discard()
+            raise
+    return True
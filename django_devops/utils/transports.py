@@ -0,0 +1,134 @@
+""" Transports that run update_services against other targets: a local root or an ssh host """
+
+import io
+import os
+import sys
+import time
+import shlex
+import tarfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Overridden by settings.DJANGO_DEVOPS_SSH_COMMAND or --ssh-command.
+SSH_COMMAND = 'ssh -o BatchMode=yes'
+
+
+def file_set(project_dir: str) -> bytes:
+    """
+    Packs the config_files and service_files folders of a project into a gzipped tar,
+    so every target receives the same rendered files. The folders are stored below the
+    name of the project, as they are found next to manage.py.
+    """
+    project_name = os.path.basename(os.path.normpath(project_dir))
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for folder in ('config_files', 'service_files'):
+            path = os.path.join(project_dir, folder)
+            if os.path.isdir(path):
+                archive.add(path, arcname=f'{project_name}/{folder}')
+    return buffer.getvalue()
+
+
+class Transport:
+    """
+    A target that update_services is run against, by a command that receives the file set
+    on its stdin if the target needs it.
+    """
+
+    name = ''
+    receives_files = False
+
+    def command(self, arguments: list) -> list:
+        """
+        Returns the command that runs update_services with arguments against the target.
+        """
+        raise NotImplementedError
+
+    def deploy(self, arguments: list, files: bytes, timeout: float) -> tuple:
+        """
+        Returns (exit code, output).
+        """
+        result = subprocess.run(
+            self.command(arguments), input=files if self.receives_files else None,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout, check=False
+        )
+        return result.returncode, result.stdout.decode('UTF-8', errors='replace')
+
+
+class LocalTransport(Transport):
+    """
+    Deploys into a directory on this machine, e.g. a chroot, a container rootfs or an
+    image being built, by running "update_services --root" in a child process.
+    The project is on this machine, so the file set is not sent.
+    """
+
+    def __init__(self, root: str, manage_py: str):
+        self.name = root
+        self.root = root
+        self.manage_py = manage_py
+
+    def command(self, arguments: list) -> list:
+        return [sys.executable, self.manage_py, 'update_services', '--root', self.root, *arguments]
+
+
+class SSHTransport(Transport):
+    """
+    Deploys to a host over ssh: the file set is unpacked into the project on the host,
+    then the host runs update_services itself with remote_python, e.g. the python of
+    the project's virtualenv.
+    The ssh command is configurable, any command called as "COMMAND HOST SCRIPT"
+    works, e.g. a local stand-in that runs SCRIPT with "sh -c" for tests.
+    """
+
+    receives_files = True
+
+    def __init__(self, host: str, ssh_command: str, remote_dir: str, remote_python: str):
+        self.name = f'ssh://{host}'
+        self.host = host
+        self.ssh_command = shlex.split(ssh_command)
+        self.remote_dir = remote_dir
+        self.remote_python = remote_python
+
+    def command(self, arguments: list) -> list:
+        remote_dir = shlex.quote(self.remote_dir)
+        command = ' '.join(shlex.quote(argument) for argument in arguments)
+        script = (
+            f'mkdir -p {remote_dir} && tar -xzf - -C {remote_dir} && cd {remote_dir} && '
+            f'{shlex.quote(self.remote_python)} manage.py update_services {command}'
+        )
+        return [*self.ssh_command, self.host, script]
+
+
+def parse_target(
+        target: str, manage_py: str, ssh_command: str, remote_dir: str, remote_python: str
+    ) -> Transport:
+    """
+    Returns the transport for a --target: "ssh://[user@]host" or a local directory.
+    """
+    if target.startswith('ssh://'):
+        return SSHTransport(target[len('ssh://'):], ssh_command, remote_dir, remote_python)
+    return LocalTransport(os.path.abspath(target), manage_py)
+
+
+def deploy_targets(
+        transports: list, arguments: list, files: bytes, parallel: int = 8, timeout: float = 600
+    ):
+    """
+    Deploys to every transport with up to parallel deploys at a time.
+    Yields (transport, exit code, seconds, output) as the deploys finish.
+    A transport that times out or can not be started is reported with exit code -1.
+    """
+    def deploy(transport):
+        start = time.monotonic()
+        try:
+            returncode, output = transport.deploy(arguments, files, timeout)
+        except subprocess.TimeoutExpired:
+            returncode, output = -1, f'Timed out after {timeout}s'
+        except OSError as err:
+            returncode, output = -1, str(err)
+        return transport, returncode, time.monotonic() - start, output
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        futures = [executor.submit(deploy, transport) for transport in transports]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,192 @@
+""" Watches directories for changed files, with inotify on Linux and polling elsewhere """
+
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+
+from django_devops.utils.logger import log
+
+# From <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+# A file is only reported once it is written and closed, or renamed into place.
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+# struct inotify_event without its name: wd, mask, cookie, len.
+EVENT = struct.Struct('iIII')
+
+
+def is_editor_file(path: str) -> bool:
+    """
+    True for the swap, backup and lock files editors write next to the file being edited.
+    """
+    name = os.path.basename(path)
+    return name.startswith(('.', '#')) or name.endswith(('~', '.swp', '.swx', '.tmp'))
+
+
+class Inotify:
+    """
+    A minimal ctypes wrapper of the Linux inotify API.
+    Raises OSError or AttributeError if inotify is not available.
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        # IN_NONBLOCK and IN_CLOEXEC have the values of O_NONBLOCK and O_CLOEXEC.
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+
+    def add_watch(self, dir_path: str) -> None:
+        """
+        Reports the files of a directory that change.
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dir_path)
+        self.watches[wd] = dir_path
+
+    def read(self, timeout: float = None) -> list:
+        """
+        Waits up to timeout seconds (None is forever) for events.
+        Returns the paths of the changed files, None stands for "events were lost".
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        paths = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                paths.append(None)
+            elif wd in self.watches and name:
+                paths.append(os.path.join(self.watches[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self) -> None:
+        """
+        Removes every watch.
+        """
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Compares the size, mtime and mode of the files every interval seconds,
+    for systems without inotify.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.dirs = []
+        self.signatures = {}
+
+    @staticmethod
+    def _scan(dir_path: str) -> dict:
+        """
+        Returns {path: (size, mtime_ns, mode)} of the files in a directory.
+        """
+        signatures = {}
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        signatures[entry.path] = (stat.st_size, stat.st_mtime_ns, stat.st_mode)
+        except FileNotFoundError:
+            pass
+        return signatures
+
+    def add_watch(self, dir_path: str) -> None:
+        """
+        Reports the files of a directory that change.
+        """
+        self.dirs.append(dir_path)
+        self.signatures.update(self._scan(dir_path))
+
+    def read(self, timeout: float = None) -> list:
+        """
+        Waits up to timeout seconds (None is forever) for changed files.
+        Returns their paths.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = self.interval if deadline is None else deadline - time.monotonic()
+            time.sleep(max(0, min(self.interval, remaining)))
+
+            signatures = {}
+            for dir_path in self.dirs:
+                signatures.update(self._scan(dir_path))
+            paths = [
+                path for path in set(signatures) | set(self.signatures)
+                if signatures.get(path) != self.signatures.get(path)
+            ]
+            self.signatures = signatures
+
+            if paths or (deadline is not None and time.monotonic() >= deadline):
+                return paths
+
+    def close(self) -> None:
+        """
+        Nothing to release.
+        """
+
+
+def file_watcher(interval: float = 1.0):
+    """
+    Returns an Inotify watcher, or a PollingWatcher if inotify is not available.
+    """
+    try:
+        return Inotify()
+    except (OSError, AttributeError) as err:
+        log(f"inotify is not available ({err}), polling every {interval}s", "WARNING")
+        return PollingWatcher(interval)
+
+
+def watch_files(dir_paths: list, debounce: float = 0.3, interval: float = 1.0):
+    """
+    Yields the set of files changed in dir_paths after each burst of edits,
+    once no file changed for debounce seconds. Editor swap and backup files are ignored.
+    Yields None when inotify lost events and every file has to be checked.
+    """
+    watcher = file_watcher(interval)
+    try:
+        for dir_path in dir_paths:
+            if os.path.isdir(dir_path):
+                watcher.add_watch(dir_path)
+
+        while True:
+            changed = set(watcher.read())
+            while changed:
+                more = watcher.read(debounce)
+                if not more:
+                    break
+                changed.update(more)
+
+            if None in changed:
+                yield None
+                continue
+            changed = {path for path in changed if not is_editor_file(path)}
+            if changed:
+                yield changed
+    finally:
+        watcher.close()